@@ -1,5 +1,7 @@
 from flask import (
     Flask,
+    Response,
+    g,
     request,
     jsonify,
     send_file,
@@ -7,48 +9,239 @@ from flask import (
     render_template,
 )
 from werkzeug.datastructures import FileStorage
+from werkzeug.wsgi import wrap_file
 import sqlite3
 import hashlib
 import os
 import random
 import logging
+import logging.handlers
+import atexit
 import jwt
 import sys
 import shutil
+import tempfile
 import json
 import lzma
-import io
+import math
+import struct
+import zlib
+import zstandard as zstd
+import re
 import argon2
 import threading
-from typing import TypedDict
-from pathlib import Path
-from datetime import datetime, timedelta
+import queue
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack, contextmanager
+from typing import Hashable, Iterable, Iterator, TypedDict
+from datetime import datetime, timedelta, timezone
 from flask_cors import CORS
 from secret_key import SECRET_KEY
 import secrets
 import time
 import string
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 logging.basicConfig(
     level=logging.INFO,  # Minimum level to log
     format="%(asctime)s UTC/GMT - %(name)s - %(levelname)s - %(message)s",
 )
 
+# app.log rolls over to app.log.1 ... app.log.<LOG_BACKUP_COUNT> at LOG_MAX_BYTES;
+# the processes writing to it take turns through app.log.lock
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# Records waiting for the log writer thread; beyond that they are dropped
+LOG_QUEUE_SIZE = 10000
+# One JSON object per line in app.log, instead of the text format
+LOG_JSON = False
+# Hot-path lines logged with extra=LOG_SAMPLED: one in LOG_SAMPLE_EVERY is kept
+LOG_SAMPLE_EVERY = 100
+LOG_SAMPLED = {"sample": True}
+
+
+class JsonLogFormatter(logging.Formatter):
+    "One JSON object per record, for log shippers"
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "sampled", None) is not None:
+            entry["sampled"] = record.sampled
+        return json.dumps(entry)
+
+
+class LogSampler(logging.Filter):
+    """
+    Keeps the first of every `every` records logged with extra=LOG_SAMPLED,
+    counted per call site, and notes how many it stands for; other records
+    always pass.
+    """
+
+    def __init__(self, every: int = LOG_SAMPLE_EVERY):
+        super().__init__()
+        self._every = every
+        self._lock = threading.Lock()
+        self._counts: Counter = Counter()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sample", False) or self._every <= 1:
+            return True
+        site = (record.pathname, record.lineno)
+        with self._lock:
+            seen = self._counts[site]
+            self._counts[site] += 1
+        if seen % self._every != 0:
+            return False
+        record.sampled = self._every
+        record.msg = f"{record.msg} (1 in {self._every} logged)"
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    "Never blocks the caller: records that don't fit in the queue are counted and dropped"
+
+    def __init__(self, queue_: queue.Queue):
+        super().__init__(queue_)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler for a file that several processes write to. A
+    rollover holds an exclusive lock on <file>.lock and leaves the files
+    alone if another process rotated them meanwhile, and a process reopens
+    the file once it was rotated under it, as WatchedFileHandler does.
+    Without fcntl (Windows) there is no lock, so only one process may write.
+    """
+
+    def __init__(self, filename: str, maxBytes: int = 0, backupCount: int = 0):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount)
+        self._lock_path = self.baseFilename + ".lock"
+        self._opened = self._stream_id()
+
+    def _stream_id(self) -> tuple[int, int]:
+        stat = os.fstat(self.stream.fileno())
+        return (stat.st_dev, stat.st_ino)
+
+    def _reopen_if_rotated(self):
+        try:
+            stat = os.stat(self.baseFilename)
+            current = (stat.st_dev, stat.st_ino)
+        except FileNotFoundError:
+            current = None
+        if current != self._opened:
+            if self.stream:
+                self.stream.close()
+            self.stream = self._open()
+            self._opened = self._stream_id()
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        self._reopen_if_rotated()
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        if fcntl is None:
+            super().doRollover()
+            self._opened = self._stream_id()
+            return
+        with open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._reopen_if_rotated()
+            self.stream.seek(0, os.SEEK_END)
+            if self.stream.tell() < self.maxBytes:
+                return  # rotated by another process while we waited
+            super().doRollover()
+            self._opened = self._stream_id()
+
+
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
 console_formatter = logging.Formatter("%(levelname)s - %(message)s")
 console_handler.setFormatter(console_formatter)
-file_handler = logging.FileHandler("app.log")
+# shared by the server processes and the maintenance task
+file_handler = SharedRotatingFileHandler(
+    "app.log", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+)
 file_handler.setLevel(logging.INFO)
 file_formatter = logging.Formatter(
     "%(asctime)s UTC/GMT - %(name)s - %(levelname)s - %(message)s"
 )
 file_formatter.converter = time.gmtime
-file_handler.setFormatter(file_formatter)
+file_handler.setFormatter(JsonLogFormatter() if LOG_JSON else file_formatter)
+
+# Callers only put records on a queue; the listener thread does the writing,
+# so no request holds a lock while the console or app.log is written to
+log_queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+log_queue_handler.addFilter(LogSampler())
+log_listener = logging.handlers.QueueListener(
+    log_queue_handler.queue, console_handler, file_handler, respect_handler_level=True
+)
+log_listener_pid: int | None = None
+
+# Threads don't survive a fork, and SQLite connections mustn't be used across
+# one, so a server that forks its workers after creating App (gunicorn
+# --preload) would leave them without any. What runs in the background is
+# therefore started per process, on first use, under this lock; each holder
+# remembers the pid it started in.
+process_start_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    "In a forked child: a free lock, and a queue without the parent's records"
+    global process_start_lock
+    process_start_lock = threading.Lock()
+    log_queue_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def start_log_listener():
+    """
+    Starts writing out the queued records, once per process. Not done at
+    import: App forks its credential workers first, before any thread runs.
+    A forked child gets a listener of its own the first time it's called.
+    """
+    global log_listener, log_listener_pid
+    with process_start_lock:
+        if log_listener_pid == os.getpid():
+            return
+        if log_listener_pid is not None:
+            log_listener = logging.handlers.QueueListener(
+                log_queue_handler.queue,
+                console_handler,
+                file_handler,
+                respect_handler_level=True,
+            )
+        log_listener_pid = os.getpid()
+        log_listener.start()
+        atexit.register(log_listener.stop)  # flushes what is still queued
+
 
 logger = logging.getLogger(__name__)
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+logger.addHandler(log_queue_handler)
+logger.propagate = False  # the root handler would write synchronously (and twice)
 
 
 def generate_slug(length=5):
@@ -61,12 +254,203 @@ ADMIN_HASHED_PASSWORD = "$argon2id$v=19$m=262144,t=6,p=4$gvj5zf9Szcc2MNnpsKctWg$
 
 ph = argon2.PasswordHasher()
 
+# Each Argon2 check of the admin credentials takes ~256 MiB and seconds of
+# CPU, so they run in worker processes: CREDENTIAL_WORKERS at a time, with
+# at most CREDENTIAL_MAX_PENDING more waiting. A client gets a burst of
+# CREDENTIAL_ATTEMPTS_BURST attempts, then one per CREDENTIAL_ATTEMPT_INTERVAL_SECONDS
+CREDENTIAL_WORKERS = 2
+CREDENTIAL_MAX_PENDING = 4
+CREDENTIAL_TIMEOUT_SECONDS = 30
+CREDENTIAL_ATTEMPTS_BURST = 5
+CREDENTIAL_ATTEMPT_INTERVAL_SECONDS = 12
+# Header the front-end proxy puts the client's address in, e.g. "X-Real-IP"; None
+# uses the peer address. Only set it if the proxy overwrites what clients send,
+# or a client can pick a new address (and rate limit bucket) for every attempt.
+CLIENT_ADDRESS_HEADER: str | None = None
+# /metrics histogram buckets: seconds, compressed/original size, writes per commit
+METRICS_SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+METRICS_BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+# Revocations made by other processes are picked up within this many seconds
+TOKEN_REVOCATION_SYNC_SECONDS = 2
+# Worlds deleted by other processes stop being found within this many seconds;
+# the deletions are kept this long for processes to read
+WORLD_DELETION_SYNC_SECONDS = 2
+WORLD_DELETION_RETENTION_SECONDS = 24 * 60 * 60
+# Tokens whose signature was already checked, kept until they expire
+VERIFIED_TOKEN_CACHE_SIZE = 256
+
+DB_POOL_SIZE = 8
+# Blobs are streamed to and from disk in chunks of this size
+BLOB_CHUNK_SIZE = 64 * 1024
+# Let the front-end web server send blob files (needs X-Sendfile support there)
+USE_X_SENDFILE = False
+# Threads hashing and compressing the files of one /upload/batch in parallel
+UPLOAD_WORKERS = min(4, os.cpu_count() or 1)
+# Columns added to tables since they were first created: (name, definition)
+ADDED_COLUMNS = {
+    "worlds": (
+        ("compressed", "INTEGER DEFAULT 0"),
+        ("total_bytes", "INTEGER"),
+        ("blob_count", "INTEGER"),
+        ("last_modified", "INTEGER"),
+        ("revision", "INTEGER NOT NULL DEFAULT 0"),
+        ("pruned_revision", "INTEGER NOT NULL DEFAULT 0"),
+    ),
+    "entries": (
+        ("revision", "INTEGER NOT NULL DEFAULT 0"),
+    ),
+    "blobs": (("verified", "INTEGER NOT NULL DEFAULT 0"), ("dict_id", "INTEGER")),
+}
+# /get_data encodings, by format query value; also negotiated through Accept
+MANIFEST_FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "binary": "application/x-worldsync-manifest",
+}
+# Manifest rows fetched from SQLite and encoded at a time
+MANIFEST_BATCH_ROWS = 1000
+# Memory the in-process manifest cache may use, and a rough per-row size
+# (tuple, int and two str headers) on top of the path and hash lengths
+MANIFEST_CACHE_MAX_BYTES = 64 * 1024 * 1024
+MANIFEST_ROW_OVERHEAD = 200
+# An encoded manifest is buffered in memory up to this size, then on disk
+MANIFEST_SPOOL_SIZE = 1024 * 1024
+# Binary manifest: magic, then revision (u64) and flags (u8), then records
+MANIFEST_BINARY_MAGIC = b"WSM1"
+# Decompressed blobs served to clients that can't decompress, kept by hash:
+# in memory, then in cache/blobs/ on disk (0 turns the disk tier off).
+# Bigger blobs are always streamed through the decompressor
+DOWNLOAD_CACHE_MAX_BYTES = 128 * 1024 * 1024
+DOWNLOAD_CACHE_DISK_MAX_BYTES = 1024 * 1024 * 1024
+DOWNLOAD_CACHE_MAX_BLOB_BYTES = 8 * 1024 * 1024
+# zstd blobs transcoded to LZMA are cached the same way, in cache/lzma/, and
+# transcoded at TRANSCODE_LZMA_PRESET; blobs too big for the cache are
+# transcoded at the faster TRANSCODE_LZMA_STREAM_PRESET on every download
+TRANSCODE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+TRANSCODE_CACHE_DISK_MAX_BYTES = 1024 * 1024 * 1024
+TRANSCODE_LZMA_PRESET = 6
+TRANSCODE_LZMA_STREAM_PRESET = 1
+# The consistency checker checks this many blob shards (objects/<ab>/) per
+# tick, on as many threads, one tick every CONSISTENCY_CHECK_TICK_SECONDS
+CONSISTENCY_CHECK_SHARDS_PER_TICK = 8
+CONSISTENCY_CHECK_WORKERS = 4
+CONSISTENCY_CHECK_TICK_SECONDS = 60
+# A blob file without a row is only deleted once it is this old: another
+# process's upload moves the file into place before its row is committed
+ORPHAN_BLOB_GRACE_SECONDS = 3600
+# Maintenance scheduler: how often it looks for due jobs, and how long no
+# request may have been in flight before idle-only jobs run
+MAINTENANCE_TICK_SECONDS = 5
+MAINTENANCE_IDLE_SECONDS = 30
+# Free pages returned to the filesystem per incremental vacuum slice
+MAINTENANCE_VACUUM_PAGES = 256
+MAINTENANCE_VACUUM_INTERVAL_SECONDS = 60
+MAINTENANCE_OPTIMIZE_INTERVAL_SECONDS = 3600
+# One table is analyzed per slice, reading at most this many rows of each index
+MAINTENANCE_ANALYZE_INTERVAL_SECONDS = 600
+MAINTENANCE_ANALYSIS_LIMIT = 1000
+# Worlds without files are deleted once they haven't changed for this long
+EMPTY_WORLD_GRACE_SECONDS = 24 * 3600
+# Tombstones of removed paths are kept this long for /get_data?since=
+TOMBSTONE_MAX_AGE_SECONDS = 30 * 24 * 3600
+# Unreferenced blobs deleted per transaction (and locked at once) by the GC
+GC_BATCH_SIZE = 1000
+# Most hashes accepted by one /upload/precheck call
+MAX_PRECHECK_HASHES = 10000
+# Hashes end up in file names, so only allow plain alphanumerics
+BLOB_HASH_PATTERN = re.compile(r"^[0-9A-Za-z]{8,128}$")
+# Codec ids, stored in the compressed column of entries and blobs. 0 and 1
+# are what the column held when it was a boolean, so old rows keep working.
+CODEC_NONE = 0
+CODEC_LZMA = 1
+CODEC_ZSTD = 2
+# Codec the server compresses uploads with (clients only ever send LZMA)
+UPLOAD_CODEC = CODEC_ZSTD
+# Blobs client_supports_compression downloads get LZMA compressed, the only
+# codec clients decode; zstd ones are transcoded (see TRANSCODE_LZMA_PRESET)
+LZMA_DOWNLOAD_CODECS = (CODEC_LZMA, CODEC_ZSTD)
+ZSTD_LEVEL = 3
+# A world gets its own zstd dictionary once it has this many small blobs
+ZSTD_DICT_MIN_SAMPLES = 64
+ZSTD_DICT_MAX_SAMPLES = 2000
+# Only blobs up to this size are sampled, big ones gain little from a dictionary
+ZSTD_DICT_MAX_SAMPLE_SIZE = 128 * 1024
+ZSTD_DICT_SIZE = 112 * 1024
+# Trained dictionaries kept in memory, least recently used ones are dropped
+ZSTD_DICT_CACHE_SIZE = 64
+# Short URL slugs resolved from memory; they never change once created
+SHORT_URL_CACHE_SIZE = 4096
+# Length of new slugs; /create_redirect_url has always made 7 character ones
+SHORT_URL_SLUG_LENGTH = 7
+# Dictionaries are trained by the maintenance task (another process), so the
+# world -> dictionary map is re-read this often
+ZSTD_DICT_RELOAD_SECONDS = 600
+# Level UPLOAD_CODEC uses for trial runs and for data that barely compresses
+COMPRESSION_FAST_LEVEL = 1
+# Uploads whose first bytes look like this are stored as they are
+COMPRESSION_ENTROPY_SAMPLE_SIZE = 8 * 1024
+COMPRESSION_MAX_ENTROPY = 7.9  # bits per byte; random data is ~7.98 at this sample size
+COMPRESSION_TRIAL_SIZE = 32 * 1024
+COMPRESSION_TRIAL_SKIP_RATIO = 0.97
+COMPRESSION_TRIAL_FAST_RATIO = 0.85
+# Formats that are compressed already, compressing them again only costs CPU
+COMPRESSED_EXTENSIONS = frozenset({
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".ogg", ".mp3", ".mp4",
+    ".zip", ".jar", ".gz", ".xz", ".zst", ".7z", ".rar", ".bz2",
+    ".mcpack", ".mcworld", ".mcaddon", ".mca", ".mcr",
+})
+# (offset, magic bytes) of the same kind of formats, for files with odd names
+COMPRESSED_MAGIC = (
+    (0, b"\x89PNG\r\n\x1a\n"),
+    (0, b"\xff\xd8\xff"),  # JPEG
+    (0, b"GIF8"),
+    (0, b"PK\x03\x04"),  # zip, jar, resource packs
+    (0, b"\x1f\x8b"),  # gzip, also gzipped NBT
+    (0, b"\xfd7zXZ\x00"),
+    (0, b"\x28\xb5\x2f\xfd"),  # zstd
+    (0, b"BZh"),
+    (0, b"7z\xbc\xaf\x27\x1c"),
+    (0, b"Rar!\x1a\x07"),
+    (0, b"OggS"),
+    (0, b"ID3"),  # mp3
+    (4, b"ftyp"),  # mp4
+    (8, b"WEBP"),
+)
+# Applied once per connection (pooled readers and the writer), right after it is opened
+SQLITE_CONNECTION_PRAGMAS = (
+    "PRAGMA busy_timeout=30000",
+    "PRAGMA synchronous=NORMAL",  # safe under WAL, only the last commits can roll back on power loss
+    "PRAGMA cache_size=-16384",  # KiB, per connection
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+)
+SQLITE_JOURNAL_MODE = "WAL"  # use "TRUNCATE" if the data dir is on a network filesystem
+# PASSIVE checkpoint on this interval, a TRUNCATE one when the server is idle
+WAL_CHECKPOINT_INTERVAL_SECONDS = 30
+
 
 class WorldDataStatisticsItem(TypedDict):
 
     id: str
     lastModifiedTime: str
     size: int
+    blobCount: int
+
+
+class WorldNotFoundError(LookupError):
+    "The world was deleted while a request was using it"
+
+
+class BatchUploadResult(TypedDict):
+
+    path: str
+    ok: bool
+    message: str
+
+
+class HashMismatchError(ValueError):
+    "An upload's bytes don't hash to the hash the client sent with it"
 
 
 def human_readable_time(dt: datetime) -> str:
@@ -100,9 +484,1349 @@ def human_readable_time(dt: datetime) -> str:
         return f"{int(years)} year{'s' if years >= 2 else ''} ago"
 
 
-class App:
+class MetricsRegistry:
+    """
+    Counters and histograms, exported in the Prometheus text format. Every
+    metric is declared once with counter() or histogram(), then updated by
+    name with labels as keyword arguments. Values are per process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> {"type", "help", "buckets", "values": {labels: value}}
+        self._metrics: dict[str, dict] = {}
+
+    def counter(self, name: str, help: str):
+        self._metrics[name] = {"type": "counter", "help": help, "values": {}}
+
+    def histogram(self, name: str, help: str, buckets=METRICS_SECONDS_BUCKETS):
+        self._metrics[name] = {
+            "type": "histogram",
+            "help": help,
+            "buckets": tuple(buckets),
+            "values": {},  # labels -> [count per bucket..., sum, count]
+        }
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        metric = self._metrics[name]
+        with self._lock:
+            metric["values"][key] = metric["values"].get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        metric = self._metrics[name]
+        buckets = metric["buckets"]
+        with self._lock:
+            counts = metric["values"].get(key)
+            if counts is None:
+                counts = [0] * (len(buckets) + 2)
+                metric["values"][key] = counts
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, name: str, **labels) -> Iterator[None]:
+        "Observes how long the block took, also when it raises"
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _labels(labels: tuple, extra: tuple = ()) -> str:
+        pairs = labels + extra
+        if len(pairs) == 0:
+            return ""
+        escaped = (
+            (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for key, value in pairs
+        )
+        return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, metric in self._metrics.items():
+                lines.append(f"# HELP {name} {metric['help']}")
+                lines.append(f"# TYPE {name} {metric['type']}")
+                for labels, value in metric["values"].items():
+                    if metric["type"] == "counter":
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(metric["buckets"], value):
+                        cumulative += count
+                        le = self._labels(labels, (("le", bound),))
+                        lines.append(f"{name}_bucket{le} {cumulative}")
+                    le = self._labels(labels, (("le", "+Inf"),))
+                    lines.append(f"{name}_bucket{le} {value[-1]}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {value[-2]}")
+                    lines.append(f"{name}_count{self._labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+class ReadWriteLock:
+    """
+    Writer-preferring reader/writer lock. Any number of readers may hold it at
+    once, a writer holds it alone. A thread that holds the write side may also
+    take the read side (it already excludes everyone else), and a thread that
+    reads may read again without queueing behind a waiting writer, which
+    would wait for it forever.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._waiting_writers = 0
+        self._writer: int | None = None
+        self._writer_depth = 0
+        self._held = threading.local()
+
+    def acquire_read(self):
+        with self._cond:
+            if self._writer == threading.get_ident():
+                self._writer_depth += 1
+                return
+            reads = getattr(self._held, "reads", 0)
+            if reads == 0:
+                while self._writer is not None or self._waiting_writers > 0:
+                    self._cond.wait()
+            self._readers += 1
+            self._held.reads = reads + 1
+
+    def release_read(self):
+        with self._cond:
+            if self._writer == threading.get_ident():
+                self._writer_depth -= 1
+                return
+            self._readers -= 1
+            self._held.reads -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth += 1
+                return
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers > 0:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._writer_depth -= 1
+            if self._writer_depth == 0:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class KeyedRWLock:
+    """
+    One ReadWriteLock per key (world id), created on first use and dropped
+    again once nobody holds or waits for it, so the table doesn't grow with
+    every world ever touched.
+
+    If a gate is given, every read/write also holds the gate in shared mode,
+    which lets a maintenance job take the gate exclusively and wait out all
+    in-flight requests. With metrics, the time taken to get the lock (gate
+    included) goes to worldsync_lock_wait_seconds, labelled with name.
+    """
+
+    def __init__(
+        self,
+        gate: ReadWriteLock | None = None,
+        metrics: MetricsRegistry | None = None,
+        name: str = "",
+    ):
+        self._gate = gate
+        self._metrics = metrics
+        self._name = name
+        self._mutex = threading.Lock()
+        self._locks: dict[Hashable, list] = {}  # key -> [ReadWriteLock, users]
+
+    def _checkout(self, key: Hashable) -> ReadWriteLock:
+        with self._mutex:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = [ReadWriteLock(), 0]
+                self._locks[key] = entry
+            entry[1] += 1
+            return entry[0]
+
+    def _checkin(self, key: Hashable):
+        with self._mutex:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    @contextmanager
+    def _hold(self, key: Hashable, exclusive: bool) -> Iterator[None]:
+        started = time.perf_counter()
+        if self._gate is not None:
+            self._gate.acquire_read()
+        lock = self._checkout(key)
+        try:
+            with lock.write() if exclusive else lock.read():
+                if self._metrics is not None:
+                    self._metrics.observe(
+                        "worldsync_lock_wait_seconds",
+                        time.perf_counter() - started,
+                        lock=self._name,
+                        mode="write" if exclusive else "read",
+                    )
+                yield
+        finally:
+            self._checkin(key)
+            if self._gate is not None:
+                self._gate.release_read()
+
+    def read(self, key: Hashable):
+        "Shared lock on one key, e.g. for serving downloads"
+        return self._hold(key, exclusive=False)
+
+    def write(self, key: Hashable):
+        "Exclusive lock on one key, e.g. for uploads and removals"
+        return self._hold(key, exclusive=True)
+
+
+def verify_admin_credentials(username: str, password: str) -> bool:
+    "Runs in a credential worker process. Both are always checked, so timing tells nothing"
+    is_username_correct = True
+    is_password_correct = True
+    try:
+        ph.verify(ADMIN_USERNAME, username)
+    except argon2.exceptions.VerifyMismatchError:
+        is_username_correct = False
+    try:
+        ph.verify(ADMIN_HASHED_PASSWORD, password)
+    except argon2.exceptions.VerifyMismatchError:
+        is_password_correct = False
+    return is_username_correct and is_password_correct
+
+
+class TokenBucketLimiter:
+    """
+    Per-key token buckets: burst tokens, refilled one per interval seconds.
+    Buckets that have refilled completely are dropped once there are many.
+    """
+
+    MAX_BUCKETS = 10000
+
+    def __init__(self, burst: int, interval: float):
+        self._burst = burst
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._buckets: dict[Hashable, tuple[float, float]] = {}  # key -> (tokens, at)
+
+    def try_acquire(self, key: Hashable) -> float:
+        "Takes a token; returns 0, or how many seconds until one is available"
+        now = time.monotonic()
+        with self._lock:
+            tokens, at = self._buckets.get(key, (self._burst, now))
+            tokens = min(self._burst, tokens + (now - at) / self._interval)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return (1 - tokens) * self._interval
+            self._buckets[key] = (tokens - 1, now)
+            if len(self._buckets) > self.MAX_BUCKETS:
+                self._prune(now)
+            return 0.0
+
+    def _prune(self, now: float):
+        full_after = self._burst * self._interval
+        self._buckets = {
+            key: (tokens, at)
+            for key, (tokens, at) in self._buckets.items()
+            if now - at < full_after
+        }
+
+
+class SQLiteConnectionPool:
+    """
+    Bounded pool of SQLite connections. Connections are opened lazily, get
+    their pragmas once, and are handed out through connection(), which always
+    puts them back. A thread that borrows while already holding a connection
+    gets the same one again, so nested helpers can't deadlock the pool.
+    With metrics, the time a connection is borrowed for is recorded.
+    A forked child starts with an empty pool (see process_start_lock).
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        max_size: int = DB_POOL_SIZE,
+        pragmas=(),
+        metrics: MetricsRegistry | None = None,
+    ):
+        self.db_path = db_path
+        self.pragmas = tuple(pragmas)
+        self._max_size = max_size
+        self._metrics = metrics
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._held = threading.local()
+        self._pid = os.getpid()
+        # the parent's connections, if forked; SQLite can't even close them here
+        self._inherited: list[queue.LifoQueue[sqlite3.Connection]] = []
+
+    def _leave_inherited(self):
+        with process_start_lock:
+            if self._pid == os.getpid():
+                return
+            self._inherited.append(self._idle)
+            self._idle = queue.LifoQueue()
+            self._slots = threading.BoundedSemaphore(self._max_size)
+            self._held = threading.local()
+            self._pid = os.getpid()
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path, isolation_level=None, timeout=30, check_same_thread=False
+        )  # auto-commit, 30 second lock wait timeout
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        if self._pid != os.getpid():
+            self._leave_inherited()
+        held = getattr(self._held, "conn", None)
+        if held is not None:
+            self._held.depth += 1
+            try:
+                yield held
+            finally:
+                self._held.depth -= 1
+            return
+
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._open()
+        except BaseException:
+            self._slots.release()
+            raise
+
+        self._held.conn = conn
+        self._held.depth = 0
+        started = time.perf_counter()
+        try:
+            yield conn
+        finally:
+            if self._metrics is not None:
+                self._metrics.observe(
+                    "worldsync_sqlite_seconds", time.perf_counter() - started, kind="read"
+                )
+            self._held.conn = None
+            try:
+                # never hand an open transaction to the next borrower
+                if conn.in_transaction:
+                    conn.rollback()
+            finally:
+                self._idle.put(conn)
+                self._slots.release()
+
+
+class SQLiteWriter:
+    """
+    The single connection every write goes through. transaction() blocks run
+    one at a time, each in a savepoint of the currently open batch; the commit
+    thread commits the batch as soon as the connection is free, so concurrent
+    writers share one COMMIT (and one fsync) instead of taking turns.
+    transaction() only returns once its batch has committed, and a thread
+    already inside one joins it. With metrics, it records the wait for the
+    connection, how long each write holds it, and each commit.
+    The connection and the commit thread are started by the first write in
+    each process, so a forked child doesn't wait on its parent's thread.
+    """
+
+    def __init__(self, db_path: str, pragmas=(), metrics: MetricsRegistry | None = None):
+        self._db_path = db_path
+        self._pragmas = tuple(pragmas)
+        self._metrics = metrics
+        self.conn: sqlite3.Connection | None = None
+        self._held = threading.local()
+        self._pid: int | None = None
+        # the parent's connection, if forked; SQLite can't even close it here
+        self._inherited: list[sqlite3.Connection] = []
+        self.commits = 0
+        self.writes = 0
+
+    def _start(self):
+        with process_start_lock:
+            if self._pid == os.getpid():
+                return
+            if self.conn is not None:
+                self._inherited.append(self.conn)
+            self.conn = sqlite3.connect(
+                self._db_path, isolation_level=None, timeout=30, check_same_thread=False
+            )
+            for pragma in self._pragmas:
+                self.conn.execute(pragma)
+            self._mutex = threading.Lock()  # whoever holds it owns the connection
+            self._cond = threading.Condition()
+            self._batch = 0  # id of the batch writers are joining
+            self._pending = 0  # released savepoints waiting in that batch
+            self._committed = -1
+            self._failed: dict[int, BaseException] = {}
+            self._held = threading.local()
+            self._thread = threading.Thread(
+                target=self._run, name="SQLiteWriter-Thread", daemon=True
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def held(self) -> bool:
+        return self._pid == os.getpid() and getattr(self._held, "depth", 0) > 0
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        if self._pid != os.getpid():
+            self._start()
+        if self.held():
+            self._held.depth += 1
+            try:
+                yield self.conn
+            finally:
+                self._held.depth -= 1
+            return
+
+        started = time.perf_counter()
+        with self._mutex:
+            acquired = time.perf_counter()
+            if not self.conn.in_transaction:
+                self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute("SAVEPOINT write")
+            self._held.depth = 1
+            try:
+                yield self.conn
+            except BaseException:
+                # some errors (SQLITE_FULL, ...) already rolled the batch back
+                if self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK TO write")
+                    self.conn.execute("RELEASE write")
+                with self._cond:
+                    if self._pending == 0 and self.conn.in_transaction:
+                        # nothing else in the batch, don't sit on the write lock
+                        self.conn.execute("COMMIT")
+                raise
+            finally:
+                self._held.depth = 0
+            self.conn.execute("RELEASE write")
+            with self._cond:
+                batch = self._batch
+                self._pending += 1
+                self._cond.notify_all()
+            if self._metrics is not None:
+                self._metrics.observe(
+                    "worldsync_lock_wait_seconds",
+                    acquired - started,
+                    lock="sqlite_writer",
+                    mode="write",
+                )
+                self._metrics.observe(
+                    "worldsync_sqlite_seconds", time.perf_counter() - acquired, kind="write"
+                )
+
+        with self._cond:
+            while self._committed < batch:
+                self._cond.wait()
+            error = self._failed.get(batch)
+        if error is not None:
+            raise sqlite3.OperationalError(f"group commit failed: {error}") from error
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending == 0:
+                    self._cond.wait()
+            with self._mutex:
+                error = None
+                started = time.perf_counter()
+                # whatever fails, the batch is settled below, or its writers
+                # would wait forever (holding their world and blob locks)
+                try:
+                    self.conn.execute("COMMIT")
+                except Exception as e:
+                    error = e
+                    logger.error(f"Group commit failed: {e}")
+                    try:
+                        if self.conn.in_transaction:
+                            self.conn.execute("ROLLBACK")
+                    except Exception as e:
+                        logger.error(f"Group commit rollback failed: {e}")
+                try:
+                    if self._metrics is not None:
+                        self._metrics.observe(
+                            "worldsync_sqlite_commit_seconds", time.perf_counter() - started
+                        )
+                        self._metrics.observe("worldsync_sqlite_commit_writes", self._pending)
+                except Exception as e:
+                    logger.error(f"Recording commit metrics failed: {e}")
+                with self._cond:
+                    batch = self._batch
+                    self.commits += 1
+                    self.writes += self._pending
+                    if error is not None:
+                        self._failed[batch] = error
+                    self._failed.pop(batch - 64, None)
+                    self._committed = batch
+                    self._batch += 1
+                    self._pending = 0
+                    self._cond.notify_all()
+
+
+class WorldRegistry:
+    """
+    Ids of the worlds that exist, loaded once at startup and kept up to date
+    by world creation and deletion so existence checks don't hit SQLite.
+    Deletions made by other processes are in the deleted_worlds table, whose
+    new rows are read through loader(after_seq) at most every
+    WORLD_DELETION_SYNC_SECONDS; their creations are looked up on a miss.
+    """
+
+    def __init__(self, loader, sync_seconds: float = WORLD_DELETION_SYNC_SECONDS):
+        self._loader = loader
+        self._sync_seconds = sync_seconds
+        self._lock = threading.Lock()
+        self._ids: set[int] = set()
+        self._seq = 0
+        self._synced_at: float | None = None
+
+    def load(self, ids, seq: int):
+        "All world ids, and the last deletion seq they reflect"
+        with self._lock:
+            self._ids = set(ids)
+            self._seq = seq
+            self._synced_at = time.monotonic()
+
+    def sync(self):
+        try:
+            rows = self._loader(self._seq)  # (seq, world_id)
+        except Exception as e:
+            logger.error(f"Failed to load world deletions: {e}")
+            rows = []
+        with self._lock:
+            for seq, world_id in rows:
+                self._seq = max(self._seq, seq)
+                self._ids.discard(world_id)
+            self._synced_at = time.monotonic()
+
+    def add(self, world_id: int):
+        with self._lock:
+            self._ids.add(world_id)
+
+    def discard(self, world_id: int):
+        with self._lock:
+            self._ids.discard(world_id)
+
+    def __contains__(self, world_id: int) -> bool:
+        synced_at = self._synced_at
+        if synced_at is None or time.monotonic() - synced_at > self._sync_seconds:
+            self.sync()
+        return world_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def ids(self) -> list[int]:
+        with self._lock:
+            return sorted(self._ids)
+
+
+class ManifestCache:
+    """
+    LRU of world manifests: the (id, path, hash, codec) rows of a world, as
+    of one revision. Every change to a world's entries bumps its revision,
+    in any process, so an entry is only used while the revision matches.
+    Bounded by an estimate of the memory the rows take; a world too big to
+    ever fit is remembered as such (rows None) until its revision changes.
+    """
+
+    def __init__(self, max_bytes: int = MANIFEST_CACHE_MAX_BYTES):
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # world id -> (revision, rows or None, size)
+        self._worlds: OrderedDict[int, tuple[int, tuple | None, int]] = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_world_bytes(self) -> int:
+        "Biggest manifest worth caching, so one world can't evict all others"
+        return self._max_bytes // 4
+
+    @staticmethod
+    def row_size(path: str, hash: str) -> int:
+        return MANIFEST_ROW_OVERHEAD + len(path) + len(hash)
+
+    def get(self, world_id: int, revision: int) -> tuple[int, tuple | None, int] | None:
+        with self._lock:
+            cached = self._worlds.get(world_id)
+            if cached is None or cached[0] != revision:
+                self.misses += 1
+                return None
+            self._worlds.move_to_end(world_id)
+            self.hits += 1
+            return cached
+
+    def put(self, world_id: int, revision: int, rows: tuple | None, size: int):
+        if rows is None:
+            size = 0  # only the marker is kept
+        with self._lock:
+            cached = self._worlds.pop(world_id, None)
+            if cached is not None:
+                self._size -= cached[2]
+                if cached[0] > revision:
+                    # a newer revision got here first
+                    self._worlds[world_id] = cached
+                    self._size += cached[2]
+                    return
+            self._worlds[world_id] = (revision, rows, size)
+            self._size += size
+            while self._size > self._max_bytes:
+                _world_id, (_revision, _rows, evicted) = self._worlds.popitem(last=False)
+                self._size -= evicted
+
+    def discard(self, world_id: int):
+        with self._lock:
+            cached = self._worlds.pop(world_id, None)
+            if cached is not None:
+                self._size -= cached[2]
+
+
+class DecompressedBlobCache:
+    """
+    Payloads made from blobs by hash: decompressed, for clients that can't
+    decompress, or transcoded to LZMA, for those that can. Content-addressed, so an entry never goes stale, only out of use: both
+    tiers evict least recently used first. The disk tier survives restarts
+    and is shared by the server processes, each of which only accounts for
+    the files it saw, so the directory can go somewhat over its budget.
+    """
+
+    def __init__(
+        self,
+        disk_dir: str | None,
+        max_bytes: int = DOWNLOAD_CACHE_MAX_BYTES,
+        disk_max_bytes: int = DOWNLOAD_CACHE_DISK_MAX_BYTES,
+        max_blob_bytes: int = DOWNLOAD_CACHE_MAX_BLOB_BYTES,
+    ):
+        self.max_blob_bytes = max_blob_bytes
+        self._max_bytes = max_bytes
+        self._disk_dir = disk_dir if disk_max_bytes > 0 else None
+        self._disk_max_bytes = disk_max_bytes
+        self._lock = threading.Lock()
+        self._blobs: OrderedDict[str, bytes] = OrderedDict()
+        self._size = 0
+        self._disk: OrderedDict[str, int] = OrderedDict()  # hash -> size
+        self._disk_size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self._disk_dir is not None:
+            self._scan_disk()
+
+    def _disk_path(self, hash: str) -> str:
+        return os.path.join(self._disk_dir, hash[:2], hash)
+
+    def _scan_disk(self):
+        "Picks up what earlier runs left, oldest first"
+        os.makedirs(self._disk_dir, exist_ok=True)
+        found = []
+        for shard in os.scandir(self._disk_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if BLOB_HASH_PATTERN.match(entry.name):
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, entry.name, stat.st_size))
+        for _mtime, hash, size in sorted(found):
+            self._disk[hash] = size
+            self._disk_size += size
+
+    def get(self, hash: str) -> bytes | None:
+        with self._lock:
+            data = self._blobs.get(hash)
+            if data is not None:
+                self._blobs.move_to_end(hash)
+                self.hits += 1
+                return data
+            on_disk = self._disk_dir is not None and hash in self._disk
+            if on_disk:
+                self._disk.move_to_end(hash)
+
+        if on_disk:
+            try:
+                with open(self._disk_path(hash), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                # evicted by another process
+                with self._lock:
+                    size = self._disk.pop(hash, None)
+                    if size is not None:
+                        self._disk_size -= size
+            else:
+                with self._lock:
+                    self.disk_hits += 1
+                self._put_memory(hash, data)
+                return data
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, hash: str, data: bytes):
+        if len(data) > self.max_blob_bytes:
+            return
+        self._put_memory(hash, data)
+        if self._disk_dir is not None:
+            self._put_disk(hash, data)
+
+    def _put_memory(self, hash: str, data: bytes):
+        with self._lock:
+            if hash in self._blobs:
+                return
+            self._blobs[hash] = data
+            self._size += len(data)
+            while self._size > self._max_bytes:
+                _hash, evicted = self._blobs.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+    def _put_disk(self, hash: str, data: bytes):
+        with self._lock:
+            if hash in self._disk:
+                return
+        path = self._disk_path(hash)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(path), delete=False
+            ) as temp_file:
+                temp_file.write(data)
+            os.replace(temp_file.name, path)
+        except OSError as e:
+            logger.error(f"download cache write failed for {hash}: {e}")
+            return
+
+        evicted = []
+        with self._lock:
+            self._disk[hash] = len(data)
+            self._disk_size += len(data)
+            while self._disk_size > self._disk_max_bytes and len(self._disk) > 1:
+                old_hash, size = self._disk.popitem(last=False)
+                self._disk_size -= size
+                evicted.append(old_hash)
+        for old_hash in evicted:
+            try:
+                os.remove(self._disk_path(old_hash))
+            except FileNotFoundError:
+                pass
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "blobs": len(self._blobs),
+                "bytes": self._size,
+                "disk_blobs": len(self._disk),
+                "disk_bytes": self._disk_size,
+            }
+
+
+class ZstdDictionaries:
+    """
+    Trained zstd dictionaries. The dictionary each world compresses with is
+    just an id, kept for every world and re-read through world_loader() every
+    ZSTD_DICT_RELOAD_SECONDS; the dictionaries themselves are loaded through
+    loader(dict_id) on first use and kept in a small LRU.
+    """
+
+    def __init__(self, loader, world_loader, max_size: int = ZSTD_DICT_CACHE_SIZE):
+        self._loader = loader
+        self._world_loader = world_loader
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._cache: OrderedDict[int, zstd.ZstdCompressionDict] = OrderedDict()
+        self._world_dicts: dict[int, int] = {}
+        self._worlds_loaded_at: float | None = None
+
+    def load_worlds(self):
+        pairs = self._world_loader()  # (world_id, dict_id), later ones win
+        with self._lock:
+            self._world_dicts = dict(pairs)
+            self._worlds_loaded_at = time.monotonic()
+
+    def set_world(self, world_id: int, dict_id: int):
+        with self._lock:
+            self._world_dicts[world_id] = dict_id
+
+    def for_world(self, world_id: int) -> zstd.ZstdCompressionDict | None:
+        loaded_at = self._worlds_loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > ZSTD_DICT_RELOAD_SECONDS:
+            self.load_worlds()
+        dict_id = self._world_dicts.get(world_id)
+        if dict_id is None:
+            return None
+        return self.get(dict_id)
+
+    def get(self, dict_id: int) -> zstd.ZstdCompressionDict | None:
+        with self._lock:
+            zdict = self._cache.get(dict_id)
+            if zdict is not None:
+                self._cache.move_to_end(dict_id)
+                return zdict
+
+        data = self._loader(dict_id)
+        if data is None:
+            return None
+        zdict = zstd.ZstdCompressionDict(data)
+        zdict.precompute_compress(level=ZSTD_LEVEL)
+
+        with self._lock:
+            self._cache[dict_id] = zdict
+            while len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+        return zdict
+
+
+class ShortUrlCache:
+    "LRU of slug -> URL. Short URLs are never changed or deleted, so entries can't go stale"
+
+    def __init__(self, max_size: int = SHORT_URL_CACHE_SIZE):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._urls: OrderedDict[str, str] = OrderedDict()
+
+    def get(self, slug: str) -> str | None:
+        with self._lock:
+            url = self._urls.get(slug)
+            if url is not None:
+                self._urls.move_to_end(slug)
+            return url
+
+    def put(self, slug: str, url: str):
+        with self._lock:
+            self._urls[slug] = url
+            self._urls.move_to_end(slug)
+            while len(self._urls) > self._max_size:
+                self._urls.popitem(last=False)
+
+
+class TokenRevocations:
+    """
+    Ids of revoked tokens, until the tokens would have expired anyway. The
+    revoked_tokens table is shared by all processes; its new rows are read
+    through loader(after_seq) at most every TOKEN_REVOCATION_SYNC_SECONDS,
+    so a check is a dict lookup.
+    """
+
+    def __init__(self, loader, sync_seconds: float = TOKEN_REVOCATION_SYNC_SECONDS):
+        self._loader = loader
+        self._sync_seconds = sync_seconds
+        self._lock = threading.Lock()
+        self._revoked: dict[int, int] = {}  # token id -> expiry (unix time)
+        self._seq = 0
+        self._synced_at: float | None = None
+
+    def sync(self):
+        try:
+            rows = self._loader(self._seq)  # (seq, token_id, expires_at)
+        except Exception as e:
+            logger.error(f"Failed to load token revocations: {e}")
+            rows = []
+        now = time.time()
+        with self._lock:
+            for seq, token_id, expires_at in rows:
+                self._seq = max(self._seq, seq)
+                self._revoked[token_id] = expires_at
+            self._revoked = {
+                token_id: expires_at
+                for token_id, expires_at in self._revoked.items()
+                if expires_at > now
+            }
+            self._synced_at = time.monotonic()
+
+    def add(self, token_id: int, expires_at: int):
+        with self._lock:
+            self._revoked[token_id] = expires_at
+
+    def is_revoked(self, token_id: int) -> bool:
+        synced_at = self._synced_at
+        if synced_at is None or time.monotonic() - synced_at > self._sync_seconds:
+            self.sync()
+        return token_id in self._revoked
+
+
+class VerifiedTokens:
+    "LRU of token -> payload for tokens whose signature checked out, until they expire"
+
+    def __init__(self, max_size: int = VERIFIED_TOKEN_CACHE_SIZE):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._tokens: OrderedDict[str, dict] = OrderedDict()
+
+    def get(self, token: str) -> dict | None:
+        with self._lock:
+            payload = self._tokens.get(token)
+            if payload is None:
+                return None
+            if payload["exp"] <= time.time():
+                del self._tokens[token]
+                return None
+            self._tokens.move_to_end(token)
+            return payload
+
+    def put(self, token: str, payload: dict):
+        if "exp" not in payload:
+            return  # never expires, so it's checked every time
+        with self._lock:
+            self._tokens[token] = payload
+            while len(self._tokens) > self._max_size:
+                self._tokens.popitem(last=False)
+
+
+class LzmaCodec:
+    "The original codec; also what clients that compress themselves send"
+
+    id = CODEC_LZMA
+
+    def compressor(self, world_id: int | None = None, level: int | None = None):
+        return lzma.LZMACompressor(preset=level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lzma.decompress(data)
+
+    def iter_decompress(self, blob_file) -> Iterator[bytes]:
+        decompressor = lzma.LZMADecompressor()
+        with blob_file:
+            while not decompressor.eof:
+                if decompressor.needs_input:
+                    chunk = blob_file.read(BLOB_CHUNK_SIZE)
+                    if not chunk:
+                        raise lzma.LZMAError("Compressed data ended before the end-of-stream marker")
+                else:
+                    chunk = b""
+                # max_length keeps highly compressible blobs from expanding
+                # into one huge buffer
+                data = decompressor.decompress(chunk, max_length=BLOB_CHUNK_SIZE)
+                if data:
+                    yield data
+
+
+class ZstdCodec:
+    """
+    zstd at a fixed level, with the world's trained dictionary when it has
+    one. The frame header names the dictionary, so decoding works no matter
+    which world a (shared) blob was first uploaded to.
+    """
+
+    id = CODEC_ZSTD
+
+    def __init__(self, dictionaries: ZstdDictionaries, level: int = ZSTD_LEVEL):
+        self.dictionaries = dictionaries
+        self.level = level
+
+    def compressor(self, world_id: int | None = None, level: int | None = None):
+        zdict = None
+        if world_id is not None:
+            zdict = self.dictionaries.for_world(world_id)
+        return zstd.ZstdCompressor(
+            level=self.level if level is None else level, dict_data=zdict
+        ).compressobj()
+
+    def _decompressor(self, header: bytes) -> zstd.ZstdDecompressor:
+        dict_id = zstd.get_frame_parameters(header).dict_id
+        zdict = None
+        if dict_id != 0:
+            zdict = self.dictionaries.get(dict_id)
+            if zdict is None:
+                raise zstd.ZstdError(f"missing zstd dictionary {dict_id}")
+        return zstd.ZstdDecompressor(dict_data=zdict)
+
+    def decompress(self, data: bytes) -> bytes:
+        # streamed frames don't record the content size, so no one-shot decompress()
+        return self._decompressor(data).decompressobj().decompress(data)
+
+    def iter_decompress(self, blob_file) -> Iterator[bytes]:
+        with blob_file:
+            header = blob_file.read(18)  # longest possible frame header
+            blob_file.seek(0)
+            decompressor = self._decompressor(header).decompressobj(
+                write_size=BLOB_CHUNK_SIZE
+            )
+            while not decompressor.eof:
+                chunk = blob_file.read(BLOB_CHUNK_SIZE)
+                if not chunk:
+                    raise zstd.ZstdError("Compressed data ended before the end of the frame")
+                data = decompressor.decompress(chunk)
+                if data:
+                    yield data
+
+
+def iter_rows(cursor: sqlite3.Cursor) -> Iterator[tuple]:
+    "The rows of an executed query, fetched MANIFEST_BATCH_ROWS at a time"
+    while rows := cursor.fetchmany(MANIFEST_BATCH_ROWS):
+        yield from rows
+
+
+def encode_manifest_json(
+    revision: int,
+    full: bool,
+    entries: Iterable[tuple],
+    removed: Iterable[tuple],
+    include_compression: bool = False,
+) -> Iterator[bytes]:
+    """
+    The {ok, revision, full, data, removed} object /get_data always returned.
+    entries are (id, path, hash, codec) rows; with include_compression each
+    entry also says whether it downloads LZMA compressed.
+    """
+    yield b'{"ok":true,"revision":%d,"full":%s,"data":[' % (
+        revision,
+        b"true" if full else b"false",
+    )
+    separator = b""
+    for id, path, hash, codec in entries:
+        entry = {"id": id, "path": path, "hash": hash}
+        if include_compression:
+            entry["compressed"] = codec in LZMA_DOWNLOAD_CODECS
+        yield separator + json.dumps(entry, separators=(",", ":")).encode()
+        separator = b","
+    yield b'],"removed":['
+    separator = b""
+    for (path,) in removed:
+        yield separator + json.dumps(path).encode()
+        separator = b","
+    yield b"]}"
+
+
+def encode_manifest_ndjson(
+    revision: int,
+    full: bool,
+    entries: Iterable[tuple],
+    removed: Iterable[tuple],
+    include_compression: bool = False,
+) -> Iterator[bytes]:
+    """
+    One JSON object per line: {"revision", "full"} first, then an
+    {"id", "path", "hash"} (and "compressed") per entry and a
+    {"removed": path} per removed path.
+    """
+    compact = (",", ":")
+    yield json.dumps({"revision": revision, "full": full}, separators=compact).encode() + b"\n"
+    for id, path, hash, codec in entries:
+        entry = {"id": id, "path": path, "hash": hash}
+        if include_compression:
+            entry["compressed"] = codec in LZMA_DOWNLOAD_CODECS
+        yield json.dumps(entry, separators=compact).encode() + b"\n"
+    for (path,) in removed:
+        yield json.dumps({"removed": path}, separators=compact).encode() + b"\n"
+
+
+def encode_manifest_binary(
+    revision: int,
+    full: bool,
+    entries: Iterable[tuple],
+    removed: Iterable[tuple],
+    include_compression: bool = False,
+) -> Iterator[bytes]:
+    """
+    MANIFEST_BINARY_MAGIC, revision (u64), flags (u8: 1 = full, 2 = entries
+    end with a compressed byte), then records, all big-endian, each
+    starting with its type (u8):
+    1: entry id (i64), path length (u16), UTF-8 path, SHA-1 (20 raw bytes)
+    2: entry id (i64), path length (u16), UTF-8 path, hash length (u8), hash
+       (for client-provided hashes that aren't a hex SHA-1)
+    3: path length (u16), UTF-8 path of a removed entry
+    0: end of the manifest
+    """
+    flags = (1 if full else 0) | (2 if include_compression else 0)
+    yield MANIFEST_BINARY_MAGIC + struct.pack(">QB", revision, flags)
+    for id, path, hash, codec in entries:
+        path_bytes = path.encode()
+        tail = struct.pack(">B", codec in LZMA_DOWNLOAD_CODECS) if include_compression else b""
+        if len(hash) == 40:
+            try:
+                raw_hash = bytes.fromhex(hash)
+            except ValueError:
+                pass  # not hex, send it as it is
+            else:
+                yield struct.pack(">BqH", 1, id, len(path_bytes)) + path_bytes + raw_hash + tail
+                continue
+        hash_bytes = hash.encode()
+        yield (
+            struct.pack(">BqH", 2, id, len(path_bytes))
+            + path_bytes
+            + struct.pack(">B", len(hash_bytes))
+            + hash_bytes
+            + tail
+        )
+    for (path,) in removed:
+        path_bytes = path.encode()
+        yield struct.pack(">BH", 3, len(path_bytes)) + path_bytes
+    yield b"\x00"
+
+
+MANIFEST_ENCODERS = {
+    "json": encode_manifest_json,
+    "ndjson": encode_manifest_ndjson,
+    "binary": encode_manifest_binary,
+}
+
+
+def looks_compressed(path: str | None, head: bytes) -> str | None:
+    """
+    Whether a file is a format that is compressed already, judging by its
+    extension and its first bytes. Returns which of the two said so.
+    """
+    if path is not None:
+        if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+            return "extension"
+    for offset, magic in COMPRESSED_MAGIC:
+        if head[offset : offset + len(magic)] == magic:
+            return "magic"
+    return None
+
+
+def byte_entropy(data: bytes) -> float:
+    "Shannon entropy of the byte values, in bits per byte (0 to 8)"
+    if len(data) == 0:
+        return 0.0
+    total = len(data)
+    entropy = 0.0
+    for count in Counter(data).values():
+        p = count / total
+        entropy -= p * math.log2(p)
+    return entropy
+
+
+class CompressionStats:
+    """
+    Counts how uploads were handled by the compression heuristics, and the
+    CPU time spent compressing, so the time the skips saved can be estimated
+    from how fast compression actually runs here.
+
+    Decisions: "full" and "fast" (compressed at ZSTD_LEVEL or
+    COMPRESSION_FAST_LEVEL), "extension", "magic", "entropy" and "trial"
+    (stored as they are, and why).
+    """
+
+    SKIPS = ("extension", "magic", "entropy", "trial")
 
     def __init__(self):
+        self._lock = threading.Lock()
+        self._decisions: dict[str, list] = {}  # decision -> [count, bytes]
+        self._compressed_bytes = 0
+        self._compression_cpu = 0.0
+        self._trial_cpu = 0.0
+        self._reversed = [0, 0, 0.0]  # count, bytes, cpu seconds
+
+    def record(
+        self,
+        decision: str,
+        size: int,
+        cpu_seconds: float = 0.0,
+        trial_cpu_seconds: float = 0.0,
+        kept: bool = True,
+    ):
+        "One upload of size bytes. kept=False: compressed, but it didn't get smaller"
+        with self._lock:
+            counts = self._decisions.setdefault(decision, [0, 0])
+            counts[0] += 1
+            counts[1] += size
+            self._trial_cpu += trial_cpu_seconds
+            if decision in self.SKIPS:
+                return
+            self._compressed_bytes += size
+            self._compression_cpu += cpu_seconds
+            if not kept:
+                self._reversed[0] += 1
+                self._reversed[1] += size
+                self._reversed[2] += cpu_seconds
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            seconds_per_byte = 0.0
+            if self._compressed_bytes > 0:
+                seconds_per_byte = self._compression_cpu / self._compressed_bytes
+            skipped_bytes = sum(
+                counts[1]
+                for decision, counts in self._decisions.items()
+                if decision in self.SKIPS
+            )
+            return {
+                "decisions": {
+                    decision: {"count": counts[0], "bytes": counts[1]}
+                    for decision, counts in self._decisions.items()
+                },
+                "reversed": {
+                    "count": self._reversed[0],
+                    "bytes": self._reversed[1],
+                    "cpu_seconds": self._reversed[2],
+                },
+                "compression_cpu_seconds": self._compression_cpu,
+                "trial_cpu_seconds": self._trial_cpu,
+                "cpu_seconds_per_mb": seconds_per_byte * 1024 * 1024,
+                "estimated_cpu_seconds_saved": max(
+                    0.0, skipped_bytes * seconds_per_byte - self._trial_cpu
+                ),
+            }
+
+
+class MaintenanceScheduler:
+    """
+    Runs periodic jobs on one background thread. Jobs marked idle_only wait
+    until no request has been in flight for MAINTENANCE_IDLE_SECONDS, so
+    they only take time nobody is waiting for; each run should be a small
+    slice of work. Requests are counted through request_started() and
+    request_finished(). start() runs the thread in the calling process, so
+    a forked child calls it again.
+    """
+
+    def __init__(
+        self,
+        tick_seconds: float = MAINTENANCE_TICK_SECONDS,
+        idle_seconds: float = MAINTENANCE_IDLE_SECONDS,
+    ):
+        self._tick_seconds = tick_seconds
+        self._idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._last_request = time.monotonic()
+        self._jobs: dict[str, dict] = {}
+        self._thread: threading.Thread | None = None
+        self._pid: int | None = None
+
+    def add_job(self, name: str, interval: float, fn, idle_only: bool = True):
+        self._jobs[name] = {
+            "fn": fn,
+            "interval": interval,
+            "idle_only": idle_only,
+            "next_run": time.monotonic() + interval,
+            "runs": 0,
+            "last_run": None,  # unix time
+            "last_duration": None,
+            "last_error": None,
+        }
+
+    def request_started(self):
+        with self._lock:
+            self._in_flight += 1
+
+    def request_finished(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._last_request = time.monotonic()
+
+    def is_idle(self) -> bool:
+        with self._lock:
+            return (
+                self._in_flight == 0
+                and time.monotonic() - self._last_request >= self._idle_seconds
+            )
+
+    def run_pending(self):
+        for name, job in self._jobs.items():
+            if time.monotonic() < job["next_run"]:
+                continue
+            if job["idle_only"] and not self.is_idle():
+                continue
+            started = time.monotonic()
+            job["last_run"] = time.time()
+            try:
+                job["fn"]()
+                job["last_error"] = None
+            except Exception as e:
+                logger.error(f"maintenance job {name} failed: {e}")
+                job["last_error"] = str(e)
+            job["runs"] += 1
+            job["last_duration"] = time.monotonic() - started
+            job["next_run"] = time.monotonic() + job["interval"]
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+
+        def run():
+            while True:
+                time.sleep(self._tick_seconds)
+                self.run_pending()
+
+        with process_start_lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # forked: the parent's requests aren't in flight here
+                self._lock = threading.Lock()
+                self._in_flight = 0
+            self._thread = threading.Thread(
+                target=run, daemon=True, name="MaintenanceScheduler-Thread"
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def status(self) -> dict:
+        now = time.monotonic()
+        return {
+            "idle": self.is_idle(),
+            "in_flight": self._in_flight,
+            "jobs": {
+                name: {
+                    "interval_seconds": job["interval"],
+                    "idle_only": job["idle_only"],
+                    "runs": job["runs"],
+                    "last_run": job["last_run"],
+                    "last_duration_seconds": job["last_duration"],
+                    "last_error": job["last_error"],
+                    "due_in_seconds": max(0.0, job["next_run"] - now),
+                }
+                for name, job in self._jobs.items()
+            },
+        }
+
+
+class App:
+
+    def __init__(self, base_dir: str | None = None):
         # Base directory: PythonAnywhere path for linux, else the module directory
         if sys.platform.startswith("linux"):
             self.base_dir = "/home/mcworldsyncutils/mysite"
@@ -110,22 +1834,96 @@ class App:
         else:
             self.base_dir = os.path.abspath(os.path.dirname(__file__))
             self.is_prod = False
+        if base_dir is not None:
+            # the data (database, objects/, cache/) lives elsewhere, e.g. in tests
+            self.base_dir = base_dir
 
         logger.info("Templates directory: %s" % os.path.join(self.base_dir, "templates"))
         logger.info("App started")
 
-        self.worlds_lock = threading.Lock()
+        # Argon2 checks run in worker processes, started before any thread is
+        # (log records queue up until then)
+        self.credential_pool = self._new_credential_pool()
+        self.credential_pool_pid = os.getpid()
+        start_log_listener()
+        self.credential_pool_lock = threading.Lock()
+        self.credential_slots = threading.BoundedSemaphore(
+            CREDENTIAL_WORKERS + CREDENTIAL_MAX_PENDING
+        )
+        self.credential_limiter = TokenBucketLimiter(
+            CREDENTIAL_ATTEMPTS_BURST, CREDENTIAL_ATTEMPT_INTERVAL_SECONDS
+        )
+
+        self.metrics = MetricsRegistry()
+        self._register_metrics()
+
+        # Startup/maintenance jobs close the gate; requests only contend per world
+        self.startup_gate = ReadWriteLock()
+        self.world_locks = KeyedRWLock(
+            gate=self.startup_gate, metrics=self.metrics, name="world"
+        )
+        # Blobs are shared between worlds; always taken after the world lock
+        self.blob_locks = KeyedRWLock(
+            gate=self.startup_gate, metrics=self.metrics, name="blob"
+        )
 
         self.app = Flask(
             __name__, template_folder=os.path.join(self.base_dir, "templates")
         )
         CORS(self.app)
+        self.app.config["USE_X_SENDFILE"] = USE_X_SENDFILE
+
+        self.db_pool = SQLiteConnectionPool(
+            os.path.join(self.base_dir, "database.db"),
+            pragmas=SQLITE_CONNECTION_PRAGMAS,
+            metrics=self.metrics,
+        )
+        self.writer = SQLiteWriter(
+            os.path.join(self.base_dir, "database.db"),
+            pragmas=SQLITE_CONNECTION_PRAGMAS,
+            metrics=self.metrics,
+        )
+
+        self.zstd_dictionaries = ZstdDictionaries(
+            self._load_zstd_dictionary, self._load_world_dictionary_ids
+        )
+        self.codecs = {
+            CODEC_LZMA: LzmaCodec(),
+            CODEC_ZSTD: ZstdCodec(self.zstd_dictionaries),
+        }
+        self.compression_stats = CompressionStats()
+        # zstd and hashlib release the GIL, so batch files ingest in parallel
+        self.upload_executor = ThreadPoolExecutor(
+            max_workers=UPLOAD_WORKERS, thread_name_prefix="Upload"
+        )
+
+        self.short_urls = ShortUrlCache()
+        self.revoked_tokens = TokenRevocations(self._load_token_revocations)
+        self.verified_tokens = VerifiedTokens()
 
-        self.revoked_tokens: set[int] = set()
+        self.worlds = WorldRegistry(self._load_world_deletions)
+        self.manifest_cache = ManifestCache()
+        self.download_cache = DecompressedBlobCache(
+            os.path.join(self.base_dir, "cache", "blobs")
+        )
+        self.transcode_cache = DecompressedBlobCache(
+            os.path.join(self.base_dir, "cache", "lzma"),
+            max_bytes=TRANSCODE_CACHE_MAX_BYTES,
+            disk_max_bytes=TRANSCODE_CACHE_DISK_MAX_BYTES,
+        )
 
         self._initialize_database()
         self._enable_write_ahead_logging()
         self._migrate_database()
+        self._migrate_world_tables()
+        self._load_world_registry()
+        self.zstd_dictionaries.load_worlds()
+        self._migrate_world_folders()
+        self._reconcile_world_stats(only_missing=True)
+        self.maintenance = MaintenanceScheduler()
+        self._schedule_maintenance()
+        # the maintenance thread starts with the first request, in the
+        # process serving it: a pre-fork server may fork after this
         # self._run_deferred_tasks()
     
         # self.app.before()
@@ -136,6 +1934,9 @@ class App:
         self.app.add_url_rule(
             "/upload/batch", view_func=self._on_upload_data_batched, methods=["POST"]
         )
+        self.app.add_url_rule(
+            "/upload/precheck", view_func=self._on_upload_precheck, methods=["POST"]
+        )
         self.app.add_url_rule(
             "/remove", view_func=self._on_remove_data, methods=["DELETE"]
         )
@@ -180,6 +1981,24 @@ class App:
             view_func=self._get_world_files_compression_info,
             methods=["GET"],
         )
+        self.app.add_url_rule(
+            "/api/world/manifest",
+            view_func=self._on_get_world_manifest,
+            methods=["GET"],
+        )
+        self.app.add_url_rule(
+            "/api/maintenance_status",
+            view_func=self._get_maintenance_status,
+            methods=["GET"],
+        )
+        self.app.add_url_rule(
+            "/api/compression_stats",
+            view_func=self._get_compression_stats,
+            methods=["GET"],
+        )
+        self.app.add_url_rule("/metrics", view_func=self._get_metrics, methods=["GET"])
+        self.app.before_request(self._start_request_metrics)
+        self.app.after_request(self._record_request_metrics)
         if not self.is_prod:
             self.app.add_url_rule("/manage", view_func=self._manage, methods=["GET"])
             
@@ -206,17 +2025,33 @@ class App:
     def run_deferred_startup_tasks_task(self):
         logger.info("Run deferred tasks...")
         try:
-            self.worlds_lock.acquire()
-            self._clean_database()
-            self._migrate_per_file_compressions()
-            self._detect_double_compression()
+            self._run_deferred_phase(self._enable_incremental_vacuum)
+            # checks a shard at a time under blob locks, no gate needed
+            self._run_deferred_phase(self._clean_database)
+            with self.startup_gate.write():
+                self._run_deferred_phase(self._migrate_per_file_compressions)
+                self._run_deferred_phase(self._detect_double_compression)
+                self._run_deferred_phase(self._reconcile_world_stats)
+                self._run_deferred_phase(self._prune_tombstones)
+            logger.info("deferred tasks startup gate released")
+            # after the blob rewrites above; hashes under blob locks
+            self._run_deferred_phase(self._verify_stored_blobs)
+            # CPU heavy and only reads blobs, so requests may run meanwhile
+            self._run_deferred_phase(self._train_zstd_dictionaries)
         except Exception as e:
             logger.error(f"deferred tasks failed: {e}")
-        finally:
-            logger.info("deferred tasks worlds lock released")
-            self.worlds_lock.release()
         logger.info("Deferred tasks complete")
 
+    def _run_deferred_phase(self, phase):
+        name = phase.__name__.lstrip("_")
+        outcome = "failed"
+        try:
+            with self.metrics.time("worldsync_deferred_phase_seconds", phase=name):
+                phase()
+            outcome = "completed"
+        finally:
+            self.metrics.inc("worldsync_deferred_phases_total", phase=name, outcome=outcome)
+
     def _run_deferred_tasks(self):
 
         thread = threading.Thread(
@@ -228,182 +2063,500 @@ class App:
         logger.info("Deferred tasks thread started")
 
     def _enable_write_ahead_logging(self):
-        conn = sqlite3.connect(os.path.join(self.base_dir, "database.db"))
-        conn.execute("PRAGMA journal_mode=TRUNCATE")
-        conn.execute("PRAGMA busy_timeout=30000")
-        conn.commit()
-        conn.close()
+        # journal_mode is persistent, the other pragmas are set per connection
+        with self._db() as (conn, cursor):
+            cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+            mode = cursor.fetchone()[0]
+        if mode.upper() != SQLITE_JOURNAL_MODE:
+            logger.warning(f"Database stayed in journal_mode={mode}")
+
+    def _delete_world_rows(self, cursor: sqlite3.Cursor, world_id: int):
+        cursor.execute("DELETE FROM entries WHERE world_id = ?", (world_id,))
+        cursor.execute("DELETE FROM tombstones WHERE world_id = ?", (world_id,))
+        cursor.execute("DELETE FROM worlds WHERE id = ?", (world_id,))
+        # so other processes' registries drop it too
+        cursor.execute(
+            "DELETE FROM deleted_worlds WHERE deleted_at < ?",
+            (int(time.time()) - WORLD_DELETION_RETENTION_SECONDS,),
+        )
+        cursor.execute(
+            "INSERT INTO deleted_worlds (world_id, deleted_at) VALUES (?, ?)",
+            (world_id, int(time.time())),
+        )
+        self.worlds.discard(world_id)
 
     def _clean_database(self):
-
+        """
+        Finishes the current consistency check cycle right away. The
+        maintenance scheduler does the same work a few shards at a time; see
+        _check_consistency_tick. Freed pages are returned by the scheduler's
+        incremental vacuum.
+        """
         logger.info("running clean db job")
+        while not self._check_consistency_tick(CONSISTENCY_CHECK_SHARDS_PER_TICK):
+            pass
+        logger.info("clean db job complete")
 
-        conn, cursor = self._get_db()
-
-        try:
-
-            cursor.execute("SELECT * FROM worlds")
-            rows = cursor.fetchall()
+    def _schedule_maintenance(self):
+        self.maintenance.add_job(
+            "consistency_check",
+            CONSISTENCY_CHECK_TICK_SECONDS,
+            lambda: self._check_consistency_tick(CONSISTENCY_CHECK_SHARDS_PER_TICK),
+            idle_only=False,
+        )
+        self.maintenance.add_job(
+            "incremental_vacuum", MAINTENANCE_VACUUM_INTERVAL_SECONDS, self._vacuum_slice
+        )
+        self.maintenance.add_job(
+            "wal_checkpoint",
+            WAL_CHECKPOINT_INTERVAL_SECONDS,
+            self._checkpoint_wal,
+            idle_only=False,
+        )
+        self.maintenance.add_job(
+            "optimize", MAINTENANCE_OPTIMIZE_INTERVAL_SECONDS, self._optimize_database
+        )
+        self.maintenance.add_job(
+            "analyze", MAINTENANCE_ANALYZE_INTERVAL_SECONDS, self._analyze_slice
+        )
 
-            for row in rows:
-                id = int(row[0])
-                table_name = "world_" + str(id)
+        self.app.before_request(self._start_process_threads)
+        # requests in flight, so idle-only jobs stay out of their way
+        self.app.before_request(self.maintenance.request_started)
+        self.app.teardown_request(lambda _error: self.maintenance.request_finished())
+
+    def _start_process_threads(self):
+        "Starts the background threads in a process serving its first request"
+        start_log_listener()
+        self.maintenance.start()
+
+    def _vacuum_slice(self):
+        "Returns up to MAINTENANCE_VACUUM_PAGES free pages to the filesystem"
+        with self._transaction() as (conn, cursor):
+            cursor.execute("PRAGMA freelist_count")
+            if cursor.fetchone()[0] == 0:
+                return
+            cursor.execute(f"PRAGMA incremental_vacuum({MAINTENANCE_VACUUM_PAGES})")
+            cursor.fetchall()  # the pages are freed as the rows are stepped through
+
+    def _checkpoint_wal(self):
+        """
+        Copies the WAL back into the database file. PASSIVE never waits on
+        readers or the writer; when idle, TRUNCATE also resets the WAL file.
+        """
+        if SQLITE_JOURNAL_MODE != "WAL":
+            return
+        mode = "TRUNCATE" if self.maintenance.is_idle() else "PASSIVE"
+        with self._db() as (conn, cursor):
+            cursor.execute(f"PRAGMA wal_checkpoint({mode})")
+            busy, log_pages, checkpointed = cursor.fetchone()
+        if busy:
+            logger.debug(f"wal checkpoint ({mode}) busy, {checkpointed}/{log_pages} pages")
+
+    def _optimize_database(self):
+        with self._transaction() as (conn, cursor):
+            cursor.execute("PRAGMA optimize")
+
+    def _analyze_slice(self):
+        "ANALYZEs the next table (in name order), with a bounded row budget"
+        with self._transaction() as (conn, cursor):
+            cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+            )
+            tables = [row[0] for row in cursor.fetchall()]
+            if len(tables) == 0:
+                return
+            cursor.execute("SELECT value FROM maintenance_state WHERE key = 'analyze_last_table'")
+            row = cursor.fetchone()
+            last = "" if row is None else row[0]
+            table = next((name for name in tables if name > last), tables[0])
+
+            cursor.execute(f"PRAGMA analysis_limit={MAINTENANCE_ANALYSIS_LIMIT}")
+            cursor.execute(f'ANALYZE "{table}"')
+            cursor.execute(
+                "INSERT OR REPLACE INTO maintenance_state (key, value) VALUES ('analyze_last_table', ?)",
+                (table,),
+            )
 
-                # check if table exists
+    def _enable_incremental_vacuum(self):
+        """
+        Switches databases created before auto_vacuum=INCREMENTAL over. That
+        takes one full VACUUM, so it runs from the maintenance task, once.
+        """
+        with self._db() as (conn, cursor):
+            cursor.execute("PRAGMA auto_vacuum")
+            if cursor.fetchone()[0] == 2:  # INCREMENTAL
+                return
+            logger.info("enabling incremental vacuum (one full VACUUM)")
+            cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            cursor.execute("VACUUM")
+        logger.info("incremental vacuum enabled")
+
+    def _database_status(self) -> dict:
+        with self._db() as (conn, cursor):
+            status = {}
+            for pragma in (
+                "journal_mode", "auto_vacuum", "page_count", "page_size", "freelist_count"
+            ):
+                cursor.execute(f"PRAGMA {pragma}")
+                status[pragma] = cursor.fetchone()[0]
+        status["group_commits"] = self.writer.commits
+        status["writes"] = self.writer.writes
+        return status
+
+    def _register_metrics(self):
+        m = self.metrics
+        m.counter("worldsync_http_requests_total", "Requests handled, by route, method and status")
+        m.histogram(
+            "worldsync_http_request_duration_seconds",
+            "Time until the response was ready (streamed bodies not included), by route",
+        )
+        m.counter("worldsync_bytes_received_total", "Request body bytes, by route")
+        m.counter("worldsync_bytes_served_total", "Response body bytes, by route")
+        m.counter("worldsync_bytes_stored_total", "Bytes of new blobs written to the store, by codec")
+        m.histogram(
+            "worldsync_lock_wait_seconds",
+            "Time waiting for a lock (world and blob locks include the startup gate)",
+        )
+        m.histogram("worldsync_sqlite_seconds", "Time a connection is held, reads and writes")
+        m.histogram("worldsync_sqlite_commit_seconds", "Time per group commit")
+        m.histogram(
+            "worldsync_sqlite_commit_writes", "Writes per group commit", METRICS_BATCH_BUCKETS
+        )
+        m.histogram("worldsync_compress_seconds", "CPU time compressing one blob, by codec")
+        m.histogram(
+            "worldsync_compression_ratio",
+            "Compressed size over original size, by codec",
+            METRICS_RATIO_BUCKETS,
+        )
+        m.histogram("worldsync_decompress_seconds", "Time decompressing one blob, by codec")
+        m.counter(
+            "worldsync_download_transcodes_total",
+            "zstd blobs sent LZMA compressed, by outcome (cached, cacheable, streamed)",
+        )
+        m.histogram(
+            "worldsync_transcode_seconds", "Time transcoding one blob to LZMA, by preset"
+        )
+        m.histogram("worldsync_deferred_phase_seconds", "Duration of deferred task phases")
+        m.counter("worldsync_deferred_phases_total", "Deferred task phases run, by outcome")
+
+    def _start_request_metrics(self):
+        g.request_started = time.perf_counter()
+
+    def _record_request_metrics(self, response: Response):
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        started = g.get("request_started")
+        if started is not None:
+            self.metrics.observe(
+                "worldsync_http_request_duration_seconds",
+                time.perf_counter() - started,
+                route=route,
+                method=request.method,
+            )
+        self.metrics.inc(
+            "worldsync_http_requests_total",
+            route=route,
+            method=request.method,
+            status=response.status_code,
+        )
+        if request.content_length:
+            self.metrics.inc("worldsync_bytes_received_total", request.content_length, route=route)
 
-                cursor.execute(
-                    f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}'"
-                )
-                table_exists = cursor.fetchone() is not None
+        if response.content_length is not None:
+            self.metrics.inc("worldsync_bytes_served_total", response.content_length, route=route)
+        elif response.is_streamed:
+            response.response = self._count_served_bytes(response.response, route)
+        return response
 
-                if not table_exists:
-                    try:
-                        logger.info(
-                            f"[ DELETE WORLD ] delete {table_name}. reason: table does not exist"
-                        )
-                        cursor.execute("DELETE FROM worlds WHERE id = ?", (id,))
-                    except Exception as e:
-                        logger.error(f"delete world failed: {e}")
-                    continue
+    def _count_served_bytes(self, chunks, route: str) -> Iterator[bytes]:
+        try:
+            for chunk in chunks:
+                self.metrics.inc("worldsync_bytes_served_total", len(chunk), route=route)
+                yield chunk
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
 
-                # check if folder exists
+    def _get_metrics(self):
+        "This process's metrics, in the Prometheus text format"
+        return Response(self.metrics.render(), mimetype="text/plain; version=0.0.4")
 
-                folder_path = os.path.join(self.base_dir, "objects", table_name)
-                folder_exists = os.path.exists(folder_path)
+    def _get_maintenance_status(self):
+        "Maintenance jobs of this process, and database space figures"
+        token = request.args.get("token")
+        if token == None:
+            return jsonify(ok=False, message="No token provided"), 400
 
-                if not folder_exists:
-                    try:
-                        logger.info(
-                            f"[ DELETE WORLD ] delete {table_name}. reason: folder does not exist"
-                        )
-                        # delete row
-                        cursor.execute("DELETE FROM worlds WHERE id = ?", (id,))
-                        # drop table if it exists
-                        logger.info(
-                            f"[ DROP TABLE ] drop {table_name}, reason: folder does not exist"
-                        )
-                        cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
-                    except Exception as e:
-                        logger.error(f"delete world failed: {e}")
-                    continue
+        if not self._is_token_valid(token):
+            return jsonify(ok=False, message="Invalid token"), 401
 
-                # check if folder is empty
+        data = self.maintenance.status()
+        data["database"] = self._database_status()
+        data["log_records_dropped"] = log_queue_handler.dropped
+        return jsonify(ok=True, data=data, message="OK"), 200
 
-                folder_contents = os.listdir(folder_path)
-                if len(folder_contents) == 0:
-                    try:
-                        logger.info(
-                            f"[ DELETE WORLD ] delete {table_name}. reason: folder is empty"
-                        )
-                        # delete row
-                        cursor.execute("DELETE FROM worlds WHERE id = ?", (id,))
-                        # drop table if it exists
-                        logger.info(
-                            f"[ DROP TABLE ] drop {table_name}, reason: folder is empty"
-                        )
-                        cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
-                    except Exception as e:
-                        logger.error(f"delete world failed: {e}")
-                    continue
+    def _check_consistency_tick(self, max_shards: int) -> bool:
+        """
+        One step of the consistency check: claims the next max_shards blob
+        shards (objects/<ab>/) after the checkpoint kept in the database,
+        so several processes share the work, and checks them in parallel.
+        A cycle starts with the row-level cleanup and ends with the GC.
+        Returns whether this tick finished a cycle.
+        """
+        shards = self._blob_shards()
+        with self._transaction() as (conn, cursor):
+            cursor.execute(
+                "SELECT value FROM maintenance_state WHERE key = 'consistency_checkpoint'"
+            )
+            row = cursor.fetchone()
+            checkpoint = "" if row is None else row[0]
+            claimed = [shard for shard in shards if shard > checkpoint][:max_shards]
+            finished = len(claimed) == 0 or claimed[-1] == shards[-1]
+            cursor.execute(
+                """
+                INSERT OR REPLACE INTO maintenance_state (key, value)
+                VALUES ('consistency_checkpoint', ?)
+                """,
+                ("" if finished else claimed[-1],),
+            )
 
-            for row in rows:
-                id = int(row[0])
-                table_name = "world_" + str(id)
+        if checkpoint == "":
+            logger.info("consistency check cycle started")
+            self._clean_database_rows()
+            self._clean_loose_files()
+
+        with ThreadPoolExecutor(
+            max_workers=CONSISTENCY_CHECK_WORKERS, thread_name_prefix="Consistency"
+        ) as pool:
+            for shard, error in zip(claimed, pool.map(self._check_blob_shard, claimed)):
+                if error is not None:
+                    logger.error(f"checking blob shard {shard} failed: {error}")
+
+        if finished:
+            self._collect_garbage_blobs()
+            self._clean_zstd_dictionaries()
+            logger.info("consistency check cycle complete")
+        return finished
+
+    def _blob_shards(self) -> list[str]:
+        "Sorted two-character blob prefixes, on disk or in the blobs table"
+        objects_dir = os.path.join(self.base_dir, "objects")
+        shards: set[str] = set()
+        if os.path.isdir(objects_dir):
+            with os.scandir(objects_dir) as it:
+                for entry in it:
+                    if entry.is_dir() and len(entry.name) == 2:
+                        shards.add(entry.name)
+
+        # one index seek per prefix; hashes are alphanumeric, "~" sorts after them
+        with self._db() as (conn, cursor):
+            cursor.execute("SELECT substr(MIN(hash), 1, 2) FROM blobs")
+            prefix = cursor.fetchone()[0]
+            while prefix is not None:
+                shards.add(prefix)
+                cursor.execute(
+                    "SELECT substr(MIN(hash), 1, 2) FROM blobs WHERE hash > ?",
+                    (prefix + "~",),
+                )
+                prefix = cursor.fetchone()[0]
+        return sorted(shards)
 
-                if not self._does_table_exist(table_name):
-                    continue  # cleaned up previously
+    def _check_blob_shard(self, shard: str) -> Exception | None:
+        """
+        Diffs the hashes the blobs table has under one prefix against the
+        files in objects/<shard>/: rows without a file go (with their
+        entries), files without a row are deleted once older than
+        ORPHAN_BLOB_GRACE_SECONDS. Both are rechecked under the blob's lock,
+        since an upload in this process may be storing it right now; the
+        grace period covers uploads in other processes.
+        """
+        try:
+            with self._db() as (conn, cursor):
+                cursor.execute("SELECT hash FROM blobs WHERE hash GLOB ?", (shard + "*",))
+                stored = {row[0] for row in cursor.fetchall()}
+
+            on_disk: set[str] = set()
+            shard_dir = os.path.join(self.base_dir, "objects", shard)
+            if os.path.isdir(shard_dir):
+                with os.scandir(shard_dir) as subdirs:
+                    for subdir in subdirs:
+                        if not subdir.is_dir():
+                            continue
+                        with os.scandir(subdir.path) as files:
+                            on_disk.update(
+                                file.name
+                                for file in files
+                                if file.name.startswith(shard + subdir.name)
+                            )
 
-                cursor.execute(f"SELECT * FROM {table_name}")
+            for hash in stored - on_disk:
+                with self.blob_locks.write(hash):
+                    if os.path.exists(self._blob_path(hash)):
+                        continue
+                    with self._transaction() as (conn, cursor):
+                        cursor.execute("DELETE FROM entries WHERE hash = ?", (hash,))
+                        cursor.execute("DELETE FROM blobs WHERE hash = ?", (hash,))
+                logger.info(
+                    f"[ DELETE ROW ] delete blob {hash} and its entries because the file doesn't exist"
+                )
 
-                for file in cursor.fetchall():
-                    id = file[0]
-                    path = file[1]
-                    hash = file[2]
+            for hash in on_disk - stored:
+                blob_path = self._blob_path(hash)
+                with self.blob_locks.write(hash):
+                    try:
+                        stat = os.stat(blob_path)
+                    except FileNotFoundError:
+                        continue
+                    # ctime too: moving a file into place doesn't change its mtime
+                    changed = max(stat.st_mtime, stat.st_ctime)
+                    if time.time() - changed < ORPHAN_BLOB_GRACE_SECONDS:
+                        continue
+                    with self._db() as (conn, cursor):
+                        cursor.execute("SELECT 1 FROM blobs WHERE hash = ?", (hash,))
+                        if cursor.fetchone() is not None:
+                            continue
+                    logger.info(
+                        f"[ DELETE FILE ] delete blob {hash} because it doesn't exist in table"
+                    )
+                    os.remove(blob_path)
+        except Exception as e:
+            return e
+        return None
 
-                    # check if file exists, and remove row if it doesn't
+    def _clean_database_rows(self):
+        "Set-based cleanup of rows that point at nothing"
+        try:
+            # worlds nothing was ever uploaded to (or everything was removed
+            # from), left alone for a while so a new world can get its files
+            with self._db() as (conn, cursor):
+                cursor.execute(
+                    """
+                    SELECT id FROM worlds WHERE id NOT IN (SELECT world_id FROM entries)
+                    AND (last_modified IS NULL OR last_modified < ?)
+                    """,
+                    (int(time.time()) - EMPTY_WORLD_GRACE_SECONDS,),
+                )
+                empty_worlds = [row[0] for row in cursor.fetchall()]
 
-                    blob_path = os.path.join(
-                        self.base_dir, "objects", table_name, f"blob_{hash}.bin"
-                    )
-                    if os.path.exists(blob_path) is False:
-                        # delete row
-                        try:
+            for id in empty_worlds:
+                try:
+                    with self.world_locks.write(id):
+                        with self._transaction() as (conn, cursor):
                             cursor.execute(
-                                f"DELETE FROM {table_name} WHERE id = ?", (id,)
-                            )
-                            logger.info(
-                                f"[ DELETE ROW ] delete in {table_name} row {path} because it doesn't exist"
+                                "SELECT 1 FROM entries WHERE world_id = ? LIMIT 1", (id,)
                             )
-                        except Exception as e:
-                            logger.error(f"failed to delete row: {e}")
-                        continue
-
-                # do the opposite, loop through all files, check if it exists in the table, and delete file if it doesn't
+                            if cursor.fetchone() is not None:
+                                continue  # got files meanwhile
+                            logger.info(f"[ DELETE WORLD ] delete {id}. reason: world is empty")
+                            self._delete_world_rows(cursor, id)
+                        self.manifest_cache.discard(id)
+                except Exception as e:
+                    logger.error(f"delete world failed: {e}")
+
+            with self._transaction() as (conn, cursor):
+                # entries left behind by worlds that no longer exist
+                cursor.execute(
+                    "DELETE FROM entries WHERE world_id NOT IN (SELECT id FROM worlds)"
+                )
+                if cursor.rowcount > 0:
+                    logger.info(f"[ DELETE ROW ] deleted {cursor.rowcount} orphaned entries")
+                cursor.execute(
+                    "DELETE FROM tombstones WHERE world_id NOT IN (SELECT id FROM worlds)"
+                )
 
-                folder_contents = os.listdir(
-                    os.path.join(self.base_dir, "objects", table_name)
+                cursor.execute(
+                    "DELETE FROM entries WHERE hash NOT IN (SELECT hash FROM blobs)"
                 )
-                for file in folder_contents:
-                    if file.startswith("blob_"):
-                        try:
-                            hash = file[5:-4]
-                            cursor.execute(
-                                f"SELECT * FROM {table_name} WHERE hash = ?", (hash,)
-                            )
-                            if cursor.fetchone() is None:
-                                logger.info(
-                                    f"[ DELETE FILE ] delete in {table_name} filehash {hash} because it doesn't exist in table"
-                                )
-                                os.remove(
-                                    os.path.join(
-                                        self.base_dir, "objects", table_name, file
-                                    )
-                                )
-                        except Exception as e:
-                            logger.error(f"failed to delete file: {e}")
+                if cursor.rowcount > 0:
+                    logger.info(f"[ DELETE ROW ] deleted {cursor.rowcount} entries without a blob")
+        except Exception as e:
+            logger.error(f"cleanup job failed: {e}")
 
-            for world in os.listdir(os.path.join(self.base_dir, "objects")):
-                if not world.startswith("world_"):
-                    continue
+    def _clean_loose_files(self):
+        "Temp files of uploads that never finished, folders of deleted worlds"
+        temp_dir = self._upload_temp_dir()
+        if os.path.isdir(temp_dir):
+            for file in os.listdir(temp_dir):
+                temp_path = os.path.join(temp_dir, file)
+                try:
+                    if time.time() - os.path.getmtime(temp_path) > 3600:
+                        logger.info(f"[ DELETE FILE ] stale upload {temp_path}")
+                        os.remove(temp_path)
+                except Exception as e:
+                    logger.error(f"failed to delete file: {e}")
+
+        objects_dir = os.path.join(self.base_dir, "objects")
+        if not os.path.isdir(objects_dir):
+            return
+        for world in os.listdir(objects_dir):
+            if not world.startswith("world_"):
+                continue
 
-                # check if table exists
+            # folders of deleted worlds, from before the shared store
 
-                if not self._does_table_exist(world):
-                    # delete row
-                    # logger.info(f"[ DELETE WORLD ] delete {world}. reason: table does not exist")
-                    # cursor.execute(f"DROP TABLE IF EXISTS {world}")
-                    # delete from worlds if it exists
+            world_id = self._parse_world_id(world[6:])
+            if world_id is None or world_id not in self.worlds:
+                try:
+                    shutil.rmtree(os.path.join(objects_dir, world))
+                except Exception as e:
+                    logger.error("unused folder delete failed")
+                    logger.error(e)
 
-                    try:
-                        shutil.rmtree(os.path.join(self.base_dir, "objects", world))
-                    except Exception as e:
-                        logger.error("unused folder delete failed")
-                        logger.error(e)
+                logger.info(
+                    f"[ DELETE FOLDER ] {world} reason: world does not exist"
+                )
 
-                    logger.info(
-                        f"DROP TABLE IF EXISTS: {world} reason: table does not exist"
+    def _clean_zstd_dictionaries(self):
+        "Drops dictionaries of deleted worlds once no stored blob uses them"
+        try:
+            self._look_up_zstd_dict_ids()
+            with self._db() as (conn, cursor):
+                cursor.execute(
+                    "SELECT 1 FROM blobs WHERE compressed = ? AND dict_id IS NULL LIMIT 1",
+                    (CODEC_ZSTD,),
+                )
+                if cursor.fetchone() is not None:
+                    return  # some blob's dictionary is unknown, keep them all this time
+                cursor.execute(
+                    """
+                    SELECT dict_id FROM zstd_dictionaries
+                    WHERE world_id NOT IN (SELECT id FROM worlds)
+                    AND NOT EXISTS (SELECT 1 FROM blobs WHERE blobs.dict_id = zstd_dictionaries.dict_id)
+                    """
+                )
+                orphaned = [row[0] for row in cursor.fetchall()]
+                if len(orphaned) == 0:
+                    return
+
+            with self._transaction() as (conn, cursor):
+                for dict_id in orphaned:
+                    logger.info(f"[ DELETE ROW ] unused zstd dictionary {dict_id}")
+                    cursor.execute(
+                        "DELETE FROM zstd_dictionaries WHERE dict_id = ?", (dict_id,)
                     )
-                    try:
+        except Exception as e:
+            logger.error(f"zstd dictionary cleanup failed: {e}")
+
+    def _look_up_zstd_dict_ids(self):
+        "Fills in dict_id for zstd blobs stored before it was recorded"
+        with self._db() as (conn, cursor):
+            cursor.execute(
+                "SELECT hash FROM blobs WHERE compressed = ? AND dict_id IS NULL",
+                (CODEC_ZSTD,),
+            )
+            hashes = [row[0] for row in cursor.fetchall()]
+
+        for hash in hashes:
+            try:
+                with self.blob_locks.read(hash):
+                    dict_id = self._zstd_dict_id(self._blob_path(hash))
+                    with self._transaction() as (conn, cursor):
                         cursor.execute(
-                            "DELETE FROM worlds WHERE id = ?", (int(world[6:]),)
+                            "UPDATE blobs SET dict_id = ? WHERE hash = ? AND compressed = ?",
+                            (dict_id, hash, CODEC_ZSTD),
                         )
-                    except Exception as e:
-                        logger.error(f"cannot delete from row: {e}")
-                    continue
-        except Exception as e:
-            logger.error(f"cleanup job failed: {e}")
-        conn.commit()
-        conn.close()
-        logger.info("clean db job complete")
-        logger.info("running vacumn job")
-        try:
-            conn, cursor = self._get_db()
-            cursor.execute("VACUUM")
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            logger.error(f"vacumn job failed: {e}")
-        logger.info("vacumn job complete")
+            except Exception as e:
+                logger.error(f"reading zstd dictionary of blob {hash} failed: {e}")
 
     def _get_free_space(self):
         _total, _used, free = shutil.disk_usage(self.base_dir)
@@ -424,36 +2577,534 @@ class App:
             os.path.join(self.base_dir, "static/assets"), filename
         )
 
-    def _get_db(self):
+    @contextmanager
+    def _db(self) -> Iterator[tuple[sqlite3.Connection, sqlite3.Cursor]]:
         """
-        PLEASE DON'T FORGET TO CALL .CLOSE() ON THE CONNECTION ONCE YOU ARE DONE, THANKS!!!
-        WE DON'T WANT MEMORY LEAKS PLAGUING OUR SERVER!!!
+        Borrow a pooled connection: `with self._db() as (conn, cursor):`.
+        It goes back to the pool when the block exits, don't close it.
+        Inside a _transaction() this is the writer connection, so reads see
+        the block's own uncommitted writes.
         """
-        db_path = os.path.join(self.base_dir, "database.db")
-        conn = sqlite3.connect(
-            db_path, isolation_level=None, timeout=30
-        )  # auto-commit, 30 second lock wait timeout
-        cursor = conn.cursor()
-        return (conn, cursor)
+        if self.writer.held():
+            connection = self.writer.transaction()
+        else:
+            connection = self.db_pool.connection()
+        with connection as conn:
+            cursor = conn.cursor()
+            try:
+                yield (conn, cursor)
+            finally:
+                cursor.close()
 
     def _initialize_database(self):
-        conn, cursor = self._get_db()
-        cursor.execute("CREATE TABLE IF NOT EXISTS worlds (id INTEGER PRIMARY KEY)")
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS shortened_urls (id INTEGER PRIMARY KEY, slug TEXT, url TEXT)"
-        )
-        conn.commit()
-        conn.close()
+        with self._db() as (conn, cursor):
+            # only takes effect on a new database, existing ones are switched
+            # over by _enable_incremental_vacuum
+            cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            # total_bytes, blob_count and last_modified (unix seconds) are
+            # kept by triggers; NULL until _reconcile_world_stats() fills
+            # them in for worlds from before they existed
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS worlds (
+                    id INTEGER PRIMARY KEY,
+                    compressed INTEGER DEFAULT 0,
+                    total_bytes INTEGER,
+                    blob_count INTEGER,
+                    last_modified INTEGER,
+                    revision INTEGER NOT NULL DEFAULT 0,
+                    pruned_revision INTEGER NOT NULL DEFAULT 0
+                )
+                """)
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS shortened_urls (id INTEGER PRIMARY KEY, slug TEXT, url TEXT)"
+            )
+            # One row per file of every world. compressed holds the codec id
+            # (CODEC_*), NULL for rows migrated from worlds that predate
+            # per-file compression. revision is the world revision it last
+            # changed in, 0 for rows from before revisions.
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    id INTEGER PRIMARY KEY,
+                    world_id INTEGER NOT NULL,
+                    path TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    compressed INTEGER DEFAULT 0,
+                    revision INTEGER NOT NULL DEFAULT 0
+                )
+                """)
+            # Paths removed from a world, and the revision that removed them
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS tombstones (
+                    world_id INTEGER NOT NULL,
+                    path TEXT NOT NULL,
+                    revision INTEGER NOT NULL,
+                    deleted_at INTEGER NOT NULL,
+                    PRIMARY KEY (world_id, path)
+                ) WITHOUT ROWID
+                """)
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_tombstones_world_revision ON tombstones (world_id, revision)"
+            )
+            # Revoked tokens, until they expire; seq lets processes read only new rows
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS revoked_tokens (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    token_id INTEGER NOT NULL,
+                    expires_at INTEGER NOT NULL
+                )
+                """
+            )
+            # Deleted worlds, for the other processes' registries; seq as above
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS deleted_worlds (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    world_id INTEGER NOT NULL,
+                    deleted_at INTEGER NOT NULL
+                )
+                """
+            )
+            # Progress of background jobs, shared by all processes
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS maintenance_state (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            cursor.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_entries_world_path ON entries (world_id, path)"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_entries_world_hash ON entries (world_id, hash)"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_entries_hash ON entries (hash)"
+            )
+            # Content-addressed store shared by all worlds. refcount is the
+            # number of entries using the blob, kept up to date by the triggers
+            # below; compressed is NULL for blobs that predate compression.
+            # verified is 1 once the server checked the blob hashes to its
+            # key, -1 if it doesn't; only verified blobs are shared with
+            # worlds that didn't upload them. dict_id is the zstd dictionary
+            # a zstd blob needs (0 for none), NULL until it was looked up.
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    hash TEXT PRIMARY KEY,
+                    refcount INTEGER NOT NULL DEFAULT 0,
+                    compressed INTEGER DEFAULT 0,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    verified INTEGER NOT NULL DEFAULT 0,
+                    dict_id INTEGER
+                ) WITHOUT ROWID
+                """)
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS entries_blob_ref_insert AFTER INSERT ON entries
+                BEGIN
+                    UPDATE blobs SET refcount = refcount + 1 WHERE hash = NEW.hash;
+                END
+                """)
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS entries_blob_ref_delete AFTER DELETE ON entries
+                BEGIN
+                    UPDATE blobs SET refcount = refcount - 1 WHERE hash = OLD.hash;
+                END
+                """)
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS entries_blob_ref_update AFTER UPDATE OF hash ON entries
+                WHEN OLD.hash != NEW.hash
+                BEGIN
+                    UPDATE blobs SET refcount = refcount - 1 WHERE hash = OLD.hash;
+                    UPDATE blobs SET refcount = refcount + 1 WHERE hash = NEW.hash;
+                END
+                """)
+            # zstd dictionaries, trained per world. Kept after the world is
+            # deleted for as long as shared blobs may still need them.
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS zstd_dictionaries (
+                    dict_id INTEGER PRIMARY KEY,
+                    world_id INTEGER NOT NULL,
+                    data BLOB NOT NULL
+                )
+                """)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[tuple[sqlite3.Connection, sqlite3.Cursor]]:
+        """
+        Like _db(), but everything in the block is one write on the writer
+        connection: it is committed (group-committed with whatever else was
+        written meanwhile) when this returns, and rolled back on error.
+        Nested use joins the outer one.
+        """
+        with self.writer.transaction() as conn:
+            cursor = conn.cursor()
+            try:
+                yield (conn, cursor)
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def _savepoint(self) -> Iterator[tuple[sqlite3.Connection, sqlite3.Cursor]]:
+        """
+        Part of the surrounding _transaction() that may fail on its own: an
+        error rolls back only what was done in the block, then propagates.
+        """
+        with self._db() as (conn, cursor):
+            cursor.execute("SAVEPOINT part")
+            try:
+                yield (conn, cursor)
+            except BaseException:
+                cursor.execute("ROLLBACK TO part")
+                cursor.execute("RELEASE part")
+                raise
+            cursor.execute("RELEASE part")
+
+    def _migrate_world_tables(self):
+        """
+        Moves rows from the old per-world `world_<id>` tables into `entries`.
+        Each world is copied and its table dropped in its own short
+        transaction, holding only that world's lock, so the database stays
+        usable the whole time and an interrupted run just resumes.
+        """
+        with self._db() as (conn, cursor):
+            cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name GLOB 'world_[0-9]*'"
+            )
+            legacy_tables = [row[0] for row in cursor.fetchall()]
+            cursor.execute("SELECT id FROM worlds")
+            world_ids = {row[0] for row in cursor.fetchall()}
+
+        if len(legacy_tables) == 0:
+            return
+
+        logger.info(f"Migrating {len(legacy_tables)} world tables to entries")
+
+        for table_name in legacy_tables:
+            world_id = self._parse_world_id(table_name[6:])
+            if world_id is None:
+                continue
+            try:
+                with self.world_locks.write(world_id):
+                    with self._transaction() as (conn, cursor):
+                        if world_id in world_ids:
+                            cursor.execute(f"PRAGMA table_info({table_name})")
+                            columns = {row[1] for row in cursor.fetchall()}
+                            compressed = (
+                                "compressed" if "compressed" in columns else "NULL"
+                            )
+                            cursor.execute(
+                                f"""
+                                INSERT OR IGNORE INTO entries (world_id, path, hash, compressed)
+                                SELECT ?, path, hash, {compressed} FROM {table_name}
+                                WHERE path IS NOT NULL AND hash IS NOT NULL
+                                """,
+                                (world_id,),
+                            )
+                            # the entries triggers stamped the world with the
+                            # migration time; _reconcile_world_stats fills its
+                            # stats in from the blobs instead
+                            cursor.execute(
+                                """
+                                UPDATE worlds
+                                SET total_bytes = NULL, blob_count = NULL, last_modified = NULL
+                                WHERE id = ?
+                                """,
+                                (world_id,),
+                            )
+                        else:
+                            # table of a world that was already deleted
+                            logger.info(f"[ DROP TABLE ] drop orphaned {table_name}")
+                        cursor.execute(f"DROP TABLE {table_name}")
+            except Exception as e:
+                logger.error(f"migrating {table_name} failed: {e}")
+
+        logger.info("World table migration complete")
+
+    def _migrate_world_folders(self):
+        """
+        Moves blobs from the old per-world objects/world_<id>/ folders into the
+        shared store, one world at a time under that world's lock. A blob that
+        is already in the store (uploaded by another world) is only linked and
+        the world's copy is dropped with the folder.
+        """
+        objects_dir = os.path.join(self.base_dir, "objects")
+        if not os.path.isdir(objects_dir):
+            return
+        folders = [name for name in os.listdir(objects_dir) if name.startswith("world_")]
+        if len(folders) == 0:
+            return
+
+        logger.info(f"Migrating {len(folders)} world folders to the blob store")
+
+        for folder_name in folders:
+            world_id = self._parse_world_id(folder_name[6:])
+            if world_id is None:
+                continue
+            folder_path = os.path.join(objects_dir, folder_name)
+            try:
+                with self.world_locks.write(world_id):
+                    for name in os.listdir(folder_path):
+                        hash = name[5:-4]
+                        if not (name.startswith("blob_") and name.endswith(".bin")):
+                            continue
+                        if not BLOB_HASH_PATTERN.match(hash):
+                            continue
+                        with self.blob_locks.write(hash):
+                            self._move_blob_to_store(
+                                world_id, hash, os.path.join(folder_path, name)
+                            )
+                    shutil.rmtree(folder_path)
+            except Exception as e:
+                logger.error(f"migrating {folder_name} failed: {e}")
+
+        logger.info("World folder migration complete")
+
+    def _move_blob_to_store(self, world_id: int, hash: str, source_path: str):
+        with self._transaction() as (conn, cursor):
+            cursor.execute(
+                "SELECT compressed FROM entries WHERE world_id = ? AND hash = ? LIMIT 1",
+                (world_id, hash),
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return  # not referenced, goes away with the folder
+
+            cursor.execute("SELECT compressed FROM blobs WHERE hash = ?", (hash,))
+            stored = cursor.fetchone()
+            if stored is not None and os.path.exists(self._blob_path(hash)):
+                cursor.execute(
+                    "UPDATE entries SET compressed = ? WHERE world_id = ? AND hash = ?",
+                    (stored[0], world_id, hash),
+                )
+                return
+
+            # entries inserted before the blob row existed weren't counted
+            cursor.execute(
+                """
+                INSERT INTO blobs (hash, refcount, compressed, size)
+                VALUES (?, (SELECT COUNT(*) FROM entries WHERE hash = ?), ?, ?)
+                ON CONFLICT (hash) DO UPDATE
+                SET refcount = excluded.refcount, compressed = excluded.compressed,
+                    size = excluded.size, verified = 0, dict_id = NULL
+                """,
+                (hash, hash, row[0], os.path.getsize(source_path)),
+            )
+            blob_path = self._blob_path(hash)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(source_path, blob_path)
 
     def _migrate_database(self):
         try:
-            conn, cursor = self._get_db()
-            cursor.execute("ALTER TABLE worlds ADD COLUMN compressed INTEGER DEFAULT 0")
-            conn.commit()
-            conn.close()
+            with self._db() as (conn, cursor):
+                for table, added_columns in ADDED_COLUMNS.items():
+                    cursor.execute(f"PRAGMA table_info({table})")
+                    columns = {row[1] for row in cursor.fetchall()}
+                    for column, definition in added_columns:
+                        if column not in columns:
+                            cursor.execute(
+                                f"ALTER TABLE {table} ADD COLUMN {column} {definition}"
+                            )
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_entries_world_revision ON entries (world_id, revision)"
+                )
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_blobs_dict_id ON blobs (dict_id)"
+                )
+                self._create_short_url_index(cursor)
+                self._create_world_stats_triggers(cursor)
+                self._create_revision_triggers(cursor)
         except Exception as e:
             logger.error(f"database migration failed: {e}")
 
+    def _create_short_url_index(self, cursor: sqlite3.Cursor):
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_shortened_urls_slug'"
+        )
+        if cursor.fetchone() is not None:
+            return
+        # slugs used to be checked then inserted, so racing creates could
+        # share one; lookups always found the oldest row, keep that one
+        cursor.execute(
+            """
+            DELETE FROM shortened_urls WHERE id NOT IN (
+                SELECT MIN(id) FROM shortened_urls GROUP BY slug
+            )
+            """
+        )
+        if cursor.rowcount > 0:
+            logger.info(f"[ DELETE ROW ] {cursor.rowcount} shadowed duplicate short URL slugs")
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_shortened_urls_slug ON shortened_urls (slug)"
+        )
+
+    def _create_world_stats_triggers(self, cursor: sqlite3.Cursor):
+        """
+        Keeps each world's total_bytes, blob_count and last_modified up to
+        date as its entries change. Blobs used by several paths of the world
+        count once, like on disk; a blob that changes size (rewritten with
+        another codec) updates every world using it.
+        """
+        now = "CAST(strftime('%s', 'now') AS INTEGER)"
+        # whether the world has no other entry with this blob
+        only_new = "NOT EXISTS (SELECT 1 FROM entries WHERE world_id = NEW.world_id AND hash = NEW.hash AND id != NEW.id)"
+        only_old = "NOT EXISTS (SELECT 1 FROM entries WHERE world_id = OLD.world_id AND hash = OLD.hash)"
+        size_new = "COALESCE((SELECT size FROM blobs WHERE hash = NEW.hash), 0)"
+        size_old = "COALESCE((SELECT size FROM blobs WHERE hash = OLD.hash), 0)"
+        add_new = f"""
+            UPDATE worlds SET
+                blob_count = blob_count + ({only_new}),
+                total_bytes = total_bytes + CASE WHEN {only_new} THEN {size_new} ELSE 0 END,
+                last_modified = {now}
+            WHERE id = NEW.world_id;
+        """
+        drop_old = f"""
+            UPDATE worlds SET
+                blob_count = blob_count - ({only_old}),
+                total_bytes = total_bytes - CASE WHEN {only_old} THEN {size_old} ELSE 0 END,
+                last_modified = {now}
+            WHERE id = OLD.world_id;
+        """
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS entries_world_stats_insert AFTER INSERT ON entries
+            BEGIN {add_new} END
+            """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS entries_world_stats_delete AFTER DELETE ON entries
+            BEGIN {drop_old} END
+            """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS entries_world_stats_update AFTER UPDATE OF hash ON entries
+            WHEN OLD.hash != NEW.hash
+            BEGIN {drop_old} {add_new} END
+            """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS blobs_world_stats_resize AFTER UPDATE OF size ON blobs
+            WHEN OLD.size != NEW.size
+            BEGIN
+                UPDATE worlds SET total_bytes = total_bytes + NEW.size - OLD.size
+                WHERE id IN (SELECT world_id FROM entries WHERE hash = NEW.hash);
+            END
+            """)
+
+    def _create_revision_triggers(self, cursor: sqlite3.Cursor):
+        """
+        Every change to a world's entries (including the codec of their
+        blob) bumps the world's revision. The
+        changed entry records the new revision, a removed path leaves a
+        tombstone with it, so /get_data?since= can return only the changes.
+        """
+        bump = "UPDATE worlds SET revision = revision + 1 WHERE id = {0}.world_id;"
+        revision = "COALESCE((SELECT revision FROM worlds WHERE id = {0}.world_id), 0)"
+        changed = f"""
+            {bump.format("NEW")}
+            UPDATE entries SET revision = {revision.format("NEW")} WHERE id = NEW.id;
+            DELETE FROM tombstones WHERE world_id = NEW.world_id AND path = NEW.path;
+        """
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS entries_revision_insert AFTER INSERT ON entries
+            BEGIN {changed} END
+            """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS entries_revision_update AFTER UPDATE OF hash ON entries
+            WHEN OLD.hash != NEW.hash
+            BEGIN {changed} END
+            """)
+        # the manifest says whether a blob downloads compressed, so a blob
+        # rewritten with another codec changes it too
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS entries_revision_recompress AFTER UPDATE OF compressed ON entries
+            WHEN OLD.hash = NEW.hash AND OLD.compressed IS NOT NEW.compressed
+            BEGIN {changed} END
+            """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS entries_revision_delete AFTER DELETE ON entries
+            BEGIN
+                {bump.format("OLD")}
+                INSERT OR REPLACE INTO tombstones (world_id, path, revision, deleted_at)
+                VALUES (
+                    OLD.world_id, OLD.path, {revision.format("OLD")},
+                    CAST(strftime('%s', 'now') AS INTEGER)
+                );
+            END
+            """)
+
+    def _prune_tombstones(self):
+        """
+        Drops tombstones older than TOMBSTONE_MAX_AGE_SECONDS. Their worlds
+        remember the newest revision dropped, since a client that synced
+        before it can't be sent a complete delta any more.
+        """
+        cutoff = int(time.time()) - TOMBSTONE_MAX_AGE_SECONDS
+        with self._transaction() as (conn, cursor):
+            cursor.execute(
+                """
+                UPDATE worlds SET pruned_revision = MAX(pruned_revision, (
+                    SELECT MAX(revision) FROM tombstones
+                    WHERE world_id = worlds.id AND deleted_at < ?
+                ))
+                WHERE id IN (SELECT world_id FROM tombstones WHERE deleted_at < ?)
+                """,
+                (cutoff, cutoff),
+            )
+            cursor.execute("DELETE FROM tombstones WHERE deleted_at < ?", (cutoff,))
+            if cursor.rowcount > 0:
+                logger.info(f"[ DELETE ROW ] pruned {cursor.rowcount} tombstones")
+
+    def _reconcile_world_stats(self, only_missing: bool = False):
+        """
+        Recomputes every world's total_bytes and blob_count from entries and
+        blobs and fixes the ones that drifted, then fills in last_modified
+        (from the blob files) for worlds from before it was tracked. With
+        only_missing, does nothing unless some world has no stats yet.
+        """
+        if only_missing:
+            with self._db() as (conn, cursor):
+                cursor.execute(
+                    "SELECT 1 FROM worlds WHERE total_bytes IS NULL OR last_modified IS NULL LIMIT 1"
+                )
+                if cursor.fetchone() is None:
+                    return
+
+        with self._transaction() as (conn, cursor):
+            cursor.execute(
+                """
+                SELECT e.world_id, COUNT(*), COALESCE(SUM(b.size), 0)
+                FROM (SELECT DISTINCT world_id, hash FROM entries) e
+                LEFT JOIN blobs b ON b.hash = e.hash
+                GROUP BY e.world_id
+                """
+            )
+            actual = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+            cursor.execute("SELECT id, blob_count, total_bytes FROM worlds")
+            drifted = [
+                (*actual.get(row[0], (0, 0)), row[0])
+                for row in cursor.fetchall()
+                if (row[1], row[2]) != actual.get(row[0], (0, 0))
+            ]
+            cursor.executemany(
+                "UPDATE worlds SET blob_count = ?, total_bytes = ? WHERE id = ?",
+                drifted,
+            )
+        if len(drifted) > 0:
+            logger.info(f"world stats reconciled for {len(drifted)} worlds")
+
+        # stat the blob files first, the writer isn't held for that
+        dates = []
+        with self._db() as (conn, cursor):
+            cursor.execute("SELECT id FROM worlds WHERE last_modified IS NULL")
+            world_ids = [row[0] for row in cursor.fetchall()]
+            for world_id in world_ids:
+                try:
+                    last_modified = self._query_last_modified_date_world(cursor, world_id)
+                except Exception as e:
+                    logger.error(f"Failed to query last modified date for: {world_id}: {e}")
+                    last_modified = datetime.now()
+                dates.append((int(last_modified.timestamp()), world_id))
+
+        with self._transaction() as (conn, cursor):
+            # another process may have recorded a change since
+            cursor.executemany(
+                "UPDATE worlds SET last_modified = ? WHERE id = ? AND last_modified IS NULL",
+                dates,
+            )
+
     def _load_double_compression_cache(self) -> dict[str, int] | None:
         cache_file_path = os.path.join(
             self.base_dir, "cache", "double_compression_cache.json"
@@ -472,10 +3123,10 @@ class App:
             json.dump(cache_data, f)
 
     def _detect_double_compression(self):
-        # loop through every file in objects
-        conn, cursor = self._get_db()
-        cursor.execute("SELECT * FROM worlds")
-        rows = cursor.fetchall()
+        # loop through every LZMA blob in the store
+        with self._db() as (conn, cursor):
+            cursor.execute("SELECT hash FROM blobs WHERE compressed = ?", (CODEC_LZMA,))
+            rows = cursor.fetchall()
 
         logger.info("Run double-compression detection")
 
@@ -483,145 +3134,197 @@ class App:
         new_compression_cache: dict[str, int] = {}
 
         for row in rows:
-            id = row[0]
-            table_name = f"world_{id}"
-            if self._does_table_exist(table_name) is False:
-                continue
+            hash = row[0]
             try:
-                cursor.execute(f"SELECT * FROM {table_name}")
-                files = cursor.fetchall()
-                for file in files:
-                    hash = file[2]
-                    # get file path
-                    file_path = os.path.join(
-                        self.base_dir, "objects", table_name, f"blob_{hash}.bin"
-                    )
-                    if os.path.exists(file_path) is False:
+                # get file path
+                file_path = self._blob_path(hash)
+                if os.path.exists(file_path) is False:
+                    continue
+                current_last_modified_time = self._get_last_modified_time_file_unix(
+                    file_path
+                )
+                new_compression_cache[file_path] = current_last_modified_time
+                if double_compression_cache.get(file_path) is not None:
+                    cached_last_modified_time = double_compression_cache[file_path]
+                    if current_last_modified_time == cached_last_modified_time:
+                        logger.info(f"Skipped double-compression check: {file_path}")
                         continue
-                    current_last_modified_time = self._get_last_modified_time_file_unix(
-                        file_path
-                    )
-                    new_compression_cache[file_path] = current_last_modified_time
-                    if double_compression_cache.get(file_path) is not None:
-                        cached_last_modified_time = double_compression_cache[file_path]
-                        if current_last_modified_time == cached_last_modified_time:
-                            logger.info(
-                                f"Skipped double-compression check: {file_path}"
-                            )
-                            continue
 
-                    # read
-                    with open(file_path, "rb") as f:
-                        file_data = f.read()
+                # read
+                with open(file_path, "rb") as f:
+                    file_data = f.read()
 
-                    # attempt first decompression
-                    try:
-                        decompressed_once = lzma.decompress(file_data)
-                    except lzma.LZMAError:
-                        continue  # file not compressed or corrupted, skip
+                # attempt first decompression
+                try:
+                    decompressed_once = lzma.decompress(file_data)
+                except lzma.LZMAError:
+                    continue  # file not compressed or corrupted, skip
 
-                    # attempt second decompression
-                    try:
-                        _ = lzma.decompress(decompressed_once)
-                    except lzma.LZMAError:
-                        logger.info(f"double-compression not detected for {file_path}")
-                        continue  # only single compression, skip
-                    else:
-                        # Double compression detected, fix by keeping only one layer
-                        logger.info(
-                            f"[FIX] Double compression detected for {file_path}"
-                        )
-                        # recompress once if you want to keep compressed storage
-                        fixed_data = decompressed_once
-                        with open(file_path, "wb") as f:
-                            f.write(fixed_data)
+                # attempt second decompression
+                try:
+                    _ = lzma.decompress(decompressed_once)
+                except lzma.LZMAError:
+                    logger.info(f"double-compression not detected for {file_path}")
+                    continue  # only single compression, skip
+                else:
+                    # Double compression detected, fix by keeping only one layer
+                    logger.info(f"[FIX] Double compression detected for {file_path}")
+                    with self.blob_locks.write(hash):
+                        self._rewrite_blob(hash, decompressed_once, CODEC_LZMA)
+                    new_compression_cache[file_path] = (
+                        self._get_last_modified_time_file_unix(file_path)
+                    )
 
-                        # update DB compressed flag to 1
+            except Exception as e:
+                logger.error(f"double-compression check failed: {e}")
+                continue
+
+        self._save_double_compression_cache(new_compression_cache)
+
+    def _verify_stored_blobs(self):
+        """
+        Checks the blobs stored while clients' hashes were taken on trust and
+        marks each as verified or not. Verified ones can be linked by any
+        world again, the others stay with the worlds that uploaded them.
+        """
+        with self._db() as (conn, cursor):
+            cursor.execute("SELECT hash FROM blobs WHERE verified = 0")
+            hashes = [row[0] for row in cursor.fetchall()]
+        if len(hashes) == 0:
+            return
+
+        logger.info(f"Verifying {len(hashes)} stored blobs")
+        mismatched = 0
+        for hash in hashes:
+            try:
+                with self.blob_locks.read(hash):
+                    with self._db() as (conn, cursor):
                         cursor.execute(
-                            f"UPDATE {table_name} SET compressed = 1 WHERE hash = ?",
+                            "SELECT compressed FROM blobs WHERE hash = ? AND verified = 0",
                             (hash,),
                         )
-
+                        row = cursor.fetchone()
+                    blob_path = self._blob_path(hash)
+                    if row is None or not os.path.exists(blob_path):
+                        continue
+                    verified = 1 if self._blob_hashes_to(hash, blob_path, row[0]) else -1
+                    with self._transaction() as (conn, cursor):
+                        cursor.execute(
+                            "UPDATE blobs SET verified = ? WHERE hash = ? AND verified = 0",
+                            (verified, hash),
+                        )
+                if verified == -1:
+                    mismatched += 1
+                    logger.warning(f"blob {hash} does not match its hash")
             except Exception as e:
-                logger.error(f"cannot add column: {e}")
-                continue
-        conn.close()
+                logger.error(f"verifying blob {hash} failed: {e}")
 
-        self._save_double_compression_cache(new_compression_cache)
+        logger.info(f"Blob verification complete, {mismatched} mismatched")
+
+    def _blob_hashes_to(self, hash: str, blob_path: str, codec: int | None) -> bool:
+        "Whether a stored blob, or what it decompresses to, has this SHA-1"
+        hash = hash.lower()
+        sha1 = hashlib.sha1()
+        with open(blob_path, "rb") as f:
+            while chunk := f.read(BLOB_CHUNK_SIZE):
+                sha1.update(chunk)
+        if sha1.hexdigest() == hash:
+            return True
+        return codec in self.codecs and self._content_hash(blob_path, codec) == hash
 
     def _migrate_per_file_compressions(self):
-        conn, cursor = self._get_db()
-        cursor.execute("SELECT * FROM worlds")
-        rows = cursor.fetchall()
+        # blobs migrated from worlds that had no compressed column
+        with self._db() as (conn, cursor):
+            cursor.execute("SELECT hash FROM blobs WHERE compressed IS NULL")
+            rows = cursor.fetchall()
 
         for row in rows:
-            id = row[0]
-            table_name = f"world_{id}"
-            if self._does_table_exist(table_name) is False:
-                continue
+            hash = row[0]
             try:
-                cursor.execute(
-                    f"ALTER TABLE {table_name} ADD COLUMN compressed INTEGER DEFAULT 0"
-                )
-
-                cursor.execute(f"SELECT * FROM {table_name}")
-                files = cursor.fetchall()
-                for file in files:
-                    hash = file[2]
-                    # get file path
-                    file_path = os.path.join(
-                        self.base_dir, "objects", table_name, f"blob_{hash}.bin"
-                    )
-                    if os.path.exists(file_path) is False:
-                        continue
+                # get file path
+                file_path = self._blob_path(hash)
+                if os.path.exists(file_path) is False:
+                    continue
 
+                with self.blob_locks.write(hash):
                     # read
                     with open(file_path, "rb") as f:
                         file_data = f.read()
 
                     # compress
-                    isCompressed, processedData = self._compress_file(file_data)
-
-                    logger.info(f"process: {file_path} compressed: {isCompressed}")
+                    codec, processedData = self._compress_file(file_data)
 
-                    # write
-                    with open(file_path, "wb") as f:
-                        f.write(processedData)
+                    logger.info(f"process: {file_path} codec: {codec}")
 
-                    cursor.execute(
-                        f"UPDATE {table_name} SET compressed = ? WHERE hash = ?",
-                        (isCompressed, hash),
-                    )
+                    self._rewrite_blob(hash, processedData, codec)
 
             except Exception as e:
-                logger.error(f"cannot add column: {e}")
+                logger.error(f"per-file compression migration failed: {e}")
                 continue
-        conn.close()
 
-    def _generate_unique_slug(self, cursor, length=5):
-        while True:
-            slug = generate_slug(length)
-            cursor.execute("SELECT 1 FROM shortened_urls WHERE slug=?", (slug,))
-            if not cursor.fetchone():
+    def _rewrite_blob(self, hash: str, data: bytes, codec: int):
+        """
+        Replaces a stored blob's bytes (same content, different encoding) and
+        its codec everywhere. Call with the blob's lock held.
+        """
+        blob_path = self._blob_path(hash)
+        temp_dir = self._upload_temp_dir()
+        os.makedirs(temp_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix=".upload_", dir=temp_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            dict_id = None
+            if codec == CODEC_ZSTD:
+                dict_id = zstd.get_frame_parameters(data[:18]).dict_id
+            with self._transaction() as (conn, cursor):
+                cursor.execute(
+                    "UPDATE blobs SET compressed = ?, size = ?, dict_id = ? WHERE hash = ?",
+                    (codec, len(data), dict_id, hash),
+                )
+                cursor.execute(
+                    "UPDATE entries SET compressed = ? WHERE hash = ?",
+                    (codec, hash),
+                )
+                os.replace(temp_path, blob_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _insert_short_url(self, url: str, length: int = SHORT_URL_SLUG_LENGTH) -> str:
+        "Stores url under a new random slug; the unique index settles collisions"
+        with self._transaction() as (conn, cursor):
+            for _attempt in range(10):
+                slug = generate_slug(length)
+                try:
+                    cursor.execute(
+                        "INSERT INTO shortened_urls (slug, url) VALUES (?, ?)", (slug, url)
+                    )
+                except sqlite3.IntegrityError:
+                    continue  # taken, only the statement was rolled back
                 return slug
+        raise RuntimeError("no free short URL slug found")
 
     def _find_redirect_url(self):
         slug_to_find = request.args.get("slug")
-
-        conn, cursor = self._get_db()
-
-        cursor.execute("SELECT url FROM shortened_urls WHERE slug = ?", (slug_to_find,))
-        row = cursor.fetchone()  # fetchone() returns None if no match
-
-        if row:
-            url = row[0]  # url is the first (and only) column selected
-            logger.info(f"URL for slug {slug_to_find}: {url}")
-            return jsonify(ok=True, message="URL found", url=url), 200
-        else:
-            logger.info(f"No URL found for slug {slug_to_find}")
+        if not slug_to_find:
             return jsonify(ok=False, message="No URL found"), 404
 
-        conn.close()
+        url = self.short_urls.get(slug_to_find)
+        if url is None:
+            with self._db() as (conn, cursor):
+                cursor.execute(
+                    "SELECT url FROM shortened_urls WHERE slug = ?", (slug_to_find,)
+                )
+                row = cursor.fetchone()  # fetchone() returns None if no match
+            if row is None:
+                logger.info(f"No URL found for slug {slug_to_find}")
+                return jsonify(ok=False, message="No URL found"), 404
+            url = row[0]
+            self.short_urls.put(slug_to_find, url)
+
+        logger.debug(f"URL for slug {slug_to_find}: {url}")
+        return jsonify(ok=True, message="URL found", url=url), 200
 
     def _create_redirect_url(self):
         data = request.get_json()
@@ -632,25 +3335,25 @@ class App:
         if not url:
             return jsonify(ok=False, message="Missing URL"), 400
 
-        username = data.get("username")
-        password = data.get("password")
-        if not username:
-            return jsonify(ok=False, message="Missing username"), 400
-        if not password:
-            return jsonify(ok=False, message="Missing password"), 400
-
-        if not self._verify_credentials(username, password):
-            return jsonify(ok=False, message="Invalid credentials"), 401
+        # a token from /api/login; raw credentials still work for older clients
+        token = data.get("token") or request.args.get("token")
+        if token:
+            if not self._is_token_valid(token):
+                return jsonify(ok=False, message="Invalid token"), 401
+        else:
+            username = data.get("username")
+            password = data.get("password")
+            if not username:
+                return jsonify(ok=False, message="Missing username"), 400
+            if not password:
+                return jsonify(ok=False, message="Missing password"), 400
 
-        # Now write to database, generate a random slug
+            error = self._verify_credentials(username, password)
+            if error is not None:
+                return error
 
-        conn, cursor = self._get_db()
-        slug = self._generate_unique_slug(cursor, length=7)
-        cursor.execute(
-            "INSERT INTO shortened_urls (slug, url) VALUES (?, ?)", (slug, url)
-        )
-        conn.commit()
-        conn.close()
+        slug = self._insert_short_url(url)
+        self.short_urls.put(slug, url)
 
         return jsonify(ok=True, message="URL created", url=f"/r?q={slug}&v2=true"), 200
 
@@ -661,16 +3364,21 @@ class App:
         if not token:
             return jsonify(ok=False, message="No token provided"), 400
 
-        if not self._is_token_valid(token):
+        payload = self._verified_token_payload(token)
+        if payload is None:
             return jsonify(ok=False, message="Invalid token"), 401
 
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        id = payload.get("id")
-
-        if id == None:
-            return jsonify(ok=False, message="Invalid token"), 401
-
-        self.revoked_tokens.add(id)
+        # kept until the token would have expired anyway
+        expires_at = int(payload.get("exp", time.time() + 365 * 24 * 3600))
+        with self._transaction() as (conn, cursor):
+            cursor.execute(
+                "DELETE FROM revoked_tokens WHERE expires_at <= ?", (int(time.time()),)
+            )
+            cursor.execute(
+                "INSERT INTO revoked_tokens (token_id, expires_at) VALUES (?, ?)",
+                (payload["id"], expires_at),
+            )
+        self.revoked_tokens.add(payload["id"], expires_at)
 
         return jsonify(ok=True, message="Token revoked"), 200
 
@@ -687,29 +3395,26 @@ class App:
             return jsonify(ok=False, message="Invalid token"), 401
 
         # Sanitize the world ID: allow only digits
-        if not world.isdigit():
+        world_id = self._parse_world_id(world)
+        if world_id is None:
             return jsonify(ok=False, message="Invalid world ID"), 400
 
-        world_path = os.path.join(self.base_dir, "objects", f"world_{world}")
-
-        # Ensure the path is within base_dir to prevent traversal
-        if not os.path.commonpath([self.base_dir, world_path]).startswith(
-            self.base_dir
-        ):
-            return jsonify(ok=False, message="Invalid world path"), 400
-
-        if not os.path.exists(world_path):
+        if not self._world_exists(world_id):
             return jsonify(ok=False, message="World not found"), 404
 
         try:
-            # Delete database entry first
-            conn, cursor = self._get_db()
-            cursor.execute("DELETE FROM worlds WHERE id = ?", (world,))
-            conn.commit()
-            conn.close()
-
-            # Recursively delete folder
-            shutil.rmtree(world_path)
+            with self.world_locks.write(world_id):
+                with self._transaction() as (conn, cursor):
+                    cursor.execute(
+                        "SELECT DISTINCT hash FROM entries WHERE world_id = ?",
+                        (world_id,),
+                    )
+                    hashes = [row[0] for row in cursor.fetchall()]
+                    self._delete_world_rows(cursor, world_id)
+                self.manifest_cache.discard(world_id)
+
+                # Blobs other worlds still use stay
+                self._collect_garbage_blobs(hashes)
         except Exception as e:
             logger.error("Deleting world failed: %s" % e)
             return jsonify(ok=False, message=f"Error deleting world: {e}"), 500
@@ -728,36 +3433,43 @@ class App:
 
         return token
 
-    def _is_token_valid(self, token: str):
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-            id = payload.get("id")
-            if id == None:
-                return False
-            if id in self.revoked_tokens:
-                return False
-            return True
-        except jwt.ExpiredSignatureError:
-            return False
-        except jwt.InvalidTokenError:
-            return False
-
-    def _query_size_of_folder(self, path: str):
-
-        total_size = 0
-
-        for name in os.listdir(path):
+    def _verified_token_payload(self, token: str) -> dict | None:
+        "The payload of a valid, unexpired and unrevoked token, else None"
+        payload = self.verified_tokens.get(token)
+        if payload is None:
+            try:
+                payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+            except jwt.InvalidTokenError:  # expired ones too
+                return None
+            if payload.get("id") is None:
+                return None
+            self.verified_tokens.put(token, payload)
+        if self.revoked_tokens.is_revoked(payload["id"]):
+            return None
+        return payload
 
-            child_path = os.path.join(path, name)
-            total_size += os.path.getsize(child_path)
+    def _is_token_valid(self, token: str):
+        return self._verified_token_payload(token) is not None
 
-        return total_size
+    def _load_token_revocations(self, after_seq: int) -> list[tuple[int, int, int]]:
+        with self._db() as (conn, cursor):
+            cursor.execute(
+                "SELECT seq, token_id, expires_at FROM revoked_tokens WHERE seq > ? ORDER BY seq",
+                (after_seq,),
+            )
+            return cursor.fetchall()
 
-    def _query_last_modified_date_folder(self, path: str):
+    def _query_last_modified_date_world(self, cursor: sqlite3.Cursor, world_id: int):
 
-        folder = Path(path)
+        cursor.execute(
+            "SELECT DISTINCT hash FROM entries WHERE world_id = ?", (world_id,)
+        )
 
-        latest_mtime = max(child.stat().st_mtime for child in folder.iterdir())
+        # a world without files was last modified when it was created, now at the latest
+        latest_mtime = max(
+            (os.path.getmtime(self._blob_path(row[0])) for row in cursor.fetchall()),
+            default=time.time(),
+        )
 
         return datetime.fromtimestamp(latest_mtime)
 
@@ -771,64 +3483,103 @@ class App:
             if not self._is_token_valid(token):
                 return jsonify(ok=False, message="Invalid token"), 401
 
-            conn, cursor = self._get_db()
-            cursor.execute("SELECT id FROM worlds")
-            result = cursor.fetchall()
-            conn.close()
-
             returnedData: list[WorldDataStatisticsItem] = []
 
-            for row in result:
-
-                id = row[0]
-                try:
-                    world_folder = os.path.join(self.base_dir, "objects", f"world_{id}")
+            # kept up to date by the entries triggers, see _create_world_stats_triggers
+            with self._db() as (conn, cursor):
+                cursor.execute(
+                    "SELECT id, total_bytes, blob_count, last_modified FROM worlds"
+                )
+                result = cursor.fetchall()
 
-                    total_size = self._query_size_of_folder(world_folder)
-                    last_modified_time = self._query_last_modified_date_folder(
-                        world_folder
-                    )
-                    last_modified_time_str = human_readable_time(last_modified_time)
-
-                    returnedData.append(
-                        {
-                            "id": id,
-                            "lastModifiedTime": last_modified_time_str,
-                            "size": total_size,
-                        }
+            for id, total_bytes, blob_count, last_modified in result:
+                last_modified_time_str = "Unknown"
+                if last_modified is not None:
+                    last_modified_time_str = human_readable_time(
+                        datetime.fromtimestamp(last_modified)
                     )
-                except Exception:
-                    logger.error(f"Failed to query details for: {id}")
 
-                    returnedData.append(
-                        {"id": id, "lastModifiedTime": "Unknown", "size": 0}
-                    )
+                returnedData.append(
+                    {
+                        "id": id,
+                        "lastModifiedTime": last_modified_time_str,
+                        "size": total_bytes or 0,
+                        "blobCount": blob_count or 0,
+                    }
+                )
 
             return jsonify(ok=True, data=returnedData), 200
         except Exception as e:
             logger.error(f"Error occurred: {e}")
             return jsonify(ok=False, message="Internal Server Error"), 500
 
+    def _client_address(self) -> str | None:
+        if CLIENT_ADDRESS_HEADER is not None:
+            address = request.headers.get(CLIENT_ADDRESS_HEADER)
+            if address:
+                return address
+        return request.remote_addr
+
+    def _process_credential_pool(self) -> ProcessPoolExecutor:
+        "The credential pool, a new one in a forked child: its parent's workers answer the parent"
+        if self.credential_pool_pid != os.getpid():
+            with process_start_lock:
+                if self.credential_pool_pid != os.getpid():
+                    self.credential_pool = self._new_credential_pool()
+                    self.credential_pool_pid = os.getpid()
+        return self.credential_pool
+
+    def _new_credential_pool(self) -> ProcessPoolExecutor:
+        pool = ProcessPoolExecutor(max_workers=CREDENTIAL_WORKERS)
+        # where processes are forked, this starts all the workers now, so the
+        # first pool forks before App starts any thread
+        pool.submit(int)
+        return pool
+
     def _verify_credentials(self, username: str, password: str):
-        isUsernameCorrect = False
-        isPasswordCorrect = False
+        """
+        Checks the admin credentials in the credential workers, rate limited
+        per client. Returns None if they're right, else the error response.
+        """
+        wait = self.credential_limiter.try_acquire(self._client_address())
+        if wait > 0:
+            logger.warning(f"Credential attempts rate limited for {self._client_address()}")
+            response = jsonify(ok=False, message="Too many attempts, try again later")
+            response.headers["Retry-After"] = str(math.ceil(wait))
+            return response, 429
+
+        if not self.credential_slots.acquire(blocking=False):
+            response = jsonify(ok=False, message="Server busy, try again later")
+            response.headers["Retry-After"] = "1"
+            return response, 503
 
         try:
-            ph.verify(ADMIN_USERNAME, username)
-            isUsernameCorrect = True
-        except argon2.exceptions.VerifyMismatchError:
-            logger.warning("Invalid credentials detected")
-            pass
+            pool = self._process_credential_pool()
+            future = pool.submit(verify_admin_credentials, username, password)
+        except BaseException:
+            self.credential_slots.release()
+            raise
+        # the slot is freed when the check is done, even if we stop waiting for it
+        future.add_done_callback(lambda _future: self.credential_slots.release())
+
         try:
-            ph.verify(ADMIN_HASHED_PASSWORD, password)
-            isPasswordCorrect = True
-        except argon2.exceptions.VerifyMismatchError:
-            logger.warning("Invalid credentials detected")
-            pass
+            is_valid = future.result(timeout=CREDENTIAL_TIMEOUT_SECONDS)
+        except BrokenProcessPool as e:
+            # a worker died (killed for memory?), the pool can't be used anymore
+            logger.error(f"Credential worker failed: {e}")
+            with self.credential_pool_lock:
+                if self.credential_pool is pool:
+                    self.credential_pool = self._new_credential_pool()
+            pool.shutdown(wait=False)
+            return jsonify(ok=False, message="Internal Server Error"), 500
+        except Exception as e:
+            logger.error(f"Credential check failed: {e}")
+            return jsonify(ok=False, message="Internal Server Error"), 500
 
-        if isUsernameCorrect == False or isPasswordCorrect == False:
-            return False
-        return True
+        if not is_valid:
+            logger.warning("Invalid credentials detected")
+            return jsonify(ok=False, message="Invalid credentials"), 401
+        return None
 
     def _login(self):
 
@@ -843,77 +3594,480 @@ class App:
         if not username or not password:
             return jsonify(ok=False, message="Missing username or password"), 400
 
-        if not self._verify_credentials(username, password):
-            logger.warning("Invalid credentials detected")
-            return jsonify(ok=False, message="Invalid credentials"), 401
+        error = self._verify_credentials(username, password)
+        if error is not None:
+            return error
 
         token = self._issue_jwt()
 
         return jsonify(ok=True, message="Login successful", data=token), 200
 
-    def _does_table_exist(self, name: str) -> bool:
-        conn, cursor = self._get_db()
-        cursor.execute(
-            """
-            SELECT name FROM sqlite_master 
-            WHERE type='table' AND name=?
-        """,
-            (name,),
-        )
-        result = cursor.fetchone()
-        conn.close()
-        return result is not None
+    @staticmethod
+    def _parse_world_id(world_id: str | int | None) -> int | None:
+        "World ids are plain integers; anything else can't name a world"
+        if isinstance(world_id, int):
+            return world_id
+        if world_id is None or not world_id.isdigit():
+            return None
+        return int(world_id)
+
+    def _load_world_registry(self):
+        with self._db() as (conn, cursor):
+            cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM deleted_worlds")
+            seq = cursor.fetchone()[0]
+            cursor.execute("SELECT id FROM worlds")
+            self.worlds.load((row[0] for row in cursor.fetchall()), seq)
+        logger.info(f"World registry loaded: {len(self.worlds)} worlds")
+
+    def _load_world_deletions(self, after_seq: int) -> list[tuple[int, int]]:
+        with self._db() as (conn, cursor):
+            cursor.execute(
+                "SELECT seq, world_id FROM deleted_worlds WHERE seq > ? ORDER BY seq",
+                (after_seq,),
+            )
+            return cursor.fetchall()
+
+    def _load_world_dictionary_ids(self) -> list[tuple[int, int]]:
+        with self._db() as (conn, cursor):
+            cursor.execute(
+                "SELECT world_id, dict_id FROM zstd_dictionaries ORDER BY rowid"
+            )
+            return cursor.fetchall()
+
+    def _load_zstd_dictionary(self, dict_id: int) -> bytes | None:
+        with self._db() as (conn, cursor):
+            cursor.execute(
+                "SELECT data FROM zstd_dictionaries WHERE dict_id = ?", (dict_id,)
+            )
+            row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    def _train_zstd_dictionaries(self):
+        """
+        Trains a zstd dictionary for every world that has enough small blobs
+        and none yet. World files are lots of small, similar chunks, which
+        compress much better against a dictionary built from their siblings.
+        Only new uploads use it; stored blobs keep their encoding.
+        """
+        with self._db() as (conn, cursor):
+            cursor.execute(
+                """
+                SELECT e.world_id FROM entries e JOIN blobs b ON b.hash = e.hash
+                WHERE b.size <= ? AND b.compressed IS NOT NULL
+                AND e.world_id NOT IN (SELECT world_id FROM zstd_dictionaries)
+                GROUP BY e.world_id HAVING COUNT(DISTINCT e.hash) >= ?
+                """,
+                (ZSTD_DICT_MAX_SAMPLE_SIZE, ZSTD_DICT_MIN_SAMPLES),
+            )
+            world_ids = [row[0] for row in cursor.fetchall()]
+
+        for world_id in world_ids:
+            try:
+                self._train_zstd_dictionary(world_id)
+            except Exception as e:
+                logger.error(f"training zstd dictionary for {world_id} failed: {e}")
+
+    def _train_zstd_dictionary(self, world_id: int):
+        with self._db() as (conn, cursor):
+            cursor.execute(
+                """
+                SELECT DISTINCT b.hash, b.compressed FROM entries e
+                JOIN blobs b ON b.hash = e.hash
+                WHERE e.world_id = ? AND b.size <= ? AND b.compressed IS NOT NULL
+                ORDER BY RANDOM() LIMIT ?
+                """,
+                (world_id, ZSTD_DICT_MAX_SAMPLE_SIZE, ZSTD_DICT_MAX_SAMPLES),
+            )
+            rows = cursor.fetchall()
+
+        samples: list[bytes] = []
+        for hash, codec in rows:
+            try:
+                with open(self._blob_path(hash), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue  # collected meanwhile
+            samples.append(self._decompress_file(data, codec))
+        if len(samples) < ZSTD_DICT_MIN_SAMPLES:
+            return
+
+        # ids below 32768 are reserved for registered dictionaries
+        dict_id = random.randint(32768, 2**31 - 1)
+        zdict = zstd.train_dictionary(
+            ZSTD_DICT_SIZE, samples, dict_id=dict_id, level=ZSTD_LEVEL
+        )
+        with self._transaction() as (conn, cursor):
+            cursor.execute(
+                "INSERT INTO zstd_dictionaries (dict_id, world_id, data) VALUES (?, ?, ?)",
+                (dict_id, world_id, zdict.as_bytes()),
+            )
+        self.zstd_dictionaries.set_world(world_id, dict_id)
+        logger.info(
+            f"trained zstd dictionary {dict_id} for {world_id} from {len(samples)} blobs"
+        )
+
+    def _world_exists(self, world_id: int | None) -> bool:
+        if world_id is None:
+            return False
+        if world_id in self.worlds:
+            return True
+
+        # Not known here, but another worker process may have created it since
+        # we loaded the registry. One primary key lookup, then it's cached
+        # until a deletion (in any process) shows up in the registry.
+        with self._db() as (conn, cursor):
+            cursor.execute("SELECT 1 FROM worlds WHERE id = ?", (world_id,))
+            if cursor.fetchone() is None:
+                return False
+        self.worlds.add(world_id)
+        return True
 
     def _on_get_server_world_data(self):
+        return self._send_manifest(include_compression=False)
+
+    def _on_get_world_manifest(self):
+        "/get_data and /api/world/compression_info in one round trip"
+        return self._send_manifest(include_compression=True)
+
+    def _send_manifest(self, include_compression: bool):
+        """
+        The world's manifest and its revision. With since=<revision> (one
+        this returned before), only the entries changed after it and the
+        paths removed after it; full says which of the two was sent, since a
+        delta isn't possible from revisions whose tombstones were pruned.
+        With include_compression, every entry also says whether it downloads
+        LZMA compressed (see compression_info).
+
+        The encoding is chosen by format= or Accept (see MANIFEST_FORMATS),
+        zstd or gzip transfer compression by Accept-Encoding. Full manifests
+        are streamed from the manifest cache. Deltas, and worlds too big for
+        the cache, are encoded as the rows come off the cursor into a spooled
+        temp file, which is streamed once the lock is released, so neither
+        memory nor the time the lock is held depend on how fast the client
+        reads.
+        """
         id = request.args.get("world")
         if id == None:
             return jsonify(ok=False, message="No world ID provided"), 400
 
-        table_name = f"world_{id}"
-        if not self._does_table_exist(table_name):
+        world_id = self._parse_world_id(id)
+        if not self._world_exists(world_id):
             return jsonify(ok=False, message="World not found"), 404
 
-        conn, cursor = self._get_db()
-        cursor.execute(f"SELECT * from {table_name}")
-        result = cursor.fetchall()
-        conn.close()
+        since = request.args.get("since")
+        if since is not None and not since.isdigit():
+            return jsonify(ok=False, message="Invalid revision"), 400
+
+        manifest_format = request.args.get("format")
+        if manifest_format is None:
+            mimetype = request.accept_mimetypes.best_match(
+                list(MANIFEST_FORMATS.values()), default=MANIFEST_FORMATS["json"]
+            )
+            manifest_format = next(
+                name for name, m in MANIFEST_FORMATS.items() if m == mimetype
+            )
+        if manifest_format not in MANIFEST_FORMATS:
+            return jsonify(ok=False, message="Unknown format"), 400
+        encode = MANIFEST_ENCODERS[manifest_format]
+
+        # only encodings named explicitly, "*" doesn't mean a client knows zstd
+        accepted = {
+            value.lower() for value, quality in request.accept_encodings if quality > 0
+        }
+        content_encoding = None
+        compressor = None
+        if "zstd" in accepted:
+            content_encoding = "zstd"
+            compressor = zstd.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        elif "gzip" in accepted:
+            content_encoding = "gzip"
+            compressor = zlib.compressobj(wbits=31)  # gzip container
+
+        with self._db() as (conn, cursor):
+            cursor.execute(
+                "SELECT revision, pruned_revision FROM worlds WHERE id = ?", (world_id,)
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return jsonify(ok=False, message="World not found"), 404
+        revision, pruned_revision = row
+
+        full = since is None or not (pruned_revision <= int(since) <= revision)
+        body = None
+        if full:
+            manifest = self._load_manifest(world_id)
+            if manifest is None:
+                return jsonify(ok=False, message="World not found"), 404
+            revision, rows = manifest
+            if rows is not None:
+                # the cached rows never change, no lock needed while sending
+                body = encode(revision, True, iter(rows), iter(()), include_compression)
+                if compressor is not None:
+                    body = self._compress_chunks(body, compressor)
+
+        if body is None:
+            body, size = self._spool_manifest(
+                world_id, None if full else int(since), encode, include_compression, compressor
+            )
+            if body is None:
+                return jsonify(ok=False, message="World not found"), 404
+            response = Response(
+                wrap_file(request.environ, body, BLOB_CHUNK_SIZE),
+                mimetype=MANIFEST_FORMATS[manifest_format],
+                direct_passthrough=True,
+            )
+            response.content_length = size
+        else:
+            response = Response(body, mimetype=MANIFEST_FORMATS[manifest_format])
 
-        returnedData = []
-        for row in result:
-            # By order: ID (int) Path (string) Hash (string)
-            id = row[0]
-            path = row[1]
-            hash = row[2]
-            returnedData.append({"id": id, "path": path, "hash": hash})
+        if content_encoding is not None:
+            response.headers["Content-Encoding"] = content_encoding
+        response.vary.update(("Accept", "Accept-Encoding"))
+        return response
 
-        return jsonify(ok=True, data=returnedData), 200
+    @staticmethod
+    def _compress_chunks(chunks: Iterable[bytes], compressor) -> Iterator[bytes]:
+        for chunk in chunks:
+            chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+        yield compressor.flush()
+
+    def _load_manifest(self, world_id: int) -> tuple[int, tuple | None] | None:
+        """
+        The world's current revision and manifest rows, from the manifest
+        cache when it has this revision, else read and cached. The rows are
+        None for worlds too big to cache. None if the world doesn't exist.
+        """
+        with self._db() as (conn, cursor):
+            cursor.execute("SELECT revision FROM worlds WHERE id = ?", (world_id,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        cached = self.manifest_cache.get(world_id, row[0])
+        if cached is not None:
+            return (cached[0], cached[1])
+
+        # writers hold the write lock, so revision and rows match
+        with self.world_locks.read(world_id):
+            with self._db() as (conn, cursor):
+                cursor.execute("SELECT revision FROM worlds WHERE id = ?", (world_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    return None
+                revision = row[0]
+                cursor.execute(
+                    "SELECT id, path, hash, compressed FROM entries WHERE world_id = ? ORDER BY id",
+                    (world_id,),
+                )
+                rows = []
+                size = 0
+                for entry in iter_rows(cursor):
+                    size += ManifestCache.row_size(entry[1], entry[2])
+                    if size > self.manifest_cache.max_world_bytes:
+                        rows = None
+                        break
+                    rows.append(entry)
+
+        if rows is not None:
+            rows = tuple(rows)
+        self.manifest_cache.put(world_id, revision, rows, size)
+        return (revision, rows)
+
+    def _spool_manifest(
+        self,
+        world_id: int,
+        since: int | None,
+        encode,
+        include_compression: bool,
+        compressor=None,
+    ):
+        """
+        Encodes the world's manifest (or with since, the changes after that
+        revision) from the database into a spooled temp file. Returns the
+        file, rewound, and its size, or (None, 0) if the world doesn't exist.
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=MANIFEST_SPOOL_SIZE)
+        try:
+            # writers hold the write lock, so revision and rows match
+            with self.world_locks.read(world_id):
+                with self._db() as (conn, cursor):
+                    cursor.execute("SELECT revision FROM worlds WHERE id = ?", (world_id,))
+                    row = cursor.fetchone()
+                    if row is None:
+                        spool.close()
+                        return (None, 0)
+                    revision = row[0]
+
+                    # a second cursor, so removed paths can stream after the entries
+                    removed_cursor = conn.cursor()
+                    try:
+                        if since is None:
+                            cursor.execute(
+                                """
+                                SELECT id, path, hash, compressed FROM entries
+                                WHERE world_id = ? ORDER BY id
+                                """,
+                                (world_id,),
+                            )
+                            removed = iter(())
+                        else:
+                            cursor.execute(
+                                """
+                                SELECT id, path, hash, compressed FROM entries
+                                WHERE world_id = ? AND revision > ? ORDER BY revision
+                                """,
+                                (world_id, since),
+                            )
+                            removed_cursor.execute(
+                                """
+                                SELECT path FROM tombstones
+                                WHERE world_id = ? AND revision > ? ORDER BY revision
+                                """,
+                                (world_id, since),
+                            )
+                            removed = iter_rows(removed_cursor)
+
+                        for chunk in encode(
+                            revision, since is None, iter_rows(cursor), removed, include_compression
+                        ):
+                            if compressor is not None:
+                                chunk = compressor.compress(chunk)
+                            spool.write(chunk)
+                    finally:
+                        removed_cursor.close()
+            if compressor is not None:
+                spool.write(compressor.flush())
+            size = spool.tell()
+            spool.seek(0)
+        except BaseException:
+            spool.close()
+            raise
+        return (spool, size)
 
     def _hash_bytes(self, b: bytes):
         sha1 = hashlib.sha1()
         sha1.update(b)
         return sha1.hexdigest()
 
-    def _compress_file(self, fileData: bytes) -> tuple[bool, bytes]:
-        "Returns if file was compressed (0), and the compressed/uncompressed data (1)"
+    def _choose_compression(
+        self,
+        path: str | None,
+        head: bytes,
+        whole_file: bool,
+        world_id: int | None = None,
+    ) -> tuple[str, float]:
+        """
+        Decides from the first bytes of a file (head), before any real work,
+        whether compressing it is worth it. whole_file says head is all of it.
+        Returns (decision, trial CPU seconds); the decisions are the ones
+        CompressionStats counts.
+        """
+        reason = looks_compressed(path, head)
+        if reason is not None:
+            return (reason, 0.0)
+
+        sample = head[:COMPRESSION_ENTROPY_SAMPLE_SIZE]
+        # too few bytes for a meaningful estimate below this
+        if len(sample) == COMPRESSION_ENTROPY_SAMPLE_SIZE:
+            if byte_entropy(sample) >= COMPRESSION_MAX_ENTROPY:
+                return ("entropy", 0.0)
+
+        if whole_file:
+            # a trial would cost as much as the real thing
+            return ("full", 0.0)
+
+        started = time.thread_time()
+        trial = head[:COMPRESSION_TRIAL_SIZE]
+        compressor = self.codecs[UPLOAD_CODEC].compressor(
+            world_id, level=COMPRESSION_FAST_LEVEL
+        )
+        ratio = len(compressor.compress(trial) + compressor.flush()) / len(trial)
+        trial_cpu = time.thread_time() - started
+
+        if ratio >= COMPRESSION_TRIAL_SKIP_RATIO:
+            return ("trial", trial_cpu)
+        if ratio >= COMPRESSION_TRIAL_FAST_RATIO:
+            return ("fast", trial_cpu)
+        return ("full", trial_cpu)
+
+    def _compressor_for(self, decision: str, world_id: int | None = None):
+        "UPLOAD_CODEC compressor for a _choose_compression() decision, None for skips"
+        if decision in CompressionStats.SKIPS:
+            return None
+        level = COMPRESSION_FAST_LEVEL if decision == "fast" else None
+        return self.codecs[UPLOAD_CODEC].compressor(world_id, level=level)
+
+    def _compress_file(
+        self, fileData: bytes, path: str | None = None
+    ) -> tuple[int, bytes]:
+        "Returns the codec used (0), and the compressed/uncompressed data (1)"
 
-        compressedData = lzma.compress(fileData)
+        decision, trial_cpu = self._choose_compression(
+            path, fileData[:BLOB_CHUNK_SIZE], len(fileData) <= BLOB_CHUNK_SIZE
+        )
+        compressor = self._compressor_for(decision)
+        if compressor is None:
+            logger.info("Compression skipped: %s", decision, extra=LOG_SAMPLED)
+            self.compression_stats.record(
+                decision, len(fileData), trial_cpu_seconds=trial_cpu
+            )
+            return (CODEC_NONE, fileData)
+
+        started = time.thread_time()
+        compressedData = compressor.compress(fileData) + compressor.flush()
+        cpu_seconds = time.thread_time() - started
 
         compressionRatio = 1
         if len(fileData) != 0:
             compressionRatio = len(compressedData) / len(fileData)
+        self._record_compression_metrics(cpu_seconds, compressionRatio)
 
+        self.compression_stats.record(
+            decision, len(fileData), cpu_seconds, trial_cpu, kept=compressionRatio < 1
+        )
         if compressionRatio >= 1:
             # not worth to compress
             logger.info(
-                f"Compression ratio: {compressionRatio} -- compression reversed"
+                "Compression ratio: %s -- compression reversed",
+                compressionRatio,
+                extra=LOG_SAMPLED,
             )
-            return (False, fileData)
+            return (CODEC_NONE, fileData)
         else:
-            logger.info(f"Compression ratio: {compressionRatio} -- compression applied")
-            return (True, compressedData)
+            logger.info(
+                "Compression ratio: %s -- compression applied",
+                compressionRatio,
+                extra=LOG_SAMPLED,
+            )
+            return (UPLOAD_CODEC, compressedData)
+
+    def _decompress_file(self, fileData: bytes, codec: int):
+        if codec == CODEC_NONE:
+            return fileData
+        with self.metrics.time("worldsync_decompress_seconds", codec=codec):
+            return self.codecs[codec].decompress(fileData)
+
+    def _record_compression_metrics(self, cpu_seconds: float, ratio: float):
+        self.metrics.observe("worldsync_compress_seconds", cpu_seconds, codec=UPLOAD_CODEC)
+        self.metrics.observe(
+            "worldsync_compression_ratio", ratio, codec=UPLOAD_CODEC
+        )
 
-    def _decompress_file(self, fileData: bytes):
-        return lzma.decompress(fileData)
+    def _timed_chunks(self, chunks: Iterator[bytes], metric: str, **labels) -> Iterator[bytes]:
+        "Passes the chunks through, timing only what makes them, not the client"
+        elapsed = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                chunk = next(chunks, None)
+                elapsed += time.perf_counter() - started
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            chunks.close()
+            self.metrics.observe(metric, elapsed, **labels)
 
     def _on_download_file(self):
         world_id = request.args.get("world")
@@ -925,86 +4079,254 @@ class App:
         if world_id == None or hash == None:
             return jsonify(ok=False, message="No world ID or hash provided"), 400
 
-        folder_name = f"world_{world_id}"
-        path = os.path.join(self.base_dir, "objects", folder_name, f"blob_{hash}.bin")
-
-        if not os.path.exists(path):
-            return jsonify(ok=False, message="File not found"), 404
-        table_name = f"world_{world_id}"
-        if self._does_table_exist(table_name) is False:
+        world_id = self._parse_world_id(world_id)
+        if not self._world_exists(world_id):
             return jsonify(ok=False, message="World not found"), 404
-        try:
-            logger.info("wait for lock release (wait deferred tasks finished)")
-            self.worlds_lock.acquire()
-            # Find it in the database
-            conn, cursor = self._get_db()
-            try:
-                # get row
-                cursor.execute(f"SELECT * FROM {table_name} WHERE hash = ?", (hash,))
-                row = cursor.fetchone()
-                if row == None:
-                    self.worlds_lock.release()
-                    conn.close()
-                    return jsonify(ok=False, message="File not found")
-            except Exception as e:
-                logger.error("Download failed: %s" % e)
-                raise Exception(e)
-            finally:
-                conn.close()
-
-            # Read compressed data
-            with open(path, "rb") as f:
-                compressed_data = f.read()
-
-            isCompressed = row[3]
-            decompressed_data = compressed_data
-            if client_supports_compression is False:
-                logger.info("old client -- compression unsupported")
-                if isCompressed == 1:
-                    logger.info("decompress")
-                    decompressed_data = self._decompress_file(compressed_data)
-                else:
-                    logger.info(f"don't decompress: isCompressed = {isCompressed}")
-            else:
-                logger.info("new client -- compression supported")
 
-            # Wrap in BytesIO so Flask can send it as a file
-            file_stream = io.BytesIO(decompressed_data)
+        if not BLOB_HASH_PATTERN.match(hash):
+            return jsonify(ok=False, message="Invalid hash"), 400
 
-            # Optionally, give the downloaded file a name
-            filename = "blob.bin"
+        path = self._blob_path(hash)
 
-            return send_file(
-                file_stream,
-                as_attachment=True,
-                download_name=filename,
-                mimetype="application/octet-stream",
-            )
+        try:
+            logger.debug("wait for world read lock (wait deferred tasks finished)")
+            with self.world_locks.read(world_id):
+                # Find it in the database
+                with self._db() as (conn, cursor):
+                    cursor.execute(
+                        """
+                        SELECT entries.compressed, COALESCE(blobs.verified, 0)
+                        FROM entries LEFT JOIN blobs ON blobs.hash = entries.hash
+                        WHERE entries.world_id = ? AND entries.hash = ? LIMIT 1
+                        """,
+                        (world_id, hash),
+                    )
+                    row = cursor.fetchone()
+                if row == None:
+                    return jsonify(ok=False, message="File not found"), 404
+
+                # The world's entry keeps the blob alive while we hold the lock.
+                # Once open, the blob can be replaced or removed without
+                # affecting this download, so the lock isn't held while sending
+                # (see _send_blob_file for X-Sendfile)
+                blob_file = open(path, "rb")
+        except FileNotFoundError:
+            return jsonify(ok=False, message="File not found"), 404
         except Exception as e:
             logger.error(f"failed to send download: {e}")
             return jsonify(ok=False, message="Internal Server Error"), 500
+
+        codec, verified = row
+        if codec == CODEC_LZMA and client_supports_compression is False:
+            logger.debug("old client -- compression unsupported, decompress")
+            return self._send_decompressed_blob(blob_file, codec, hash, verified == 1)
+        if codec in self.codecs and codec != CODEC_LZMA:
+            # clients only understand LZMA, other codecs never leave the server
+            if client_supports_compression:
+                return self._send_transcoded_blob(blob_file, codec, hash, verified == 1)
+            return self._send_decompressed_blob(blob_file, codec, hash, verified == 1)
+
+        # Blobs are content-addressed, so the hash is a strong validator.
+        # Compressed bytes are a different representation of the same content.
+        etag = f"{hash}.xz" if codec == CODEC_LZMA else hash
+        return self._send_blob_file(blob_file, path, etag=etag)
+
+    def _send_blob_file(self, blob_file, path: str, etag: str):
+        """
+        Serves a blob straight from disk, with If-None-Match and Range support.
+        With X-Sendfile the front-end server opens the blob by path, so that
+        is only used while the path still is the file opened under the lock;
+        a blob replaced or collected since is sent from the open file.
+        """
+        if self.app.config["USE_X_SENDFILE"] and self._is_same_file(blob_file, path):
+            blob_file.close()
+            try:
+                return send_file(
+                    path,
+                    as_attachment=True,
+                    download_name="blob.bin",
+                    mimetype="application/octet-stream",
+                    etag=etag,
+                    conditional=True,
+                )
+            except FileNotFoundError:
+                # collected right after the check
+                return jsonify(ok=False, message="File not found"), 404
+
+        size = os.fstat(blob_file.fileno()).st_size
+        response = Response(
+            wrap_file(request.environ, blob_file, BLOB_CHUNK_SIZE),
+            mimetype="application/octet-stream",
+            direct_passthrough=True,
+        )
+        response.content_length = size
+        response.headers.set("Content-Disposition", "attachment", filename="blob.bin")
+        response.set_etag(etag)
+        try:
+            return response.make_conditional(
+                request.environ, accept_ranges=True, complete_length=size
+            )
+        except Exception:
+            blob_file.close()
+            raise
+
+    @staticmethod
+    def _is_same_file(blob_file, path: str) -> bool:
+        try:
+            return os.path.samestat(os.fstat(blob_file.fileno()), os.stat(path))
+        except FileNotFoundError:
+            return False
+
+    def _send_decompressed_blob(
+        self, blob_file, codec: int, hash: str, verified: bool = True
+    ):
+        """
+        Serves a compressed blob decompressed. Cached payloads are sent from
+        memory (with Range support); otherwise the blob streams through an
+        incremental decompressor, whose length isn't known up front so
+        there's no Range support, and is cached if it turns out small enough
+        and verified (the cache is shared by all worlds).
+        If-None-Match works either way.
+        """
+        cached = self.download_cache.get(hash)
+        if cached is not None:
+            blob_file.close()
+            return self._send_cached_payload(cached, hash)
+
+        chunks = self._timed_chunks(
+            self.codecs[codec].iter_decompress(blob_file),
+            "worldsync_decompress_seconds",
+            codec=codec,
+        )
+        if (
+            verified
+            and os.fstat(blob_file.fileno()).st_size <= self.download_cache.max_blob_bytes
+        ):
+            # never bigger than decompressed, so it may fit
+            chunks = self._cache_chunks(self.download_cache, hash, chunks)
+        return self._send_streamed_payload(chunks, blob_file, hash)
+
+    def _send_transcoded_blob(self, blob_file, codec: int, hash: str, verified: bool):
+        """
+        Serves a compressed blob as LZMA, like _send_decompressed_blob but
+        with transcode_cache. Verified blobs small enough to be cached are
+        transcoded at TRANSCODE_LZMA_PRESET, so each is only transcoded once
+        while it stays cached; bigger ones at TRANSCODE_LZMA_STREAM_PRESET.
+        """
+        etag = f"{hash}.xz"
+        cached = self.transcode_cache.get(hash)
+        if cached is not None:
+            blob_file.close()
+            self.metrics.inc("worldsync_download_transcodes_total", outcome="cached")
+            return self._send_cached_payload(cached, etag)
+
+        cacheable = (
+            verified
+            and os.fstat(blob_file.fileno()).st_size <= self.transcode_cache.max_blob_bytes
+        )
+        preset = TRANSCODE_LZMA_PRESET if cacheable else TRANSCODE_LZMA_STREAM_PRESET
+        self.metrics.inc(
+            "worldsync_download_transcodes_total",
+            outcome="cacheable" if cacheable else "streamed",
+        )
+        chunks = self._timed_chunks(
+            self._iter_transcoded(blob_file, codec, preset),
+            "worldsync_transcode_seconds",
+            preset=preset,
+        )
+        if cacheable:
+            chunks = self._cache_chunks(self.transcode_cache, hash, chunks)
+        return self._send_streamed_payload(chunks, blob_file, etag)
+
+    def _iter_transcoded(self, blob_file, codec: int, preset: int) -> Iterator[bytes]:
+        compressor = self.codecs[CODEC_LZMA].compressor(level=preset)
+        chunks = self.codecs[codec].iter_decompress(blob_file)
+        try:
+            for data in chunks:
+                compressed = compressor.compress(data)
+                if compressed:
+                    yield compressed
+            yield compressor.flush()
         finally:
-            logger.info("release worlds lock")
-            self.worlds_lock.release()
+            chunks.close()
+
+    def _send_cached_payload(self, data: bytes, etag: str):
+        response = Response(data, mimetype="application/octet-stream")
+        response.headers.set("Content-Disposition", "attachment", filename="blob.bin")
+        response.set_etag(etag)
+        return response.make_conditional(
+            request.environ, accept_ranges=True, complete_length=len(data)
+        )
 
-    def _get_world_files_compression_info(self):
-        world_id = request.args.get("world")
+    def _send_streamed_payload(self, chunks: Iterator[bytes], blob_file, etag: str):
+        response = Response(
+            chunks,
+            mimetype="application/octet-stream",
+            direct_passthrough=True,
+        )
+        response.headers.set("Content-Disposition", "attachment", filename="blob.bin")
+        response.headers["Accept-Ranges"] = "none"
+        response.set_etag(etag)
+        response.make_conditional(request.environ)
+        if response.status_code == 304:
+            # the generator never started, so it won't close the file itself
+            blob_file.close()
+        return response
+
+    def _cache_chunks(
+        self, cache: DecompressedBlobCache, hash: str, chunks: Iterator[bytes]
+    ) -> Iterator[bytes]:
+        "Passes the chunks through, and caches the whole payload once it's all sent"
+        kept = []
+        size = 0
+        for chunk in chunks:
+            yield chunk
+            if kept is not None:
+                size += len(chunk)
+                if size > cache.max_blob_bytes:
+                    kept = None
+                else:
+                    kept.append(chunk)
+        if kept is not None:
+            cache.put(hash, b"".join(kept))
+
+    def _get_compression_stats(self):
+        "What the compression heuristics decided and how the download cache did, in this process"
+        token = request.args.get("token")
+        if token == None:
+            return jsonify(ok=False, message="No token provided"), 400
+
+        if not self._is_token_valid(token):
+            return jsonify(ok=False, message="Invalid token"), 401
 
-        table_name = f"world_{world_id}"
-        if self._does_table_exist(table_name) is False:
+        data = self.compression_stats.snapshot()
+        data["download_cache"] = self.download_cache.snapshot()
+        data["transcode_cache"] = self.transcode_cache.snapshot()
+        return jsonify(ok=True, data=data, message="OK"), 200
+
+    def _get_world_files_compression_info(self):
+        world_id = self._parse_world_id(request.args.get("world"))
+        if not self._world_exists(world_id):
             return jsonify(ok=False, message="World not found"), 404
 
-        conn, cursor = self._get_db()
-        cursor.execute(f"SELECT * FROM {table_name}")
+        manifest = self._load_manifest(world_id)
+        if manifest is None:
+            return jsonify(ok=False, message="World not found"), 404
+        rows = manifest[1]
+        if rows is None:
+            # too big for the cache
+            with self._db() as (conn, cursor):
+                cursor.execute(
+                    "SELECT id, path, hash, compressed FROM entries WHERE world_id = ?",
+                    (world_id,),
+                )
+                rows = cursor.fetchall()
 
-        rows = cursor.fetchall()
         compression_info_dict: dict[str, bool] = {}
-
-        for row in rows:
-            hash = row[2]
-            compressed = row[3]
-            compression_info_dict[hash] = True if compressed else False
-        conn.close()
+        for _id, _path, hash, codec in rows:
+            # whether a client_supports_compression download is LZMA;
+            # other codecs are decompressed for the client
+            compression_info_dict[hash] = codec in LZMA_DOWNLOAD_CODECS
 
         return jsonify(ok=True, data=compression_info_dict, message="OK"), 200
 
@@ -1026,54 +4348,412 @@ class App:
         if file.filename == "":
             return jsonify(ok=False, message="No file provided"), 400
 
-        if self._does_table_exist(f"world_{worldid}") is False:
+        world_id = self._parse_world_id(worldid)
+        if not self._world_exists(world_id):
+            return jsonify(ok=False, message="World not found"), 404
+
+        if client_provided_hash is not None:
+            if not BLOB_HASH_PATTERN.match(client_provided_hash):
+                return jsonify(ok=False, message="Invalid hash"), 400
+            # blobs are keyed by the lowercase hex SHA-1, whatever case clients send
+            client_provided_hash = client_provided_hash.lower()
+
+        try:
+            if client_provided_hash is not None:
+                # Already stored: only the path needs to point at it, the body is never read
+                with self.world_locks.write(world_id):
+                    with self.blob_locks.write(client_provided_hash):
+                        stored_compressed = self._find_stored_blob(
+                            client_provided_hash, world_id
+                        )
+                        if stored_compressed is not None:
+                            logger.debug(
+                                "blob already stored, skip upload: %s", client_provided_hash
+                            )
+                            replaced_hash = self._upsert_entry(
+                                world_id, treepath, client_provided_hash, stored_compressed
+                            )
+                    if stored_compressed is not None:
+                        self._collect_garbage_blobs([replaced_hash])
+                        return None
+        except WorldNotFoundError:
             return jsonify(ok=False, message="World not found"), 404
+
+        try:
+            # Hashing and compression happen outside the lock, into a temp file
+            file_hash, codec, temp_path = self._ingest_upload(
+                file,
+                self._upload_temp_dir(),
+                world_id,
+                client_compressed=client_compressed,
+                client_is_compressed=client_is_compressed,
+                client_provided_hash=client_provided_hash,
+                path=treepath,
+            )
+        except HashMismatchError as e:
+            logger.warning(f"file insert rejected: {e}")
+            return jsonify(ok=False, message="Hash does not match the file"), 400
+        except Exception as e:
+            logger.error(f"file insert failed: {e}")
+            raise RuntimeError(f"File Insert Failed: {e}")
+
         try:
-            logger.info("wait for lock release (wait deferred tasks finished)")
-            self.worlds_lock.acquire()
-            table_name = f"world_{worldid}"
-            file_data: bytes = file.read()
-            logger.info(f"Received: {len(file_data)} bytes from the client")
+            logger.debug("wait for world write lock (wait deferred tasks finished)")
+            with self.world_locks.write(world_id):
+                with self.blob_locks.write(file_hash):
+                    replaced_hash = self._store_blob(
+                        world_id, treepath, file_hash, codec, temp_path
+                    )
+                self._collect_garbage_blobs([replaced_hash])
+        except WorldNotFoundError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return jsonify(ok=False, message="World not found"), 404
+        except Exception as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            logger.error(f"file insert failed: {e}")
+            raise RuntimeError(f"File Insert Failed: {e}")
+
+    def _store_blob(
+        self, world_id: int, path: str, hash: str, codec: int, temp_path: str
+    ) -> str | None:
+        """
+        Moves an ingested upload into the store, unless a verified blob is
+        already there, and points the path at it. Ingested uploads are
+        verified, so one replaces an unverified blob with the same hash for
+        every world using it. Call with the world and blob locks held.
+        Returns the hash the path pointed at before, if it changed.
+        """
+        stored_compressed = self._find_stored_blob(hash)
+        if stored_compressed is not None:
+            # same content arrived meanwhile (or the client sent no hash)
+            os.remove(temp_path)
+            return self._upsert_entry(world_id, path, hash, stored_compressed)
+
+        size = os.path.getsize(temp_path)
+        dict_id = self._zstd_dict_id(temp_path) if codec == CODEC_ZSTD else None
+        with self._transaction() as (conn, cursor):
+            cursor.execute(
+                """
+                INSERT INTO blobs (hash, compressed, size, verified, dict_id)
+                VALUES (?, ?, ?, 1, ?)
+                ON CONFLICT (hash) DO UPDATE
+                SET compressed = excluded.compressed, size = excluded.size,
+                    verified = 1, dict_id = excluded.dict_id
+                """,
+                (hash, codec, size, dict_id),
+            )
+            cursor.execute(
+                "UPDATE entries SET compressed = ? WHERE hash = ? AND compressed IS NOT ?",
+                (codec, hash, codec),
+            )
+            replaced_hash = self._upsert_entry(world_id, path, hash, codec)
+
+            # Atomic, so a concurrent download sees the old or the new blob
+            blob_path = self._blob_path(hash)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(temp_path, blob_path)
+        self.metrics.inc("worldsync_bytes_stored_total", size, codec=codec)
+        return replaced_hash
+
+    def _upsert_entry(
+        self, world_id: int, path: str, hash: str, codec: int | None
+    ) -> str | None:
+        """
+        Points path at hash. Returns the hash it pointed at before, if
+        different. Raises WorldNotFoundError if the world is gone.
+        """
+        with self._transaction() as (conn, cursor):
+            cursor.execute(
+                "SELECT hash FROM entries WHERE world_id = ? AND path = ?",
+                (world_id, path),
+            )
+            row = cursor.fetchone()
+            # the world may have been deleted by another process since it was checked
+            cursor.execute(
+                """
+                INSERT INTO entries (world_id, path, hash, compressed)
+                SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM worlds WHERE id = ?)
+                ON CONFLICT (world_id, path) DO UPDATE
+                SET hash = excluded.hash, compressed = excluded.compressed
+                """,
+                (world_id, path, hash, codec, world_id),
+            )
+            if cursor.rowcount == 0:
+                self.worlds.discard(world_id)
+                raise WorldNotFoundError(f"world {world_id} no longer exists")
+        if row is None or row[0] == hash:
+            return None
+        return row[0]
 
-            file_hash = client_provided_hash
-            if client_provided_hash == None:
-                file_hash = self._hash_bytes(file_data)
+    @staticmethod
+    def _zstd_dict_id(blob_path: str) -> int:
+        "The dictionary a zstd blob's frame header names, 0 for none"
+        with open(blob_path, "rb") as f:
+            return zstd.get_frame_parameters(f.read(18)).dict_id  # longest frame header
+
+    def _find_stored_blob(self, hash: str, world_id: int | None = None):
+        """
+        Returns the codec of the stored blob with this hash, or None if the
+        store doesn't have it. Unverified blobs only count for a world that
+        already uses them. Call with the blob's lock held.
+        """
+        with self._db() as (conn, cursor):
+            cursor.execute(
+                """
+                SELECT compressed FROM blobs
+                WHERE hash = ? AND (verified = 1 OR EXISTS (
+                    SELECT 1 FROM entries WHERE world_id = ? AND hash = blobs.hash
+                ))
+                """,
+                (hash, world_id),
+            )
+            row = cursor.fetchone()
+        if row is None or not os.path.exists(self._blob_path(hash)):
+            return None
+        return row[0]
 
-            # if client is compressing, trust client with compression data
+    def _blob_path(self, hash: str) -> str:
+        "objects/ab/cd/abcd..., so no directory ends up with millions of files"
+        return os.path.join(self.base_dir, "objects", hash[0:2], hash[2:4], hash)
 
-            is_compressed = False
-            compressed_file_data = file_data
+    def _upload_temp_dir(self) -> str:
+        return os.path.join(self.base_dir, "objects", "tmp")
 
-            if client_compressed is False:
-                logger.info("old client -- does not support compression")
-                is_compressed, compressed_file_data = self._compress_file(file_data)
+    def _collect_garbage_blobs(self, hashes: list[str | None] | None = None):
+        """
+        Deletes blobs no entry references any more, either the given ones or
+        (with None) every such blob. The refcount is checked again under the
+        blobs' locks, since an upload may have started using one meanwhile.
+        Rows go GC_BATCH_SIZE at a time, one transaction each, and the files
+        are only unlinked once it committed.
+        """
+        if hashes is not None:
+            hashes = [hash for hash in hashes if hash is not None]
+            if len(hashes) == 0:
+                return
+
+        with self._db() as (conn, cursor):
+            if hashes is None:
+                cursor.execute("SELECT hash FROM blobs WHERE refcount <= 0")
             else:
-                logger.info("new client -- supports compression")
-                is_compressed = client_is_compressed
-                compressed_file_data = file_data
+                cursor.execute(
+                    """
+                    SELECT hash FROM blobs
+                    WHERE refcount <= 0 AND hash IN (SELECT value FROM json_each(?))
+                    """,
+                    (json.dumps(hashes),),
+                )
+            # sorted, so the locks are always taken in the same order
+            candidates = sorted(row[0] for row in cursor.fetchall())
+
+        for start in range(0, len(candidates), GC_BATCH_SIZE):
+            batch = candidates[start : start + GC_BATCH_SIZE]
+            with ExitStack() as blob_locks:
+                for hash in batch:
+                    blob_locks.enter_context(self.blob_locks.write(hash))
+                with self._transaction() as (conn, cursor):
+                    cursor.execute(
+                        """
+                        SELECT hash FROM blobs
+                        WHERE refcount <= 0 AND hash IN (SELECT value FROM json_each(?))
+                        """,
+                        (json.dumps(batch),),
+                    )
+                    deleted = [row[0] for row in cursor.fetchall()]
+                    cursor.execute(
+                        """
+                        DELETE FROM blobs
+                        WHERE refcount <= 0 AND hash IN (SELECT value FROM json_each(?))
+                        """,
+                        (json.dumps(batch),),
+                    )
+                for hash in deleted:
+                    try:
+                        os.remove(self._blob_path(hash))
+                    except FileNotFoundError:
+                        logger.info(f"Warn: file not found: {self._blob_path(hash)}")
+
+    def _on_upload_precheck(self):
+        """
+        Takes {"world": id, "hashes": [...]} and returns the hashes the server
+        doesn't have yet, so clients only upload those.
+        """
+        data = request.get_json(silent=True)
+        if not data:
+            return jsonify(ok=False, message="Missing JSON body"), 400
+
+        world_id = self._parse_world_id(str(data.get("world", "")))
+        if not self._world_exists(world_id):
+            return jsonify(ok=False, message="World not found"), 404
+
+        hashes = data.get("hashes")
+        if not isinstance(hashes, list) or not all(isinstance(h, str) for h in hashes):
+            return jsonify(ok=False, message="hashes must be a list of strings"), 400
+        if len(hashes) > MAX_PRECHECK_HASHES:
+            return jsonify(ok=False, message="Too many hashes"), 400
 
-            conn, cursor = self._get_db()
+        stored = self._stored_hashes([hash.lower() for hash in hashes], world_id)
+        missing = [hash for hash in dict.fromkeys(hashes) if hash.lower() not in stored]
+        return jsonify(ok=True, message="OK", data={"missing": missing}), 200
+
+    def _stored_hashes(self, hashes: list[str], world_id: int) -> set[str]:
+        """
+        Which of the hashes the store has. Any world's verified blobs count,
+        the store is shared; unverified ones only if this world uses them.
+        """
+        with self._db() as (conn, cursor):
             cursor.execute(
-                f"INSERT OR REPLACE INTO {table_name} (path, hash, compressed) VALUES (?, ?, ?)",
-                (treepath, file_hash, is_compressed),
+                """
+                SELECT hash FROM blobs
+                WHERE hash IN (SELECT value FROM json_each(?)) AND (verified = 1 OR EXISTS (
+                    SELECT 1 FROM entries WHERE world_id = ? AND hash = blobs.hash
+                ))
+                """,
+                (json.dumps(hashes), world_id),
             )
+            known = [row[0] for row in cursor.fetchall()]
+        return {hash for hash in known if os.path.exists(self._blob_path(hash))}
 
-            # Create directory (absolute)
-            objects_dir = os.path.join(self.base_dir, "objects", table_name)
-            os.makedirs(objects_dir, exist_ok=True)
+    def _ingest_upload(
+        self,
+        file: FileStorage,
+        temp_dir: str,
+        world_id: int | None = None,
+        client_compressed: bool = False,
+        client_is_compressed: bool = False,
+        client_provided_hash: str | None = None,
+        path: str | None = None,
+    ) -> tuple[str, int, str]:
+        """
+        Streams an upload into a temp file in temp_dir, BLOB_CHUNK_SIZE at
+        a time, updating the SHA-1 and (for old clients) the UPLOAD_CODEC
+        compressor, with the world's dictionary, as it goes, so memory use
+        doesn't depend on the file size. Whether to compress at all is
+        decided from the first chunk (see _choose_compression).
+        A client_provided_hash must be the SHA-1 of the bytes sent or, for
+        a client-compressed file, of what they decompress to; otherwise
+        HashMismatchError is raised.
+        Returns (hash, codec, temp file path).
+        """
+        os.makedirs(temp_dir, exist_ok=True)
+        stream = file.stream
+        sha1 = hashlib.sha1()
+        chunk = stream.read(BLOB_CHUNK_SIZE)
+
+        # if client is compressing, trust client with compression data
+        compressor = None
+        decision = None
+        trial_cpu = 0.0
+        if client_compressed is False:
+            logger.debug("old client -- does not support compression")
+            decision, trial_cpu = self._choose_compression(
+                path, chunk, len(chunk) < BLOB_CHUNK_SIZE, world_id
+            )
+            compressor = self._compressor_for(decision, world_id)
+            if compressor is None:
+                logger.info("Compression skipped: %s", decision, extra=LOG_SAMPLED)
+        else:
+            logger.debug("new client -- supports compression")
 
-            blob_path = os.path.join(objects_dir, f"blob_{file_hash}.bin")
-            with open(blob_path, "wb") as f:
-                f.write(compressed_file_data)
+        fd, temp_path = tempfile.mkstemp(prefix=".upload_", dir=temp_dir)
+        try:
+            received_size = 0
+            stored_size = 0
+            cpu_seconds = 0.0
+            with os.fdopen(fd, "wb") as out:
+                while chunk:
+                    received_size += len(chunk)
+                    sha1.update(chunk)
+                    if compressor is not None:
+                        started = time.thread_time()
+                        chunk = compressor.compress(chunk)
+                        cpu_seconds += time.thread_time() - started
+                    stored_size += len(chunk)
+                    out.write(chunk)
+                    chunk = stream.read(BLOB_CHUNK_SIZE)
+                if compressor is not None:
+                    started = time.thread_time()
+                    tail = compressor.flush()
+                    cpu_seconds += time.thread_time() - started
+                    stored_size += len(tail)
+                    out.write(tail)
+            logger.debug("Received: %d bytes from the client", received_size)
+
+            file_hash = sha1.hexdigest()
+            if client_provided_hash is not None:
+                self._check_client_hash(
+                    client_provided_hash,
+                    file_hash,
+                    temp_path if client_compressed and client_is_compressed else None,
+                )
+                file_hash = client_provided_hash.lower()
+            if compressor is None:
+                if decision is not None:
+                    self.compression_stats.record(
+                        decision, received_size, trial_cpu_seconds=trial_cpu
+                    )
+                    return (file_hash, CODEC_NONE, temp_path)
+                codec = CODEC_LZMA if client_is_compressed else CODEC_NONE
+                return (file_hash, codec, temp_path)
 
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            logger.error(f"file insert failed: {e}")
-            raise RuntimeError(f"File Insert Failed: {e}")
-        finally:
-            logger.info("release worlds lock")
-            self.worlds_lock.release()
+            compressionRatio = 1
+            if received_size != 0:
+                compressionRatio = stored_size / received_size
+            self._record_compression_metrics(cpu_seconds, compressionRatio)
+
+            self.compression_stats.record(
+                decision, received_size, cpu_seconds, trial_cpu, kept=compressionRatio < 1
+            )
+            if compressionRatio < 1:
+                logger.info(
+                    "Compression ratio: %s -- compression applied",
+                    compressionRatio,
+                    extra=LOG_SAMPLED,
+                )
+                return (file_hash, UPLOAD_CODEC, temp_path)
+
+            # not worth to compress: store the original bytes instead
+            logger.info(
+                "Compression ratio: %s -- compression reversed",
+                compressionRatio,
+                extra=LOG_SAMPLED,
+            )
+            stream.seek(0)
+            with open(temp_path, "wb") as out:
+                shutil.copyfileobj(stream, out, BLOB_CHUNK_SIZE)
+            return (file_hash, CODEC_NONE, temp_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _check_client_hash(
+        self, client_hash: str, received_hash: str, lzma_path: str | None
+    ):
+        """
+        Raises HashMismatchError unless client_hash is the SHA-1 of the
+        received bytes or, with lzma_path (the received file, LZMA compressed
+        by the client), of what that decompresses to.
+        """
+        client_hash = client_hash.lower()
+        if client_hash == received_hash:
+            return
+        if lzma_path is not None:
+            if self._content_hash(lzma_path, CODEC_LZMA) == client_hash:
+                return
+        raise HashMismatchError(f"upload does not hash to {client_hash}")
+
+    def _content_hash(self, blob_path: str, codec: int) -> str | None:
+        "SHA-1 of what a compressed file decompresses to, None if it doesn't"
+        sha1 = hashlib.sha1()
+        try:
+            for data in self.codecs[codec].iter_decompress(open(blob_path, "rb")):
+                sha1.update(data)
+        except (lzma.LZMAError, zstd.ZstdError, EOFError):
+            return None
+        return sha1.hexdigest()
 
     def _on_upload_data(self):
         if "file" not in request.files:
@@ -1087,7 +4767,7 @@ class App:
         client_is_compressed = request.form.get("client_is_compressed") == "true"
         client_provided_hash = request.form.get("client_provided_hash")
 
-        self._insert_file(
+        error = self._insert_file(
             file,
             treepath,
             worldid,
@@ -1097,10 +4777,17 @@ class App:
                 client_provided_hash if client_provided_hash != "" else None
             ),
         )
+        if error is not None:
+            return error
 
         return jsonify(ok=True, message="Uploaded"), 200
 
     def _on_upload_data_batched(self):
+        """
+        Uploads many files at once. They are hashed and compressed in parallel
+        on the upload pool, then all stored in one transaction. Each file
+        succeeds or fails on its own; data has a result for every file.
+        """
         files = request.files.getlist("files")
         paths = request.form.getlist("paths")
         client_hashes = request.form.getlist("client_hashes")
@@ -1112,108 +4799,243 @@ class App:
         if not files or len(files) != len(paths):
             return jsonify(ok=False, message="Mismatched files and paths"), 400
 
-        client_hashes_list: list[str] | list[None] = client_hashes
+        if worldid is None:
+            return jsonify(ok=False, message="No world ID provided"), 400
+
+        world_id = self._parse_world_id(worldid)
+        if not self._world_exists(world_id):
+            return jsonify(ok=False, message="World not found"), 404
 
         if not client_is_compressed:
-            client_is_compressed = ["false"] * len(files)
-            client_hashes_list = [None] * len(files)
-
-        for file, treepath, is_compressed, client_hash in zip(
-            files, paths, client_is_compressed, client_hashes_list
+            client_is_compressed = []
+            client_hashes = []
+        # values left out at the end mean uncompressed and no hash
+        client_is_compressed += ["false"] * (len(files) - len(client_is_compressed))
+        client_hashes += [""] * (len(files) - len(client_hashes))
+        client_hashes = [hash.lower() for hash in client_hashes]
+
+        results: list[BatchUploadResult] = [
+            {"path": path, "ok": False, "message": ""} for path in paths
+        ]
+        stored = self._stored_hashes([hash for hash in client_hashes if hash], world_id)
+        linked: dict[int, str] = {}  # file index -> hash of a blob already stored
+        pending = {}  # file index -> future of _ingest_upload
+        for i, (file, treepath, is_compressed, client_hash) in enumerate(
+            zip(files, paths, client_is_compressed, client_hashes)
         ):
-            logger.info(f"upload tree path: {treepath}")
-            self._insert_file(
-                file,
-                treepath,
-                worldid,
-                client_compressed=client_compressed,
-                client_is_compressed=is_compressed == "true",
-                client_provided_hash=client_hash,
-            )
+            logger.debug("upload tree path: %s", treepath)
+            client_hash = client_hash or None
+            if file.filename == "":
+                results[i]["message"] = "No file provided"
+            elif client_hash is not None and not BLOB_HASH_PATTERN.match(client_hash):
+                results[i]["message"] = "Invalid hash"
+            elif client_hash in stored:
+                logger.debug("blob already stored, skip upload: %s", client_hash)
+                linked[i] = client_hash
+            else:
+                pending[i] = self.upload_executor.submit(
+                    self._ingest_upload,
+                    file,
+                    self._upload_temp_dir(),
+                    world_id,
+                    client_compressed=client_compressed,
+                    client_is_compressed=is_compressed == "true",
+                    client_provided_hash=client_hash,
+                    path=treepath,
+                )
 
-        return jsonify(ok=True, message="Uploaded"), 200
+        ingested: dict[int, tuple[str, int, str]] = {}  # index -> hash, codec, temp path
+        for i, future in pending.items():
+            try:
+                ingested[i] = future.result()
+            except HashMismatchError as e:
+                logger.warning(f"file insert rejected: {e}")
+                results[i]["message"] = "Hash does not match the file"
+            except Exception as e:
+                logger.error(f"file insert failed: {e}")
+                results[i]["message"] = f"File Insert Failed: {e}"
 
-    def _remove_entry(self, table_name: str, file_path: str):
-        conn, cursor = self._get_db()
-        cursor.execute(f"""SELECT * FROM {table_name} WHERE path = ?""", (file_path,))
-        row = cursor.fetchone()
-        if row == None:
-            conn.close()
-            return jsonify(ok=False, message="File not found"), 404
+        try:
+            self._store_batch(world_id, paths, linked, ingested, results)
+        except WorldNotFoundError:
+            return jsonify(ok=False, message="World not found"), 404
+        finally:
+            for _hash, _codec, temp_path in ingested.values():
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
 
-        id, path, hash = row
-        cursor.execute(f"""DELETE FROM {table_name} WHERE id = ?""", (id,))
+        if all(result["ok"] for result in results):
+            return jsonify(ok=True, message="Uploaded", data=results), 200
+        return jsonify(ok=False, message="Some files failed to upload", data=results), 207
 
-        # Check if anyone else having the same hash
-        cursor.execute(f"""SELECT * FROM {table_name} WHERE hash = ?""", (hash,))
-        if cursor.fetchone() == None:
-            blob_path = os.path.join(
-                self.base_dir, "objects", table_name, f"blob_{hash}.bin"
+    def _store_batch(
+        self,
+        world_id: int,
+        paths: list[str],
+        linked: dict[int, str],
+        ingested: dict[int, tuple[str, int, str]],
+        results: list[BatchUploadResult],
+    ):
+        """
+        Points every path of a batch at its blob in one transaction, moving
+        ingested uploads into the store. A file that fails only rolls back
+        its own rows and gets its message in results. Raises
+        WorldNotFoundError, storing nothing, if the world is gone.
+        """
+        # sorted, so two batches sharing blobs always lock them in the same order
+        hashes = sorted(
+            set(linked.values()) | {hash for hash, _codec, _temp in ingested.values()}
+        )
+        stored: list[int] = []
+        replaced_hashes: list[str | None] = []
+        try:
+            logger.debug("wait for world write lock (wait deferred tasks finished)")
+            with self.world_locks.write(world_id):
+                with ExitStack() as blob_locks:
+                    for hash in hashes:
+                        blob_locks.enter_context(self.blob_locks.write(hash))
+                    with self._transaction() as (conn, cursor):
+                        cursor.execute("SELECT 1 FROM worlds WHERE id = ?", (world_id,))
+                        if cursor.fetchone() is None:
+                            self.worlds.discard(world_id)
+                            raise WorldNotFoundError(f"world {world_id} no longer exists")
+                        for i in sorted(linked.keys() | ingested.keys()):
+                            try:
+                                with self._savepoint():
+                                    replaced_hashes.append(
+                                        self._store_batch_file(
+                                            world_id, paths[i], linked.get(i), ingested.get(i)
+                                        )
+                                    )
+                            except Exception as e:
+                                logger.error(f"file insert failed: {e}")
+                                results[i]["message"] = f"File Insert Failed: {e}"
+                                continue
+                            stored.append(i)
+                # every path is committed, results can't change any more
+                for i in stored:
+                    results[i]["ok"] = True
+                    results[i]["message"] = "Uploaded"
+                self._collect_garbage_blobs(replaced_hashes)
+        except WorldNotFoundError:
+            raise
+        except Exception as e:
+            logger.error(f"batch insert failed: {e}")
+            for i in stored:
+                if not results[i]["ok"]:
+                    results[i]["message"] = f"File Insert Failed: {e}"
+
+    def _store_batch_file(
+        self,
+        world_id: int,
+        path: str,
+        linked_hash: str | None,
+        ingested: tuple[str, int, str] | None,
+    ) -> str | None:
+        if ingested is not None:
+            hash, codec, temp_path = ingested
+            return self._store_blob(world_id, path, hash, codec, temp_path)
+
+        # checked before the locks were taken, it may have been collected since
+        stored_compressed = self._find_stored_blob(linked_hash, world_id)
+        if stored_compressed is None:
+            raise RuntimeError("blob is no longer stored, upload it again")
+        return self._upsert_entry(world_id, path, linked_hash, stored_compressed)
+
+    def _remove_entries(self, world_id: int, paths: list[str]) -> set[str]:
+        """
+        Removes the world's entries for all paths in one transaction, then
+        collects the blobs no world uses any more. Call with the world's
+        write lock held. Returns the paths that existed.
+        """
+        paths_json = json.dumps(paths)
+        with self._transaction() as (conn, cursor):
+            cursor.execute(
+                """
+                SELECT path, hash FROM entries
+                WHERE world_id = ? AND path IN (SELECT value FROM json_each(?))
+                """,
+                (world_id, paths_json),
+            )
+            rows = cursor.fetchall()
+            if len(rows) == 0:
+                return set()
+            # the trigger drops the blobs' refcounts
+            cursor.execute(
+                """
+                DELETE FROM entries
+                WHERE world_id = ? AND path IN (SELECT value FROM json_each(?))
+                """,
+                (world_id, paths_json),
             )
-            if os.path.exists(blob_path):
-                os.remove(blob_path)
-            else:
-                logger.info(f"Warn: file not found: {blob_path}")
-        else:
-            logger.info("dbg: Another entry still using this blob")
 
-        conn.commit()
-        conn.close()
+        # Deleted only if no entry in any world still uses them
+        self._collect_garbage_blobs(list({row[1] for row in rows}))
+        return {row[0] for row in rows}
 
     def _on_remove_data_batched(self):
 
         paths = request.form.getlist("paths")
         worldid = request.form.get("world")
 
+        if worldid is None:
+            return jsonify(ok=False, message="No world ID provided"), 400
+
         if not paths:
             return jsonify(ok=False, message="No paths provided"), 400
 
-        table_name = f"world_{worldid}"
+        world_id = self._parse_world_id(worldid)
+        if not self._world_exists(world_id):
+            return jsonify(ok=False, message="World not found"), 404
 
-        for path in paths:
-            self._remove_entry(table_name, path)
+        with self.world_locks.write(world_id):
+            removed = self._remove_entries(world_id, paths)
 
-        return jsonify(ok=True, message="Files deleted"), 200
+        missing = [path for path in dict.fromkeys(paths) if path not in removed]
+        return (
+            jsonify(
+                ok=True,
+                message="Files deleted",
+                data={"removed": len(removed), "missing": missing},
+            ),
+            200,
+        )
 
     def _on_remove_data(self):
         id = request.args.get("world")
         if id == None:
             return jsonify(ok=False, message="No world ID provided"), 400
 
-        table_name = f"world_{id}"
-        if not self._does_table_exist(table_name):
+        world_id = self._parse_world_id(id)
+        if not self._world_exists(world_id):
             return jsonify(ok=False, message="World not found"), 404
 
         file_path = request.args.get("path")
         if file_path == None:
             return jsonify(ok=False, message="No path provided"), 400
 
-        self._remove_entry(table_name, file_path)
+        with self.world_locks.write(world_id):
+            removed = self._remove_entries(world_id, [file_path])
+
+        if len(removed) == 0:
+            return jsonify(ok=False, message="File not found"), 404
 
         return jsonify(ok=True, message="File deleted"), 200
 
     def _create_world_storage(self):
         logger.info("Creating new world storage entry in DB")
 
-        conn, cursor = self._get_db()
-        cursor.execute(
-            "INSERT INTO worlds (id) VALUES (?)", (random.randint(1000000, 9999999),)
-        )
-        new_world_id = cursor.lastrowid
-        conn.commit()
-
-        table_name = f"world_{new_world_id}"
-        cursor.execute(f"""
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                id INTEGER PRIMARY KEY,
-                path STRING UNIQUE,
-                hash STRING,
-                compressed INTEGER DEFAULT 0
+        with self._transaction() as (conn, cursor):
+            cursor.execute(
+                """
+                INSERT INTO worlds (id, total_bytes, blob_count, last_modified)
+                VALUES (?, 0, 0, ?)
+                """,
+                (random.randint(1000000, 9999999), int(time.time())),
             )
-            """)
+            new_world_id = cursor.lastrowid
 
-        conn.commit()
-        conn.close()
+        self.worlds.add(new_world_id)
 
         logger.info("Entry successfully created")
         return new_world_id
@@ -1227,8 +5049,7 @@ class App:
         if id == None:
             return jsonify(ok=False, message="World Id not provided"), 400
 
-        table_name = f"world_{id}"
-        if not self._does_table_exist(table_name):
+        if not self._world_exists(self._parse_world_id(id)):
             return jsonify(ok=False, message="World not found"), 404
 
         return jsonify(ok=True, message="World found"), 200
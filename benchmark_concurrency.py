@@ -0,0 +1,75 @@
+"""
+Lock contention benchmark: the old single worlds_lock vs per-world
+reader/writer locks. Every simulated request spends IO_SECONDS inside its
+critical section (disk read/write), 90% of requests are downloads and the
+rest uploads, spread over WORLDS worlds.
+
+Usage: python benchmark_concurrency.py
+"""
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from app import KeyedRWLock, ReadWriteLock
+
+WORLDS = 16
+REQUESTS_PER_CLIENT = 200
+IO_SECONDS = 0.002
+DOWNLOAD_RATIO = 0.9
+CLIENT_COUNTS = [1, 2, 4, 8, 16, 32]
+
+
+class GlobalLock:
+    "What App used before: one mutex for every world and every request"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def read(self, _key):
+        with self._lock:
+            yield
+
+    @contextmanager
+    def write(self, _key):
+        with self._lock:
+            yield
+
+
+def run(locks, clients: int) -> float:
+    def client(seed: int):
+        rng = random.Random(seed)
+        for _ in range(REQUESTS_PER_CLIENT):
+            world = rng.randrange(WORLDS)
+            if rng.random() < DOWNLOAD_RATIO:
+                with locks.read(world):
+                    time.sleep(IO_SECONDS)
+            else:
+                with locks.write(world):
+                    time.sleep(IO_SECONDS)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    return clients * REQUESTS_PER_CLIENT / elapsed
+
+
+def main():
+    print(f"{'clients':>8} {'global lock req/s':>18} {'per-world req/s':>16} {'speedup':>8}")
+    for clients in CLIENT_COUNTS:
+        global_rps = run(GlobalLock(), clients)
+        keyed_rps = run(KeyedRWLock(gate=ReadWriteLock()), clients)
+        print(
+            f"{clients:>8} {global_rps:>18.0f} {keyed_rps:>16.0f} {keyed_rps / global_rps:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as application  # noqa: E402
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    "Builds App instances on one data directory, like the server's processes"
+    apps = []
+
+    def make():
+        instance = application.App(base_dir=str(tmp_path))
+        apps.append(instance)
+        return instance
+
+    yield make
+    for instance in apps:
+        instance.credential_pool.shutdown()
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def world(app):
+    "A new world's id"
+    return app.app.test_client().post("/create").json["data"]
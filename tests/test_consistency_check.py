@@ -0,0 +1,103 @@
+import hashlib
+import io
+import os
+import shutil
+
+from werkzeug.datastructures import FileStorage
+
+import app as application
+
+
+def upload(app, world, path, data):
+    response = app.app.test_client().post(
+        "/upload",
+        data={"file": (io.BytesIO(data), "f"), "path": path, "world": str(world)},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200
+    return hashlib.sha1(data).hexdigest()
+
+
+def run_cycle(app):
+    while not app._check_consistency_tick(application.CONSISTENCY_CHECK_SHARDS_PER_TICK):
+        pass
+
+
+def blob_row_count(app, hash):
+    with app._db() as (conn, cursor):
+        cursor.execute("SELECT COUNT(*) FROM blobs WHERE hash = ?", (hash,))
+        return cursor.fetchone()[0]
+
+
+def entry_count(app, hash):
+    with app._db() as (conn, cursor):
+        cursor.execute("SELECT COUNT(*) FROM entries WHERE hash = ?", (hash,))
+        return cursor.fetchone()[0]
+
+
+def write_orphan(app, data):
+    hash = hashlib.sha1(data).hexdigest()
+    blob_path = app._blob_path(hash)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    with open(blob_path, "wb") as f:
+        f.write(data)
+    return hash, blob_path
+
+
+def test_shards_are_listed_from_the_database(app, world):
+    hashes = {upload(app, world, f"f{i}", f"data {i}".encode()) for i in range(5)}
+    shutil.rmtree(os.path.join(app.base_dir, "objects"))
+
+    assert app._blob_shards() == sorted({hash[:2] for hash in hashes})
+
+
+def test_missing_shard_drops_its_rows_and_entries(app, world):
+    hash = upload(app, world, "a", b"gone with its shard")
+    kept = upload(app, world, "b", b"still here")
+    if kept[:2] == hash[:2]:
+        kept = upload(app, world, "b", b"still here, in another shard")
+    shutil.rmtree(os.path.join(app.base_dir, "objects", hash[:2]))
+
+    run_cycle(app)
+
+    assert blob_row_count(app, hash) == 0
+    assert entry_count(app, hash) == 0
+    assert blob_row_count(app, kept) == 1
+    assert entry_count(app, kept) == 1
+
+
+def test_old_orphan_file_is_deleted(app, world, monkeypatch):
+    upload(app, world, "a", b"referenced")
+    hash, blob_path = write_orphan(app, b"orphan")
+    monkeypatch.setattr(application, "ORPHAN_BLOB_GRACE_SECONDS", 0)
+
+    assert app._check_blob_shard(hash[:2]) is None
+    assert not os.path.exists(blob_path)
+
+
+def test_new_orphan_file_is_kept(app, world):
+    hash, blob_path = write_orphan(app, b"maybe still being stored")
+
+    assert app._check_blob_shard(hash[:2]) is None
+    assert os.path.exists(blob_path)
+
+
+def test_blob_whose_commit_is_pending_in_another_process_is_kept(make_app, tmp_path):
+    uploader = make_app()
+    checker = make_app()
+    world = uploader.app.test_client().post("/create").json["data"]
+    data = b"stored, not committed yet"
+
+    hash, codec, temp_path = uploader._ingest_upload(
+        FileStorage(io.BytesIO(data)), uploader._upload_temp_dir(), world
+    )
+    with uploader.world_locks.write(world), uploader.blob_locks.write(hash):
+        with uploader._transaction():
+            uploader._store_blob(world, "a", hash, codec, temp_path)
+            # the file is in place, its row only commits with this batch
+            assert blob_row_count(checker, hash) == 0
+            assert checker._check_blob_shard(hash[:2]) is None
+            assert os.path.exists(uploader._blob_path(hash))
+
+    response = checker.app.test_client().get(f"/download?world={world}&blob={hash}")
+    assert response.status_code == 200
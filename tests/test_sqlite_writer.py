@@ -0,0 +1,156 @@
+import io
+import os
+import signal
+import sqlite3
+import threading
+
+import pytest
+
+import app as application
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    db_path = str(tmp_path / "writer.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE parents (id INTEGER PRIMARY KEY)")
+    conn.execute(
+        """
+        CREATE TABLE children (
+            id INTEGER PRIMARY KEY,
+            parent INTEGER REFERENCES parents (id) DEFERRABLE INITIALLY DEFERRED
+        )
+        """
+    )
+    conn.close()
+    return db_path
+
+
+@pytest.fixture
+def writer(db_path):
+    return application.SQLiteWriter(db_path, pragmas=["PRAGMA foreign_keys=ON"])
+
+
+def count(db_path, table):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    finally:
+        conn.close()
+
+
+class FailingCommitMetrics:
+    def observe(self, name, value, **labels):
+        if name.startswith("worldsync_sqlite_commit"):
+            raise RuntimeError("metrics broke")
+
+
+def test_concurrent_writes_share_commits(writer, db_path):
+    writers = 16
+    barrier = threading.Barrier(writers)
+
+    def write(i):
+        barrier.wait()
+        with writer.transaction() as conn:
+            conn.execute("INSERT INTO parents (id) VALUES (?)", (i,))
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    assert count(db_path, "parents") == writers
+    assert writer.writes == writers
+    assert writer.commits <= writers
+
+
+def test_nested_transaction_commits_with_the_outer_one(writer, db_path):
+    with writer.transaction() as conn:
+        conn.execute("INSERT INTO parents (id) VALUES (1)")
+        with writer.transaction() as inner:
+            inner.execute("INSERT INTO parents (id) VALUES (2)")
+        assert count(db_path, "parents") == 0
+
+    assert count(db_path, "parents") == 2
+
+
+def test_failed_write_is_rolled_back(writer, db_path):
+    with pytest.raises(ValueError):
+        with writer.transaction() as conn:
+            conn.execute("INSERT INTO parents (id) VALUES (1)")
+            raise ValueError
+
+    with writer.transaction() as conn:
+        conn.execute("INSERT INTO parents (id) VALUES (2)")
+    assert count(db_path, "parents") == 1
+
+
+def test_failed_commit_wakes_its_writers(writer, db_path):
+    # the foreign key is only checked by the COMMIT
+    with pytest.raises(sqlite3.OperationalError, match="group commit failed"):
+        with writer.transaction() as conn:
+            conn.execute("INSERT INTO children (parent) VALUES (1)")
+
+    with writer.transaction() as conn:
+        conn.execute("INSERT INTO parents (id) VALUES (1)")
+    assert count(db_path, "children") == 0
+    assert count(db_path, "parents") == 1
+
+
+def test_failing_commit_metrics_dont_block_writers(writer, db_path):
+    writer._metrics = FailingCommitMetrics()
+
+    with writer.transaction() as conn:
+        conn.execute("INSERT INTO parents (id) VALUES (1)")
+
+    assert count(db_path, "parents") == 1
+
+
+def run_in_child(fn):
+    "Forks, runs fn in the child and returns whether it finished in time"
+    pid = os.fork()
+    if pid == 0:
+        signal.alarm(10)
+        try:
+            fn()
+        except BaseException:
+            os._exit(1)
+        os._exit(0)
+    _, status = os.waitpid(pid, 0)
+    return os.waitstatus_to_exitcode(status) == 0
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork()")
+def test_forked_child_starts_its_own_commit_thread(writer, db_path):
+    with writer.transaction() as conn:
+        conn.execute("INSERT INTO parents (id) VALUES (1)")
+
+    def write():
+        with writer.transaction() as conn:
+            conn.execute("INSERT INTO parents (id) VALUES (2)")
+
+    assert run_in_child(write)
+    assert count(db_path, "parents") == 2
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork()")
+def test_app_serves_uploads_in_a_forked_worker(app, world):
+    def upload():
+        response = app.app.test_client().post(
+            "/upload",
+            data={
+                "file": (io.BytesIO(b"from a worker"), "f"),
+                "path": "a",
+                "world": str(world),
+            },
+            content_type="multipart/form-data",
+        )
+        assert response.status_code == 200
+        assert app.maintenance._thread.is_alive()
+
+    assert run_in_child(upload)
+    with app._db() as (conn, cursor):
+        cursor.execute("SELECT COUNT(*) FROM entries WHERE world_id = ?", (world,))
+        assert cursor.fetchone()[0] == 1
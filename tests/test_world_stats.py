@@ -0,0 +1,76 @@
+import hashlib
+import io
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+LEGACY_WORLD_ID = 1234567
+
+
+def create_legacy_world(base_dir, files: dict[str, bytes], mtime: float):
+    "A world as the server stored it before entries and the shared blob store"
+    conn = sqlite3.connect(os.path.join(base_dir, "database.db"))
+    conn.execute("CREATE TABLE worlds (id INTEGER PRIMARY KEY, compressed INTEGER DEFAULT 0)")
+    conn.execute("INSERT INTO worlds (id) VALUES (?)", (LEGACY_WORLD_ID,))
+    conn.execute(
+        f"""
+        CREATE TABLE world_{LEGACY_WORLD_ID} (
+            id INTEGER PRIMARY KEY,
+            path STRING UNIQUE,
+            hash STRING,
+            compressed INTEGER DEFAULT 0
+        )
+        """
+    )
+    folder = os.path.join(base_dir, "objects", f"world_{LEGACY_WORLD_ID}")
+    os.makedirs(folder)
+    for path, data in files.items():
+        hash = hashlib.sha1(data).hexdigest()
+        conn.execute(
+            f"INSERT INTO world_{LEGACY_WORLD_ID} (path, hash) VALUES (?, ?)", (path, hash)
+        )
+        blob_path = os.path.join(folder, f"blob_{hash}.bin")
+        with open(blob_path, "wb") as f:
+            f.write(data)
+        os.utime(blob_path, (mtime, mtime))
+    conn.commit()
+    conn.close()
+
+
+def world_stats(app, world_id):
+    with app._db() as (conn, cursor):
+        cursor.execute(
+            "SELECT last_modified, blob_count, total_bytes FROM worlds WHERE id = ?",
+            (world_id,),
+        )
+        return cursor.fetchone()
+
+
+def test_migrated_world_keeps_last_modified_of_its_blobs(tmp_path, make_app):
+    mtime = datetime(2024, 3, 1, tzinfo=timezone.utc).timestamp()
+    files = {"level.dat": b"level", "region/r.0.0.mca": b"region data"}
+    create_legacy_world(str(tmp_path), files, mtime)
+
+    app = make_app()
+
+    assert world_stats(app, LEGACY_WORLD_ID) == (
+        int(mtime),
+        2,
+        sum(len(data) for data in files.values()),
+    )
+
+
+def test_upload_updates_world_stats(app, world):
+    started = int(time.time())
+    response = app.app.test_client().post(
+        "/upload",
+        data={"file": (io.BytesIO(b"x" * 100), "f"), "path": "a", "world": str(world)},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200
+
+    last_modified, blob_count, total_bytes = world_stats(app, world)
+    assert last_modified >= started
+    assert blob_count == 1
+    assert total_bytes > 0